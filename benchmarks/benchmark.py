@@ -0,0 +1,208 @@
+"""Benchmarks of the hot paths of napari-sam.
+
+The SAM models are replaced by a small randomly initialized model with the same architecture and input size, so the
+benchmarks run offline on the CPU and measure the overhead of napari-sam around the model rather than the model itself.
+Results are printed and can be written to a JSON file, which can be passed to --compare in a later run.
+
+Usage:
+    python benchmarks/benchmark.py --output results.json
+    python benchmarks/benchmark.py --compare results.json --filter click
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+import torch
+from segment_anything.build_sam import _build_sam
+from segment_anything.utils.amg import mask_to_rle_pytorch
+
+import napari_sam
+import napari_sam.models as models
+from napari_sam.everything import compose_masks
+from napari_sam.points import PointRegistry
+
+IMAGE_SIZES_2D = [(256, 256), (1024, 1024)]
+VOLUME_SHAPES = [(4, 256, 256), (16, 256, 256), (16, 512, 512)]
+POINT_COUNTS = [10, 100, 1000]
+MASK_COUNTS = [50, 200]
+
+
+def build_tiny_sam(checkpoint=None):
+    """SAM with a single small image encoder block. Uses the input size and the prompt encoder and mask decoder of SAM."""
+    torch.manual_seed(0)
+    return _build_sam(encoder_embed_dim=32, encoder_depth=1, encoder_num_heads=1, encoder_global_attn_indexes=[], checkpoint=None)
+
+
+def use_tiny_sam():
+    """Replace all SAM model types by build_tiny_sam, so no weights are downloaded."""
+    models.sam_model_registry = {model_type: build_tiny_sam for model_type in ("default", "vit_h", "vit_l", "vit_b")}
+    models.get_weights_path = lambda model_type: None
+
+
+def measure(function, repeat, setup=None):
+    """Run setup (untimed) and function repeat times and return the durations of function in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+class WidgetSession:
+    """A headless napari viewer with a SamWidget that is activated in click mode on an image and its labels."""
+    def __init__(self, shape):
+        import napari
+        from napari_sam._widget import SamWidget
+        self.viewer = napari.Viewer(show=False)
+        image = np.random.default_rng(0).random(shape).astype(np.float32)
+        self.image_layer = self.viewer.add_image(image, name="image")
+        self.label_layer = self.viewer.add_labels(np.zeros(shape, dtype=np.int32), name="labels")
+        self.widget = SamWidget(self.viewer)
+        self.widget.cb_image_layers.setCurrentText("image")
+        self.widget.cb_label_layers.setCurrentText("labels")
+        self.widget.cb_lazy_embedding.setChecked(False)
+        self.widget._load_model()
+        self.widget.tasks.wait()
+        self.widget.embedding_cache = None  # Embeddings are computed every time
+        self.widget._activate()
+        self.widget.tasks.wait()
+
+    def set_image(self):
+        self.widget.set_image()
+        self.widget.tasks.wait()
+
+    def click(self, coords):
+        self.widget.do_click(np.asarray(coords), 1)
+        self.widget.tasks.wait()
+
+    def close(self):
+        self.widget._deactivate()
+        self.viewer.close()
+
+
+def bench_set_image(repeat):
+    for shape in IMAGE_SIZES_2D + VOLUME_SHAPES:
+        session = WidgetSession(shape)
+        yield "set_image_{}d".format(len(shape)), {"shape": list(shape)}, measure(session.set_image, repeat)
+        session.close()
+
+
+def bench_click(repeat):
+    """Latency of a click (prediction and labels update) and of the prediction alone against the volume size."""
+    for shape in VOLUME_SHAPES:
+        session = WidgetSession(shape)
+        rng = np.random.default_rng(0)
+        clicks = [(int(rng.integers(shape[0])), shape[1] // 2, shape[2] // 2) for _ in range(repeat)]
+        yield "click", {"shape": list(shape)}, measure(lambda: session.click(clicks.pop()), repeat)
+        widget = session.widget
+        points, labels = np.array([[0, shape[1] // 2, shape[2] // 2]]), np.array([1])
+        yield "predict", {"shape": list(shape)}, measure(lambda: widget.predict(points, labels, 0), repeat)
+        session.close()
+
+
+def bench_update_points_layer(repeat):
+    session = WidgetSession(VOLUME_SHAPES[0])
+    rng = np.random.default_rng(0)
+    for num_points in POINT_COUNTS:
+        points = PointRegistry(3)
+        for coords in rng.integers(0, VOLUME_SHAPES[0], size=(num_points, 3)):
+            points.add(coords, int(rng.integers(1, 10)))
+        yield "update_points_layer", {"points": num_points}, measure(lambda: session.widget.update_points_layer(points), repeat)
+    session.close()
+
+
+def create_records(num_masks, size, rng):
+    """Records of random elliptical masks in the format of SamAutomaticMaskGenerator(output_mode="uncompressed_rle")."""
+    rows, columns = np.ogrid[:size, :size]
+    masks = []
+    for _ in range(num_masks):
+        center, radii = rng.integers(0, size, 2), rng.integers(5, size // 8, 2)
+        masks.append(((rows - center[0]) / radii[0]) ** 2 + ((columns - center[1]) / radii[1]) ** 2 <= 1)
+    rles = mask_to_rle_pytorch(torch.from_numpy(np.stack(masks)))
+    return [{"segmentation": rle, "area": int(mask.sum()), "predicted_iou": float(rng.random())} for rle, mask in zip(rles, masks)]
+
+
+def bench_compose_masks(repeat):
+    """Mask composition of AUTO mode."""
+    rng = np.random.default_rng(0)
+    size = 1024
+    for num_masks in MASK_COUNTS:
+        records = create_records(num_masks, size, rng)
+        labels = np.zeros((size, size), dtype=np.int32)
+        yield "compose_masks", {"masks": num_masks, "size": size}, measure(lambda: compose_masks(records, labels), repeat, lambda: labels.fill(0))
+
+
+BENCHMARKS = {
+    "set_image": bench_set_image,
+    "click": bench_click,
+    "update_points_layer": bench_update_points_layer,
+    "compose_masks": bench_compose_masks,
+}
+
+
+def get_metadata():
+    return {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "napari_sam": napari_sam.__version__,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "num_threads": torch.get_num_threads(),
+        "environment": {name: value for name, value in os.environ.items() if name.startswith("NAPARI_SAM_")},
+    }
+
+
+def get_result_key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+def run(names, repeat, baseline=None):
+    """Run the benchmarks of names and print one line per result, with the change to baseline results if given."""
+    baseline = {get_result_key(result): result for result in baseline["results"]} if baseline is not None else {}
+    results = []
+    for name in names:
+        for result_name, params, times in BENCHMARKS[name](repeat):
+            result = {"name": result_name, "params": params, "repeat": repeat, "times_ms": times,
+                      "median_ms": statistics.median(times), "mean_ms": statistics.mean(times), "min_ms": min(times)}
+            line = "{:<20} {:<40} median {:9.2f} ms  min {:9.2f} ms".format(result_name, json.dumps(params), result["median_ms"], result["min_ms"])
+            before = baseline.get(get_result_key(result))
+            if before is not None:
+                line += "  {:+.1%} vs. baseline".format(result["median_ms"] / before["median_ms"] - 1)
+            print(line, flush=True)
+            results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark napari-sam with a tiny stand-in SAM model.")
+    parser.add_argument("--output", help="JSON file the results are written to.")
+    parser.add_argument("--compare", help="JSON file of an earlier run the results are compared with.")
+    parser.add_argument("--filter", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS), help="Benchmarks that are run.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs per benchmark.")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    use_tiny_sam()
+    results = run(args.filter, args.repeat, baseline)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"metadata": get_metadata(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,13 @@
 __version__ = "0.3.10"
-from ._widget import SamWidget
 
 __all__ = (
     "SamWidget"
 )
+
+
+def __getattr__(name):
+    # The widget is imported on first access, so that importing the package does not import napari and Qt
+    if name == "SamWidget":
+        from ._widget import SamWidget
+        return SamWidget
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="session")
+def build_tiny_sam():
+    """Builder of randomly initialized SAMs with a single small image encoder block, the prompt encoder and mask decoder of SAM.
+
+    Has the signature of the builders in segment_anything.sam_model_registry.
+    """
+    torch = pytest.importorskip("torch")
+    build_sam = pytest.importorskip("segment_anything.build_sam")
+
+    def build_tiny_sam(checkpoint=None):
+        torch.manual_seed(0)
+        return build_sam._build_sam(encoder_embed_dim=32, encoder_depth=1, encoder_num_heads=1, encoder_global_attn_indexes=[], checkpoint=checkpoint)
+    return build_tiny_sam
+
+
+@pytest.fixture(scope="session")
+def tiny_sam(build_tiny_sam):
+    return build_tiny_sam().eval()
+
+
+@pytest.fixture
+def make_sam_widget(make_napari_viewer, tiny_sam, monkeypatch):
+    """Factory of SamWidgets with the tiny SAM that are activated in click mode on an image and labels."""
+    models = pytest.importorskip("napari_sam.models")
+    from napari_sam._widget import SamWidget
+    monkeypatch.setattr(models, "sam_model_registry", {model_type: lambda checkpoint=None: tiny_sam for model_type in ("default", "vit_h", "vit_l", "vit_b")})
+    monkeypatch.setattr(models, "get_weights_path", lambda model_type: None)
+
+    def make_sam_widget(image, labels=None, multimask=False):
+        viewer = make_napari_viewer()
+        viewer.add_image(image, name="image")
+        viewer.add_labels(np.zeros(image.shape, dtype=np.int32) if labels is None else labels, name="labels")
+        widget = SamWidget(viewer)
+        widget.embedding_cache = None
+        widget.cb_image_layers.setCurrentText("image")
+        widget.cb_label_layers.setCurrentText("labels")
+        widget.cb_multimask.setChecked(multimask)
+        widget._load_model()
+        widget.tasks.wait()
+        widget._activate()
+        widget.tasks.wait()
+        return widget
+    return make_sam_widget
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+from napari_sam import cli, engine, models  # noqa: E402
+
+
+def test_segment_directory(tmp_path, tiny_sam, monkeypatch):
+    monkeypatch.setattr(models, "sam_model_registry", {"vit_b": lambda checkpoint=None: tiny_sam})
+    monkeypatch.setattr(models, "get_weights_path", lambda model_type: None)
+    # A coarse point grid keeps the Everything mode of the tiny SAM fast
+    monkeypatch.setattr(cli, "create_mask_generator", lambda sam_model: engine.create_mask_generator(sam_model, points_per_side=4))
+    input_dir, output_dir = tmp_path / "images", tmp_path / "labels"
+    input_dir.mkdir()
+    rng = np.random.default_rng(0)
+    np.save(input_dir / "image.npy", rng.random((48, 64)).astype(np.float32))
+    with open(input_dir / "VOLUME.NPY", "wb") as f:  # np.save would append .npy
+        np.save(f, rng.integers(0, 256, (2, 40, 56), dtype=np.uint8))
+    (input_dir / "notes.txt").write_text("not an image")
+
+    assert cli.read_image(input_dir / "VOLUME.NPY").shape == (2, 40, 56)
+    cli.main([str(input_dir), str(output_dir), "--model-type", "vit_b", "--device", "cpu", "--workers", "0"])
+    assert sorted(path.name for path in output_dir.iterdir()) == ["VOLUME.npy", "image.npy"]
+    image_labels, volume_labels = np.load(output_dir / "image.npy"), np.load(output_dir / "VOLUME.npy")
+    assert image_labels.shape == (48, 64) and image_labels.dtype == np.int32
+    assert volume_labels.shape == (2, 40, 56)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+from segment_anything import SamPredictor  # noqa: E402
+from napari_sam.decoder import ExportedDecoder, check_decoder  # noqa: E402
+from napari_sam.engine import set_image_size  # noqa: E402
+
+BACKENDS = ["torch", "torchscript", "onnx"]
+
+
+def create_decoder(sam_model, backend):
+    if backend == "onnx":
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+    return ExportedDecoder(sam_model, backend)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_decoder_matches_sam_predictor(tiny_sam, backend):
+    assert check_decoder(create_decoder(tiny_sam, backend), tiny_sam)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("multimask_output", [False, True])
+def test_predict_batch_matches_predict(tiny_sam, backend, multimask_output):
+    decoder = create_decoder(tiny_sam, backend)
+    predictor = SamPredictor(tiny_sam)
+    set_image_size(predictor, (600, 800))
+    generator = torch.Generator().manual_seed(0)
+    features = torch.randn(3, tiny_sam.prompt_encoder.embed_dim, *tiny_sam.prompt_encoder.image_embedding_size, generator=generator)
+    mask_input = torch.randn(3, 1, *tiny_sam.prompt_encoder.mask_input_size, generator=generator).numpy()
+    boxes = np.array([[50, 60, 500, 400], [10, 20, 300, 550], [400, 100, 790, 590]])
+    point_coords = np.array([[[100, 200]], [[200, 300]], [[500, 300]]])
+    point_labels = np.ones((3, 1))
+
+    masks, scores, logits = decoder.predict_batch(predictor, features, point_coords, point_labels, boxes, mask_input, multimask_output)
+    assert masks.shape == (3, 3 if multimask_output else 1, 600, 800)
+    for index in range(3):
+        slice_masks, slice_scores, slice_logits = decoder.predict(predictor, features[index:index + 1], point_coords[index], point_labels[index],
+                                                                  boxes[index], mask_input[index], multimask_output)
+        np.testing.assert_allclose(logits[index], slice_logits, rtol=1e-3, atol=1e-3 * np.abs(slice_logits).max())
+        np.testing.assert_allclose(scores[index], slice_scores, rtol=1e-3, atol=1e-3)
+        assert np.mean(masks[index] != slice_masks) < 1e-3
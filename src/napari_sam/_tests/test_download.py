@@ -0,0 +1,129 @@
+import hashlib
+import http.server
+import os
+import socketserver
+import threading
+import urllib.error
+import pytest
+from napari_sam import download
+from napari_sam.download import download_file, get_mirror_url, is_verified
+
+DATA = os.urandom(300000)
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves data with support for Range requests and closes the first `drops` responses after a third of their body."""
+    data = DATA
+    missing = False
+    drops = 0
+    starts = []
+
+    def do_GET(self):
+        cls = type(self)
+        range_header = self.headers.get("Range")
+        start = int(range_header[len("bytes="):].split("-")[0]) if range_header else 0
+        cls.starts.append(start)
+        if cls.missing:
+            self.send_error(404)
+            return
+        if start >= len(cls.data):
+            self.send_response(416)
+            self.end_headers()
+            return
+        body = cls.data[start:]
+        if range_header:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(cls.data) - 1, len(cls.data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if cls.drops > 0:
+            cls.drops -= 1
+            body = body[:len(body) // 3]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(download.time, "sleep", sleeps.append)
+    return sleeps
+
+
+@pytest.fixture
+def server(sleeps):
+    handler = type("Handler", (RangeHandler,), {"starts": []})
+    httpd = socketserver.ThreadingTCPServer(("127.0.0.1", 0), handler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield handler, "http://127.0.0.1:{}/sam_test.pth".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_resumes_dropped_connections(server, tmp_path):
+    handler, url = server
+    handler.drops = 2
+    path = download_file(url, tmp_path / "sam_test.pth", SHA256)
+    assert path.read_bytes() == DATA
+    assert handler.starts[0] == 0 and handler.starts[1] > 0 and handler.starts[2] > handler.starts[1]
+    assert not (tmp_path / "sam_test.pth.part").exists()
+    assert is_verified(path, SHA256)
+
+
+def test_stale_partial_download_is_restarted(server, tmp_path):
+    handler, url = server
+    (tmp_path / "sam_test.pth.part").write_bytes(b"stale" * 1000)
+    path = download_file(url, tmp_path / "sam_test.pth", SHA256)
+    assert path.read_bytes() == DATA
+    assert handler.starts == [5000, 0]
+
+
+def test_checksum_mismatch_removes_download(server, tmp_path):
+    _, url = server
+    with pytest.raises(RuntimeError):
+        download_file(url, tmp_path / "sam_test.pth", "0" * 64)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_verification_is_recorded_until_modified(tmp_path):
+    path = tmp_path / "sam_test.pth"
+    path.write_bytes(DATA)
+    assert is_verified(path, SHA256)
+    assert (tmp_path / "sam_test.pth.sha256").is_file()
+    path.write_bytes(DATA[:-1])
+    assert not is_verified(path, SHA256)
+
+
+def test_weights_from_local_mirror(tmp_path, monkeypatch):
+    from napari_sam.utils import get_weights_path
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    (mirror / "sam_vit_b_01ec64.pth").write_bytes(DATA)
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    monkeypatch.setenv("NAPARI_SAM_WEIGHTS_URL", str(mirror))
+    monkeypatch.setitem(download.SAM_WEIGHTS_SHA256, "sam_vit_b_01ec64.pth", SHA256)
+    assert get_mirror_url("https://example.com/weights/sam_vit_b_01ec64.pth") == str(mirror / "sam_vit_b_01ec64.pth")
+    path = get_weights_path("vit_b")
+    assert path.parent == tmp_path / "home" / ".cache/napari-segment-anything"
+    assert path.read_bytes() == DATA
+    (mirror / "sam_vit_b_01ec64.pth").unlink()
+    assert get_weights_path("vit_b") == path  # Verified weights are not downloaded again
+
+
+def test_missing_file_is_not_retried(server, sleeps, tmp_path):
+    handler, url = server
+    handler.missing = True
+    with pytest.raises(urllib.error.HTTPError):
+        download_file(url, tmp_path / "sam_test.pth", SHA256)
+    assert handler.starts == [0]
+    with pytest.raises(FileNotFoundError):
+        download_file(str(tmp_path / "mirror" / "sam_test.pth"), tmp_path / "sam_test.pth", SHA256)
+    assert sleeps == []
@@ -0,0 +1,141 @@
+import time
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+from segment_anything import SamPredictor  # noqa: E402
+from napari_sam.embedding import SliceEmbeddings, encode_images, from_storage, get_device_cache_size, get_numpy_dtype, to_storage  # noqa: E402
+from napari_sam.embedding_cache import EmbeddingCache  # noqa: E402
+
+FEATURES_SHAPE = (2, 4, 4)
+
+
+class FakeEncoder:
+    """Encodes an image to features filled with its mean and records the number of encoded images."""
+    def __init__(self):
+        self.num_encoded = 0
+        self.encoded = []
+
+    def __call__(self, images):
+        self.num_encoded += len(images)
+        self.encoded.extend(int(image.mean()) for image in images)
+        return torch.stack([torch.full(FEATURES_SHAPE, float(image.mean())) for image in images])
+
+
+def create_embeddings(images, encode=None, storage_dtype="float32", features=None, valid=None, **kwargs):
+    num_slices = len(images)
+    if features is None:
+        features = np.zeros((num_slices, *FEATURES_SHAPE), dtype=get_numpy_dtype(storage_dtype))
+        valid = np.zeros(num_slices, dtype=bool)
+    return SliceEmbeddings(encode or FakeEncoder(), lambda index: images[index], features, valid, "cpu", storage_dtype=storage_dtype, **kwargs)
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("float32", 0), ("float16", 1e-3), ("bfloat16", 1e-2)])
+def test_storage_round_trip(dtype, tolerance):
+    features = torch.randn(3, 8, 5, 5, generator=torch.Generator().manual_seed(0))
+    stored = to_storage(features, dtype)
+    assert stored.dtype == get_numpy_dtype(dtype)
+    assert stored.nbytes == features.numel() * (4 if dtype == "float32" else 2)
+    restored = from_storage(stored, dtype)
+    assert restored.dtype == torch.float32
+    torch.testing.assert_close(restored, features, rtol=tolerance, atol=tolerance)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "bfloat16"])
+def test_from_storage_copies(dtype):
+    stored = to_storage(torch.ones(1, 2, 3, 3), dtype)
+    features = from_storage(stored, dtype)
+    features += 1
+    torch.testing.assert_close(from_storage(stored, dtype), torch.ones(1, 2, 3, 3))
+
+
+def test_get_device_cache_size(monkeypatch):
+    monkeypatch.setenv("NAPARI_SAM_DEVICE_CACHE_SIZE", "0.5")
+    assert get_device_cache_size() == 512 * 1024
+    assert get_device_cache_size(2) == 2 * 1024 ** 2
+
+
+@pytest.mark.parametrize("storage_dtype", ["float32", "bfloat16"])
+def test_device_cache_evicts_least_recently_used(storage_dtype):
+    images = [np.full((8, 8, 3), index, dtype=np.uint8) for index in range(5)]
+    slice_size = 4 * int(np.prod(FEATURES_SHAPE))  # Features are kept on the device in float32
+    embeddings = create_embeddings(images, storage_dtype=storage_dtype, device_cache_size=2.5 * slice_size)
+    assert embeddings.max_device_slices == 2
+    for index in (0, 1, 2, 1, 3):
+        features = embeddings[index]
+        assert features.shape == (1, *FEATURES_SHAPE) and features.dtype == torch.float32
+        assert float(features[0, 0, 0, 0]) == index
+    assert list(embeddings._device_cache) == [1, 3]
+    assert embeddings[1] is embeddings._device_cache[1]
+    embeddings.close()
+    assert len(embeddings._device_cache) == 0
+
+
+def create_images(num_slices):
+    return [np.full((8, 8, 3), index, dtype=np.uint8) for index in range(num_slices)]
+
+
+def wait_until(condition, timeout=10):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout
+        time.sleep(0.01)
+
+
+def test_only_requested_slice_is_encoded():
+    encoder = FakeEncoder()
+    embeddings = create_embeddings(create_images(5), encoder)
+    assert float(embeddings[3][0, 0, 0, 0]) == 3
+    assert encoder.encoded == [3]
+    np.testing.assert_array_equal(embeddings.valid, [False, False, False, True, False])
+    embeddings[3]
+    assert encoder.num_encoded == 1
+    embeddings.compute([1, 3, 4])
+    assert encoder.encoded == [3, 1, 4]
+    assert embeddings.num_computed() == 3
+    embeddings.close()
+
+
+def test_prefetch_starts_at_center():
+    encoder = FakeEncoder()
+    embeddings = create_embeddings(create_images(6), encoder)
+    embeddings[2]
+    embeddings.prefetch(2)
+    wait_until(lambda: embeddings.num_computed() == 6)
+    wait_until(lambda: embeddings._num_prefetch_workers == 0)
+    assert encoder.encoded == [2, 1, 3, 0, 4, 5]
+    embeddings.close()
+
+
+def test_changed_cached_slice_is_embedded_again(tmp_path):
+    images = create_images(5)
+    features, valid, digests = EmbeddingCache(tmp_path).open("key", (5, *FEATURES_SHAPE))
+    embeddings = create_embeddings(images, features=features, valid=valid, digests=digests)
+    embeddings.compute(range(5))
+    embeddings.close()
+    del features, valid, digests, embeddings
+
+    images[2] = np.full((8, 8, 3), 9, dtype=np.uint8)
+    encoder = FakeEncoder()
+    features, valid, digests = EmbeddingCache(tmp_path).open("key", (5, *FEATURES_SHAPE))
+    assert valid.all()
+    embeddings = create_embeddings(images, encoder, features=features, valid=valid, digests=digests)
+    assert [float(embeddings[index][0, 0, 0, 0]) for index in range(5)] == [0, 1, 9, 3, 4]
+    assert encoder.encoded == [9]
+    embeddings.close()
+
+
+def test_batched_encode_matches_single_encode(tiny_sam):
+    transform = SamPredictor(tiny_sam).transform
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (60, 80, 3), dtype=np.uint8) for _ in range(2)]
+    images.append(np.broadcast_to(rng.integers(0, 256, (60, 80, 1), dtype=np.uint8), (60, 80, 3)))  # Grayscale
+    batched = encode_images(tiny_sam, transform, images)
+    assert batched.shape == (3, tiny_sam.prompt_encoder.embed_dim, *tiny_sam.prompt_encoder.image_embedding_size)
+    for index, image in enumerate(images):
+        torch.testing.assert_close(batched[index:index + 1], encode_images(tiny_sam, transform, [image]), rtol=1e-4, atol=1e-5)
+
+    predictor = SamPredictor(tiny_sam)
+    predictor.set_image(images[0])
+    torch.testing.assert_close(batched[:1], predictor.features, rtol=1e-4, atol=1e-5)
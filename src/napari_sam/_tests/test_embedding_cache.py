@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pytest
+
+from napari_sam.embedding_cache import DIGEST_SIZE, EmbeddingCache, embedding_key, get_image_digest
+
+SHAPE = (2, 8, 8, 8)
+
+
+def test_embedding_key():
+    image = np.random.default_rng(0).random((3, 16, 16)).astype(np.float32)
+    key = embedding_key(image, (0, 1), "vit_b")
+    assert key == embedding_key(image.copy(), (0.0, 1.0), "vit_b")
+    changed = image.copy()
+    changed[0, 0, 0] += 1
+    assert embedding_key(changed, (0, 1), "vit_b") != key
+    assert embedding_key(image.astype(np.float64), (0, 1), "vit_b") != key
+    assert embedding_key(image, (0, 0.5), "vit_b") != key
+    assert embedding_key(image, None, "vit_b") != key
+    assert embedding_key(image, (0, 1), "vit_h") != key
+    assert embedding_key(image, (0, 1), "vit_b", get_image_digest(image)) == key
+
+
+def test_image_digest_samples_the_slice_stack():
+    volume = np.zeros((40, 16, 16), dtype=np.uint8)
+    other = volume.copy()
+    other[-1] = 1
+    assert get_image_digest(volume, 3) != get_image_digest(other, 3)
+
+
+def test_embedding_key_includes_precision():
+    models = pytest.importorskip("napari_sam.models")
+    image = np.zeros((16, 16), dtype=np.uint8)
+    keys = {embedding_key(image, None, models.get_model_id("vit_b", precision)) for precision in models.PRECISIONS}
+    assert len(keys) == len(models.PRECISIONS)
+    assert models.get_model_id("vit_b", "float32") == "vit_b"
+
+
+def test_reopen_persisted_entry(tmp_path):
+    cache = EmbeddingCache(tmp_path, max_size=1)
+    features, valid, digests = cache.open("key", SHAPE)
+    assert features.shape == SHAPE and not valid.any() and digests.shape == (SHAPE[0], DIGEST_SIZE)
+    features[1] = 3
+    valid[1] = True
+    digests[1] = 7
+    del features, valid, digests
+
+    features, valid, digests = EmbeddingCache(tmp_path, max_size=1).open("key", SHAPE)
+    assert isinstance(features, np.memmap)
+    np.testing.assert_array_equal(valid, [False, True])
+    assert np.all(features[1] == 3) and np.all(digests[1] == 7)
+    del features, valid, digests
+
+    # An entry of another shape or dtype is replaced by an empty one
+    features, valid, _ = cache.open("key", (3, *SHAPE[1:]))
+    assert features.shape == (3, *SHAPE[1:]) and not valid.any()
+    features, valid, _ = cache.open("key", (3, *SHAPE[1:]), np.float16)
+    assert features.dtype == np.float16 and not valid.any()
+
+
+def test_lru_eviction(tmp_path):
+    cache = EmbeddingCache(tmp_path, max_size=1)
+    cache.open("probe", SHAPE)
+    entry_size = (tmp_path / "probe.features.npy").stat().st_size
+    cache.remove("probe")
+    assert list(tmp_path.iterdir()) == []
+
+    cache = EmbeddingCache(tmp_path, max_size=2.5 * entry_size / 1024 ** 3)
+    for age, key in ((200, "a"), (100, "b")):
+        cache.open(key, SHAPE)
+        os.utime(tmp_path / "{}.features.npy".format(key), (age, age))
+    cache.open("a", SHAPE)  # Marks a as recently used
+    cache.open("c", SHAPE)
+    assert sorted(path.name.split(".")[0] for path in tmp_path.glob("*.features.npy")) == ["a", "c"]
+    assert not any(tmp_path.glob("b.*"))
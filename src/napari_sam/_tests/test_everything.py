@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+from segment_anything.utils.amg import mask_to_rle_pytorch  # noqa: E402
+from napari_sam.everything import compose_masks, decode_rle_crop, match_labels, merge_tile_labels  # noqa: E402
+
+
+def to_rle(mask):
+    return mask_to_rle_pytorch(torch.from_numpy(mask[None]))[0]
+
+
+def to_record(mask, predicted_iou=0.9):
+    return {"segmentation": to_rle(mask), "area": int(mask.sum()), "predicted_iou": predicted_iou}
+
+
+def box_mask(shape, rows, columns):
+    mask = np.zeros(shape, dtype=bool)
+    mask[rows, columns] = True
+    return mask
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_decode_rle_crop(seed):
+    rng = np.random.default_rng(seed)
+    mask = rng.random((37, 23)) > 0.7
+    mask[:, :3] = False
+    crop, bbox = decode_rle_crop(to_rle(mask))
+    np.testing.assert_array_equal(mask[bbox], crop)
+    assert mask.sum() == crop.sum()
+    assert crop[0].any() and crop[-1].any() and crop[:, 0].any() and crop[:, -1].any()
+
+
+def test_decode_rle_crop_empty_and_full():
+    assert decode_rle_crop(to_rle(np.zeros((5, 6), dtype=bool))) == (None, None)
+    crop, bbox = decode_rle_crop(to_rle(np.ones((5, 6), dtype=bool)))
+    assert crop.all() and bbox == (slice(0, 5), slice(0, 6))
+
+
+def test_compose_masks_order():
+    shape = (20, 20)
+    large = box_mask(shape, slice(0, 15), slice(0, 15))
+    small = box_mask(shape, slice(5, 10), slice(5, 10))
+    records = [to_record(small, 0.95), to_record(large, 0.5)]
+
+    labels = np.zeros(shape, dtype=np.int32)
+    assert compose_masks(records, labels, order="area") == 3
+    assert labels[7, 7] == 2 and labels[0, 0] == 1  # Small masks stay visible
+    assert labels[19, 19] == 0
+
+    labels = np.zeros(shape, dtype=np.int32)
+    compose_masks(records, labels, order="predicted_iou", start_label=10)
+    assert labels[7, 7] == 11 and labels[0, 0] == 10
+
+    labels = np.full(shape, 7, dtype=np.int32)
+    labels[10:] = 0
+    compose_masks(records, labels, overwrite=False)
+    assert labels[7, 7] == 7 and labels[12, 12] == 1
+
+    with pytest.raises(RuntimeError):
+        compose_masks(records, labels, order="unknown")
+
+
+def test_match_labels():
+    reference = np.zeros((10, 10), dtype=np.int32)
+    reference[:5] = 4
+    reference[5:] = 9
+    labels = np.zeros((10, 10), dtype=np.int32)
+    labels[:4] = 1  # IoU 0.8 with 4
+    labels[8:, :2] = 2  # IoU 0.08 with 9
+    mapping = match_labels(labels, reference, 2)
+    np.testing.assert_array_equal(mapping, [0, 4, 0])
+    np.testing.assert_array_equal(match_labels(labels, np.zeros_like(reference), 2), [0, 0, 0])
+
+
+def test_merge_tile_labels():
+    region = np.zeros((10, 20), dtype=np.int32)
+    region[2:6, :12] = 3  # Instance of a previous tile that continues into this tile
+    processed = np.zeros(region.shape, dtype=bool)
+    processed[:, :10] = True
+    tile_labels = np.zeros(region.shape, dtype=np.int32)
+    tile_labels[2:6, 4:18] = 1  # IoU 0.6 with 3 within the processed part
+    tile_labels[8:, 15:] = 2
+    next_label = merge_tile_labels(tile_labels, region, processed, next_label=4)
+    assert next_label == 5
+    assert np.all(region[2:6, :18] == 3)
+    assert np.all(region[8:, 15:] == 4)
+    assert merge_tile_labels(np.zeros_like(tile_labels), region, processed, next_label) == next_label
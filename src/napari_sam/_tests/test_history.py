@@ -0,0 +1,81 @@
+import numpy as np
+
+from napari_sam.history import History, LabelDelta, LogitsStore, rle_decode, rle_encode
+
+
+def test_rle_round_trip():
+    values = np.array([3, 3, 0, 0, 0, 7, 3, 3])
+    encoded = rle_encode(values)
+    np.testing.assert_array_equal(encoded[0], [3, 0, 7, 3])
+    np.testing.assert_array_equal(encoded[1], [2, 3, 1, 2])
+    np.testing.assert_array_equal(rle_decode(encoded), values)
+    assert len(rle_decode(rle_encode(values[:0]))) == 0
+
+
+def test_label_delta_apply_and_undo():
+    rng = np.random.default_rng(0)
+    before = rng.integers(0, 3, size=(4, 20, 30)).astype(np.int32)
+    after = before.copy()
+    after[1, 5:12, 8:20] = 5
+    after[2, 15, 3] = 9
+    indices = np.nonzero(before != after)
+    delta = LabelDelta(indices, before[indices], after[indices])
+    assert delta.region == (slice(1, 3), slice(5, 16), slice(3, 20))
+
+    data = before.copy()
+    assert delta.apply(data, undoing=False) == delta.region
+    np.testing.assert_array_equal(data, after)
+    delta.apply(data, undoing=True)
+    np.testing.assert_array_equal(data, before)
+
+
+def test_label_delta_broadcasts_new_value():
+    before = np.zeros((10, 10), dtype=np.int32)
+    indices = (np.array([2, 2, 3]), np.array([4, 5, 4]))
+    delta = LabelDelta(indices, before[indices], 4)
+    data = before.copy()
+    delta.apply(data, undoing=False)
+    assert data.sum() == 12 and np.all(data[indices] == 4)
+
+
+def test_logits_store_refcounting():
+    store = LogitsStore()
+    logits = np.zeros((1, 256, 256), dtype=np.float32)
+    key = store.add(logits)
+    assert store.add(logits) == key
+    assert store.nbytes == logits.nbytes
+    store.release(key)
+    assert store.get(key) is logits
+    store.release(key)
+    assert store.nbytes == 0
+    assert store.add(None) is None
+
+
+def test_history_undo_redo():
+    history = History(max_size=1)
+    history.push((0, np.array([1, 2]), 1, True), (1, 1), None, (None, None), None)
+    history.push((1, np.array([3, 4]), 1, True), (1, 1), None, (None, None), None)
+    assert history.undo().point[0] == 1
+    assert history.redo().point[0] == 1
+    assert history.redo() is None
+    history.undo()
+    history.push((2, np.array([5, 6]), 2, True), (1, 2), None, (None, None), None)  # Clears the redo history
+    assert history.redo() is None
+    assert history.undo().point[0] == 2
+    assert history.undo().point[0] == 0
+    assert history.undo() is None
+
+
+def test_history_evicts_oldest_items_over_budget():
+    logits_size = 256 * 256 * 4
+    history = History(max_size=3.5 * logits_size / 1024 ** 2)
+    logits = [np.full((1, 256, 256), index, dtype=np.float32) for index in range(6)]
+    for index in range(5):
+        history.push((index, np.array([0, 0]), 1, True), (1, 1), None, (logits[index], logits[index + 1]), None)
+        assert history.nbytes <= history.max_size
+    # Logits shared by neighbouring items are stored once, so two items fit into the budget
+    assert history.logits_store.nbytes == 3 * logits_size
+    undone = [history.undo() for _ in range(3)]
+    assert [item.point[0] for item in undone[:2]] == [4, 3]
+    assert undone[2] is None
+    np.testing.assert_array_equal(history.get_logits(undone[1].logits[0]), logits[3])
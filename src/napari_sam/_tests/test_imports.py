@@ -0,0 +1,16 @@
+import subprocess
+import sys
+
+CODE = """
+import sys
+import napari_sam
+import napari_sam._widget
+heavy = sorted(name for name in ("torch", "segment_anything") if name in sys.modules)
+assert not heavy, heavy
+"""
+
+
+def test_widget_import_does_not_import_torch():
+    # A fresh interpreter, since other tests import torch into this one
+    result = subprocess.run([sys.executable, "-c", CODE], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,45 @@
+import numpy as np
+
+from napari_sam.labels import get_chunk_shape, write_values
+
+
+class ChunkedArray:
+    """Array with a zarr-like chunks attribute that records the regions that are written."""
+    def __init__(self, data, chunks):
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.chunks = chunks
+        self.written = []
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.written.append(key)
+        self.data[key] = value
+
+
+def test_write_values_numpy():
+    data = np.zeros((3, 8, 8), dtype=np.int32)
+    indices = (np.array([0, 2]), np.array([1, 7]), np.array([3, 0]))
+    bbox = write_values(data, indices, np.array([4, 5]))
+    assert bbox == (slice(0, 3), slice(1, 8), slice(0, 4))
+    assert data[0, 1, 3] == 4 and data[2, 7, 0] == 5 and data.sum() == 9
+    assert write_values(data, (np.array([], dtype=int),) * 3, 1) is None
+
+
+def test_write_values_chunked_writes_only_changed_chunks():
+    expected = np.arange(10 * 10, dtype=np.int32).reshape(10, 10)
+    data = ChunkedArray(expected.copy(), (4, 4))
+    assert get_chunk_shape(data) == (4, 4)
+    indices = (np.array([0, 1, 9]), np.array([0, 3, 9]))
+    write_values(data, indices, 0)
+    expected[indices] = 0
+    np.testing.assert_array_equal(data.data, expected)
+    assert data.written == [(slice(0, 4), slice(0, 4)), (slice(8, 10), slice(8, 10))]
+
+
+def test_get_chunk_shape():
+    assert get_chunk_shape(np.zeros(3)) is None
+    assert get_chunk_shape(ChunkedArray(np.zeros((2, 2)), ((1, 1), (2,)))) is None  # Dask-style chunks
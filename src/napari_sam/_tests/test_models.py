@@ -0,0 +1,87 @@
+import gc
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+from segment_anything import SamPredictor  # noqa: E402
+from napari_sam import models  # noqa: E402
+
+
+@pytest.fixture
+def counting_builder(build_tiny_sam, monkeypatch):
+    """Registers build_tiny_sam for all model types and counts the built models."""
+    built = []
+
+    def build(checkpoint=None):
+        built.append(checkpoint)
+        return build_tiny_sam(checkpoint)
+    monkeypatch.setattr(models, "sam_model_registry", {model_type: build for model_type in ("default", "vit_h", "vit_l", "vit_b")})
+    monkeypatch.setattr(models, "get_weights_path", lambda model_type: None)
+    monkeypatch.setattr(models, "_models", type(models._models)())
+    return built
+
+
+def test_widgets_share_one_model(make_napari_viewer, counting_builder):
+    from napari_sam._widget import SamWidget
+    viewer = make_napari_viewer()
+    widgets = [SamWidget(viewer), SamWidget(viewer)]
+    for widget in widgets:
+        widget._load_model()
+        widget.tasks.wait()
+    assert widgets[0].sam_model is widgets[1].sam_model
+    assert len(counting_builder) == 1
+
+    # The registry only holds weak references, so the model is freed once no widget uses it anymore
+    for widget in widgets:
+        widget.sam_model = widget.sam_predictor = widget.sam_decoder = widget.sam_propagation_decoder = widget.sam_anything_predictor = None
+    gc.collect()
+    assert len(models._models) == 0
+    models.get_model("vit_b")
+    assert len(counting_builder) == 2
+
+
+def test_get_model_per_precision(counting_builder):
+    float32_model = models.get_model("vit_b", precision="float32")
+    assert models.get_model("vit_b", precision="float32") is float32_model
+    assert models.get_model("vit_b", precision="bfloat16") is not float32_model
+    assert len(counting_builder) == 2
+    with pytest.raises(RuntimeError):
+        models.get_model("vit_b", precision="float64")
+
+
+def test_load_weights_matches_build_sam(tmp_path, build_tiny_sam, monkeypatch):
+    checkpoint = tmp_path / "sam.pth"
+    torch.manual_seed(1)
+    state_dict = {name: torch.randn_like(tensor) for name, tensor in build_tiny_sam().state_dict().items()}
+    torch.save(state_dict, checkpoint)
+    monkeypatch.setattr(models, "sam_model_registry", {"vit_b": build_tiny_sam})
+
+    loaded = models.load_weights("vit_b", checkpoint)
+    expected = build_tiny_sam(checkpoint)
+    assert not any(tensor.is_meta for tensor in list(loaded.parameters()) + list(loaded.buffers()))
+    loaded_state, expected_state = loaded.state_dict(), expected.state_dict()
+    assert loaded_state.keys() == expected_state.keys()
+    for name in expected_state:
+        torch.testing.assert_close(loaded_state[name], expected_state[name], rtol=0, atol=0)
+    torch.testing.assert_close(loaded.pixel_mean, expected.pixel_mean)
+    torch.testing.assert_close(loaded.pixel_std, expected.pixel_std)
+
+
+@pytest.mark.parametrize("precision", ["bfloat16", "float16"])
+def test_reduced_precision_keeps_float32_outputs(counting_builder, precision):
+    sam_model = models.get_model("vit_b", precision=precision)
+    assert sam_model.image_encoder.patch_embed.proj.weight.dtype == models.PRECISIONS[precision]
+    assert sam_model.prompt_encoder.point_embeddings[0].weight.dtype == torch.float32
+    if precision == "float16":  # Half precision convolutions are not implemented on all CPUs
+        return
+    predictor = SamPredictor(sam_model)
+    image = np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+    predictor.set_image(image)
+    assert predictor.features.dtype == torch.float32
+    masks, scores, logits = predictor.predict(point_coords=np.array([[32, 32]]), point_labels=np.array([1]))
+    assert scores.dtype == np.float32 and logits.dtype == np.float32
+
+    float32_predictor = SamPredictor(models.get_model("vit_b", precision="float32"))
+    float32_predictor.set_image(image)
+    torch.testing.assert_close(predictor.features, float32_predictor.features, rtol=0.1, atol=0.1)
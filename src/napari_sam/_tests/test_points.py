@@ -0,0 +1,43 @@
+import numpy as np
+
+from napari_sam.points import PointRegistry
+
+
+def test_add_remove():
+    points = PointRegistry(3)
+    first = points.add([2, 10, 20], 1)
+    second = points.add([2, 10, 20], 3)
+    third = points.add([5, 1, 1], 1)
+    assert len(points) == 3 and first in points
+
+    coords, label = points.remove(second)
+    np.testing.assert_array_equal(coords, [2, 10, 20])
+    assert label == 3
+    assert second not in points
+    assert points.ids() == [first, third]
+    assert points.ids(2) == [first]
+
+
+def test_slice_queries():
+    points = PointRegistry(3)
+    ids = [points.add([index % 3, index, index], index) for index in range(9)]
+    assert points.ids(1) == [ids[1], ids[4], ids[7]]
+    coords, labels = points.get_points(2)
+    np.testing.assert_array_equal(coords[:, 0], 2)
+    np.testing.assert_array_equal(labels, [2, 5, 8])
+    for point_id in points.ids(0):
+        points.remove(point_id)
+    assert points.ids(0) == []
+    assert len(points.get_points(0)[0]) == 0
+
+
+def test_restore_keeps_id_and_grows():
+    points = PointRegistry(2)
+    ids = [points.add([index, index], 1) for index in range(40)]
+    assert ids == list(range(40))
+    coords, label = points.remove(7)
+    assert points.add(coords, label, 7) == 7
+    np.testing.assert_array_equal(points.get_coords(7), [7, 7])
+    assert points.get_label(39) == 1
+    np.testing.assert_array_equal(points.get_coords(39), [39, 39])
+    assert points.ids()[-1] == 7
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+from segment_anything import SamPredictor  # noqa: E402
+from napari_sam.decoder import ExportedDecoder  # noqa: E402
+from napari_sam.embedding import SliceEmbeddings  # noqa: E402
+from napari_sam.engine import predict_mask, set_image_size  # noqa: E402
+from napari_sam.propagation import get_box, propagate_mask  # noqa: E402
+
+SHAPE = (64, 64)
+
+
+def square_mask(size):
+    mask = np.zeros(SHAPE, dtype=bool)
+    start = (SHAPE[0] - size) // 2
+    mask[start:start + size, start:start + size] = True
+    return mask
+
+
+class ObjectDecoder:
+    """Stands in for ExportedDecoder and predicts the known mask of an object on the slice of the features."""
+    def __init__(self, masks):
+        self.masks = masks
+
+    def predict_batch(self, predictor, features, boxes=None, mask_input=None):
+        indices = [int(index) for index in features[:, 0, 0, 0]]
+        masks = np.stack([self.masks[index] for index in indices])[:, None]
+        logits = np.zeros((len(indices), 1, 256, 256), dtype=np.float32)
+        return masks, np.ones((len(indices), 1)), logits
+
+
+def create_embeddings(num_slices, encode):
+    features = np.zeros((num_slices, 256, 64, 64), dtype=np.float32)
+    valid = np.zeros(num_slices, dtype=bool)
+    return SliceEmbeddings(encode, lambda index: index, features, valid, "cpu", batch_size=4)
+
+
+def encode_index(indices):
+    return torch.stack([torch.full((256, 64, 64), float(index)) for index in indices])
+
+
+def run(decoder, predictor, embeddings, mask, slice_index, **kwargs):
+    results = []
+    for _, _, result in propagate_mask(decoder, predictor, embeddings, mask, slice_index, **kwargs):
+        results.extend(result or [])
+    return results
+
+
+@pytest.mark.parametrize("sizes, expected", [
+    ([20, 20, 0, 20, 20, 20, 20, 20, 20, 20], [3, 4, 6, 7, 8, 9]),  # Empty mask below
+    ([20, 20, 20, 5, 20, 20, 20, 20, 45, 20], [4, 6, 7]),  # Too small below, too large above
+    ([20, 20, 20, 20, 20, 20, 20, 20, 20, 20], [0, 1, 2, 3, 4, 6, 7, 8, 9]),  # Image border
+])
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_propagation_stops_where_the_object_vanishes(sizes, expected, batch_size):
+    masks = [square_mask(size) for size in sizes]
+    embeddings = create_embeddings(len(masks), encode_index)
+    results = run(ObjectDecoder(masks), None, embeddings, masks[5], 5, batch_size=batch_size)
+    assert sorted(index for index, _, _, _ in results) == expected
+    for index, mask, bbox, _ in results:
+        np.testing.assert_array_equal(mask, masks[index][bbox])
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_batched_propagation_matches_predict_mask(tiny_sam, batch_size):
+    def encode(indices):
+        return torch.stack([torch.randn(256, 64, 64, generator=torch.Generator().manual_seed(index)) for index in indices])
+    decoder = ExportedDecoder(tiny_sam, "torch")
+    predictor = SamPredictor(tiny_sam)
+    set_image_size(predictor, SHAPE)
+    embeddings = create_embeddings(8, encode)
+    mask, slice_index = square_mask(20), 4
+    results = run(decoder, predictor, embeddings, mask, slice_index, batch_size=batch_size, min_area_ratio=0, max_area_ratio=np.inf)
+    assert len(results) > 0
+
+    # Every slice is prompted with the box and logits of the last slice of the previous batch in its direction
+    accepted = {slice_index: (mask, None)}
+    for index, mask_crop, bbox, logits in sorted(results, key=lambda result: abs(result[0] - slice_index)):
+        distance = abs(index - slice_index)
+        prompt_index = slice_index + np.sign(index - slice_index) * batch_size * ((distance - 1) // batch_size)
+        prompt_mask, prompt_logits = accepted[prompt_index]
+        masks, _, expected_logits = predict_mask(predictor, embeddings[index], box=get_box(prompt_mask)[[1, 0, 3, 2]], mask_input=prompt_logits, decoder=decoder)
+        np.testing.assert_allclose(logits, expected_logits, atol=1e-4)
+        full_mask = np.zeros(SHAPE, dtype=bool)
+        full_mask[bbox] = mask_crop
+        assert np.count_nonzero(full_mask != masks[0]) <= 2
+        accepted[index] = (full_mask, logits)
@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from napari_sam.tasks import TaskQueue
+
+
+def sleep_and_return(duration, value):
+    time.sleep(duration)
+    return value
+
+
+def count(total, delay=0.01):
+    for index in range(total):
+        time.sleep(delay)
+        yield index + 1, total
+    return total
+
+
+def fail():
+    raise ValueError("task failed")
+
+
+def test_tasks_run_in_submission_order(qtbot):
+    queue = TaskQueue()
+    results = []
+    for index, duration in enumerate((0.2, 0.1, 0.0)):
+        queue.submit(sleep_and_return, duration, index, on_done=results.append)
+    queue.submit(None, on_done=lambda _: results.append("gui"))
+    queue.submit(sleep_and_return, 0, 3, on_done=results.append)
+    with qtbot.waitSignal(queue.idle, timeout=10000):
+        queue.wait()
+    assert results == [0, 1, 2, "gui", 3]
+    assert not queue.is_busy
+
+
+def test_progress_and_results_of_generators(qtbot):
+    queue = TaskQueue()
+    progress, results = [], []
+    queue.progress.connect(lambda done, total: progress.append((done, total)))
+    queue.submit(count, 3, on_done=results.append)
+    queue.wait()
+    assert progress == [(1, 3), (2, 3), (3, 3)]
+    assert results == [3]
+
+
+def test_cancel_drops_running_and_pending_tasks(qtbot):
+    queue = TaskQueue()
+    events = []
+    queue.submit(count, 1000, on_done=lambda result: events.append("done 0"), on_cancelled=lambda: events.append("cancelled 0"))
+    queue.submit(sleep_and_return, 0, 1, on_done=lambda result: events.append("done 1"), on_cancelled=lambda: events.append("cancelled 1"))
+    queue.submit(None, on_done=lambda _: events.append("done 2"), on_cancelled=lambda: events.append("cancelled 2"))
+    qtbot.waitUntil(lambda: queue._worker is not None)
+    queue.cancel()
+    queue.wait()
+    assert events == ["cancelled 2", "cancelled 1", "cancelled 0"]  # Rolled back in reverse order
+
+    # The queue keeps working after a cancellation
+    queue.submit(sleep_and_return, 0, 4, on_done=lambda result: events.append("done {}".format(result)))
+    queue.wait()
+    assert events[-1] == "done 4"
+
+
+def test_error_drops_queued_tasks(qtbot):
+    queue = TaskQueue()
+    events = []
+    queue.submit(sleep_and_return, 0, 0, on_done=lambda result: events.append("done 0"))
+    queue.submit(fail, on_done=lambda result: events.append("done 1"), on_cancelled=lambda: events.append("cancelled 1"))
+    queue.submit(sleep_and_return, 0, 2, on_done=lambda result: events.append("done 2"), on_cancelled=lambda: events.append("cancelled 2"))
+    with qtbot.capture_exceptions() as exceptions:
+        queue.wait()
+    assert len(exceptions) > 0 and all(isinstance(exception, ValueError) for _, exception, _ in exceptions)
+    assert events == ["done 0", "cancelled 2", "cancelled 1"]
+    assert not queue.is_busy
+
+
+@pytest.mark.parametrize("busy", [False, True])
+def test_cancel_emits_idle(qtbot, busy):
+    queue = TaskQueue()
+    if busy:
+        queue.submit(count, 1000)
+        qtbot.waitUntil(lambda: queue._worker is not None)
+    with qtbot.waitSignal(queue.idle, timeout=10000):
+        queue.cancel()
+    queue.wait()
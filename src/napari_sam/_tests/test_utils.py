@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from napari_sam.utils import ImagePreprocessor
+
+
+def normalize(x, source_limits, target_limits=(0, 255)):
+    """The normalization the widget used before ImagePreprocessor, followed by the clipping to uint8."""
+    if source_limits[0] == source_limits[1]:
+        return np.zeros(x.shape, dtype=np.uint8)
+    x_std = (x.astype(np.float64) - source_limits[0]) / (source_limits[1] - source_limits[0])
+    x_scaled = x_std * (target_limits[1] - target_limits[0]) + target_limits[0]
+    return np.clip(x_scaled, *target_limits).astype(np.uint8)
+
+
+@pytest.mark.parametrize("dtype, contrast_limits", [
+    (np.uint8, (0, 255)),
+    (np.uint8, (20, 200)),
+    (np.uint16, (100, 40000)),
+    (np.int16, (-1000, 3000)),
+    (np.int32, (-50000, 70000)),
+    (np.float32, (-0.5, 2.0)),
+    (np.float64, (0.1, 0.9)),
+    (np.float32, (1.0, 1.0)),
+])
+@pytest.mark.parametrize("rgb", [False, True])
+def test_image_preprocessor_matches_normalize(dtype, contrast_limits, rgb):
+    rng = np.random.default_rng(0)
+    shape = (50, 70, 4) if rgb else (50, 70)
+    if np.dtype(dtype).kind == "f":
+        image = rng.uniform(-1, 3, shape).astype(dtype)
+    else:
+        info = np.iinfo(dtype)
+        image = rng.integers(max(info.min, -100000), min(info.max, 100000), shape, endpoint=True).astype(dtype)
+    expected = normalize(image[..., :3] if rgb else np.stack((image,) * 3, axis=-1), contrast_limits)
+
+    result = ImagePreprocessor(dtype, contrast_limits, rgb)(image)
+    assert result.shape == expected.shape and result.dtype == np.uint8
+    difference = np.abs(result.astype(int) - expected)
+    assert difference.max() <= 1  # Float32 instead of float64 arithmetic may round differently
+    assert np.mean(difference == 0) > 0.99
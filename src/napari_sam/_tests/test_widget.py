@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+
+
+def create_image(shape, seed=0):
+    """Bright ellipse on a noisy background, so that clicks on it predict a non-empty mask."""
+    rng = np.random.default_rng(seed)
+    rows, columns = np.ogrid[:shape[-2], :shape[-1]]
+    ellipse = ((rows - shape[-2] / 2) / (shape[-2] / 4)) ** 2 + ((columns - shape[-1] / 2) / (shape[-1] / 3)) ** 2 <= 1
+    return (np.broadcast_to(ellipse, shape) + 0.1 * rng.random(shape)).astype(np.float32)
+
+
+def click(widget, coords, is_positive=1):
+    widget.do_click(np.asarray(coords), is_positive)
+    widget.tasks.wait()
+
+
+def undo(widget):
+    widget.on_undo(None)
+    widget.tasks.wait()
+
+
+def redo(widget):
+    widget.on_redo(None)
+    widget.tasks.wait()
+
+
+def test_zarr_labels_click_undo_refresh(make_sam_widget):
+    zarr = pytest.importorskip("zarr")
+    shape = (3, 96, 128)
+    labels = zarr.zeros(shape, chunks=(1, 32, 32), dtype=np.int32)
+    widget = make_sam_widget(create_image(shape), labels)
+    widget.viewer.dims.set_current_step(0, 1)
+    click(widget, (1, 48, 64))
+    written = labels[:]
+    assert written[1].any() and not written[[0, 2]].any()
+    np.testing.assert_array_equal(widget.label_layer._slice.image.raw, written[1])
+
+    undo(widget)
+    assert not labels[:].any()
+    assert not widget.label_layer._slice.image.raw.any()
+    redo(widget)
+    np.testing.assert_array_equal(labels[:], written)
+
+
+def test_refresh_labels_falls_back_to_full_refresh(make_sam_widget, monkeypatch):
+    widget = make_sam_widget(create_image((96, 128)))
+    refreshed = []
+
+    def partial_refresh():
+        raise AttributeError("_updated_slice")
+    monkeypatch.setattr(widget.label_layer, "_partial_labels_refresh", partial_refresh)
+    original_refresh = widget.label_layer.refresh
+    monkeypatch.setattr(widget.label_layer, "refresh", lambda *args, **kwargs: (refreshed.append(True), original_refresh(*args, **kwargs)))
+    click(widget, (48, 64))
+    assert refreshed
+    assert widget.label_layer.data.any()
+    np.testing.assert_array_equal(widget.label_layer._slice.image.raw, widget.label_layer.data)
+
+
+def get_candidate_labels(candidate, label, shape):
+    mask, bbox = candidate[:2]
+    labels = np.zeros(shape, dtype=np.int32)
+    if mask is not None:
+        labels[bbox][mask] = label
+    return labels
+
+
+def test_cycle_mask_candidates(make_sam_widget, monkeypatch):
+    import napari_sam._widget
+    shape = (96, 128)
+    widget = make_sam_widget(create_image(shape), multimask=True)
+    click(widget, (48, 64))
+    _, label, candidates, index = widget.mask_candidates
+    assert len(candidates) == 3 and index == 0
+    np.testing.assert_array_equal(widget.label_layer.data, get_candidate_labels(candidates[0], label, shape))
+
+    predictions, written = [], []
+    monkeypatch.setattr(widget, "predict", lambda *args, **kwargs: predictions.append(args))
+    write_values = napari_sam._widget.write_values
+    monkeypatch.setattr(napari_sam._widget, "write_values", lambda data, indices, values: (written.append(len(values)), write_values(data, indices, values))[1])
+    states = []
+    for step in (1, 1, 1, -1):
+        before = widget.label_layer.data.copy()
+        if step == 1:
+            widget.on_next_mask_candidate(None)
+        else:
+            widget.on_previous_mask_candidate(None)
+        widget.tasks.wait()
+        index = (index + step) % 3
+        expected = get_candidate_labels(candidates[index], label, shape)
+        np.testing.assert_array_equal(widget.label_layer.data, expected)
+        np.testing.assert_array_equal(widget.sam_logits, candidates[index][2])
+        assert written[-1] == np.count_nonzero(before != expected)  # Only the pixels that differ are written
+        states.append((expected, candidates[index][2]))
+    assert predictions == [] and max(written) > 0
+
+    # Undo and redo restore the labels and logits of every candidate change
+    for expected, logits in reversed(states[:-1]):
+        undo(widget)
+        np.testing.assert_array_equal(widget.label_layer.data, expected)
+        np.testing.assert_array_equal(widget.sam_logits, logits)
+    undo(widget)
+    np.testing.assert_array_equal(widget.label_layer.data, get_candidate_labels(candidates[0], label, shape))
+    np.testing.assert_array_equal(widget.sam_logits, candidates[0][2])
+    for expected, logits in states:
+        redo(widget)
+        np.testing.assert_array_equal(widget.label_layer.data, expected)
+        np.testing.assert_array_equal(widget.sam_logits, logits)
+
+
+def test_points_layer_follows_clicks(make_sam_widget):
+    widget = make_sam_widget(create_image((3, 96, 128)))
+    widget.label_layer.selected_label = 1
+    click(widget, (1, 48, 64))
+    widget.label_layer.selected_label = 2
+    click(widget, (1, 20, 30))
+    click(widget, (2, 48, 64), 0)
+    np.testing.assert_array_equal(widget.points_layer.data, [[1, 48, 64], [1, 20, 30], [2, 48, 64]])
+    expected_colors = [widget.get_point_color(label) for label in (1, 2, 0)]
+    np.testing.assert_allclose(widget.points_layer.face_color, expected_colors)
+
+    undo(widget)
+    np.testing.assert_array_equal(widget.points_layer.data, [[1, 48, 64], [1, 20, 30]])
+    redo(widget)
+    np.testing.assert_allclose(widget.points_layer.face_color, expected_colors)
+    assert widget.points_layer_ids == widget.points.ids()
+
+
+@pytest.mark.parametrize("shape", [(96, 128), (3, 96, 128)])
+def test_contrast_change_resets_logits(make_sam_widget, shape):
+    widget = make_sam_widget(create_image(shape))
+    click(widget, (1, 48, 64) if len(shape) == 3 else (48, 64))
+    assert widget.get_logits(1 if len(shape) == 3 else None) is not None
+    features, preprocessor = widget.sam_features, widget.image_preprocessor
+
+    widget.image_layer.contrast_limits = (0.2, 0.8)
+    widget.update_contrast_limits()
+    if len(shape) == 3:
+        assert widget.image_preprocessor is preprocessor  # Replaced only together with the embeddings
+    widget.tasks.wait()
+    assert widget.sam_features is not features
+    assert widget.image_preprocessor.contrast_limits == (0.2, 0.8)
+    assert widget.sam_logits == (None if len(shape) == 2 else [None] * shape[0])
+    click(widget, (1, 40, 64) if len(shape) == 3 else (40, 64))
+    assert widget.label_layer.data.any()
@@ -1,19 +1,21 @@
-from qtpy.QtWidgets import QVBoxLayout, QPushButton, QWidget, QLabel, QComboBox, QRadioButton, QGroupBox, QProgressBar, QApplication, QScrollArea
+from qtpy.QtWidgets import QVBoxLayout, QPushButton, QWidget, QLabel, QComboBox, QRadioButton, QGroupBox, QProgressBar, QScrollArea, QCheckBox
 from qtpy import QtCore
 from qtpy.QtCore import Qt
+from qtpy.QtGui import QFontDatabase
 import napari
 import numpy as np
 from enum import Enum
-from collections import deque, defaultdict
+from functools import partial
 import inspect
-from segment_anything import SamPredictor, sam_model_registry
-from segment_anything.automatic_mask_generator import SamAutomaticMaskGenerator
-from napari_sam.utils import get_weights_path, get_cached_weight_types, normalize
-import torch
+from napari_sam.utils import SAM_MODEL_TYPES, get_cached_weight_types, ImagePreprocessor, get_bbox, union_bbox
+from napari_sam.embedding_cache import EmbeddingCache
+from napari_sam.history import History, LabelDelta
+from napari_sam.labels import create_labels, write_values
+from napari_sam.points import PointRegistry
+from napari_sam.profiling import profiler
+from napari_sam.tasks import TaskQueue
 from vispy.util.keys import CONTROL
-import copy
 import warnings
-from tqdm import tqdm
 
 
 class AnnotatorMode(Enum):
@@ -36,7 +38,8 @@ class SamWidget(QWidget):
         self.annotator_mode = AnnotatorMode.NONE
         self.segmentation_mode = SegmentationMode.SEMANTIC
 
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # torch and segment_anything take seconds to import, so they are only imported once a model is loaded
+        self.device = None
 
         main_layout = QVBoxLayout()
 
@@ -84,6 +87,8 @@ class SamWidget(QWidget):
         self.rb_click.setToolTip("Positive Click: Middle Mouse Button\n \n"
                                  "Negative Click: Control + Middle Mouse Button \n \n"
                                  "Undo: Control + Z \n \n"
+                                 "Redo: Control + Shift + Z \n \n"
+                                 "Next/Previous Mask Candidate: Control + M / Control + Shift + M \n \n"
                                  "Select Point: Left Click \n \n"
                                  "Delete Selected Point: Delete")
         self.l_annotation.addWidget(self.rb_click)
@@ -136,12 +141,72 @@ class SamWidget(QWidget):
         self.g_segmentation.setLayout(self.l_segmentation)
         main_layout.addWidget(self.g_segmentation)
 
+        self.cb_lazy_embedding = QCheckBox("Embed 3D slices on demand")
+        self.cb_lazy_embedding.setChecked(True)
+        self.cb_lazy_embedding.setToolTip("Only the SAM image embedding of the clicked slice is computed \n"
+                                          "before a click is processed. \n \n"
+                                          "All other slices are embedded in the background, \n"
+                                          "starting with the slices closest to the current slice.")
+        main_layout.addWidget(self.cb_lazy_embedding)
+
+        self.cb_multimask = QCheckBox("Suggest alternative masks")
+        self.cb_multimask.setToolTip("SAM predicts three candidate masks for every click \n"
+                                     "and the one with the highest score is written. \n \n"
+                                     "Control + M and Control + Shift + M cycle through the \n"
+                                     "candidates of the last click without running SAM again.")
+        main_layout.addWidget(self.cb_multimask)
+
         self.btn_activate = QPushButton("Activate")
         self.btn_activate.clicked.connect(self._activate)
         self.btn_activate.setEnabled(False)
         self.is_active = False
         main_layout.addWidget(self.btn_activate)
 
+        self.btn_propagate = QPushButton("Propagate to neighboring slices")
+        self.btn_propagate.setToolTip("Segments the object of the current label on the current slice \n"
+                                      "in the slices above and below until it vanishes. \n \n"
+                                      "Only available for 3D images in click mode.")
+        self.btn_propagate.clicked.connect(self._propagate)
+        self.btn_propagate.setEnabled(False)
+        main_layout.addWidget(self.btn_propagate)
+
+        self.l_task = QLabel()
+        self.l_task.setVisible(False)
+        main_layout.addWidget(self.l_task)
+        self.pb_task = QProgressBar()
+        self.pb_task.setVisible(False)
+        main_layout.addWidget(self.pb_task)
+        self.btn_cancel_task = QPushButton("Cancel")
+        self.btn_cancel_task.setToolTip("Cancels the running computation.")
+        self.btn_cancel_task.clicked.connect(self._cancel_tasks)
+        self.btn_cancel_task.setVisible(False)
+        main_layout.addWidget(self.btn_cancel_task)
+
+        self.cb_profiling = QCheckBox("Show latency statistics")
+        self.cb_profiling.setToolTip("Records the duration of every stage of embedding, \n"
+                                     "clicks and Everything mode. \n \n"
+                                     "The recorded stages can be exported as Chrome trace \n"
+                                     "(chrome://tracing or Perfetto) or as JSON statistics.")
+        main_layout.addWidget(self.cb_profiling)
+        self.l_profiling = QLabel()
+        self.l_profiling.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.l_profiling.setVisible(False)
+        main_layout.addWidget(self.l_profiling)
+        self.btn_export_profiling = QPushButton("Export latencies")
+        self.btn_export_profiling.clicked.connect(self.export_profiling)
+        self.btn_export_profiling.setVisible(False)
+        main_layout.addWidget(self.btn_export_profiling)
+        self.profiling_timer = QtCore.QTimer(self)
+        self.profiling_timer.setInterval(1000)
+        self.profiling_timer.timeout.connect(self.update_profiling_stats)
+        self.cb_profiling.toggled.connect(self.on_profiling_toggled)
+        self.cb_profiling.setChecked(profiler.enabled)
+
+        self.tasks = TaskQueue(self)
+        self.tasks.started.connect(self._on_task_started)
+        self.tasks.progress.connect(self._on_task_progress)
+        self.tasks.idle.connect(self._on_tasks_idle)
+
         container_widget = QWidget()
         container_layout = QVBoxLayout(container_widget)
 
@@ -156,7 +221,7 @@ class SamWidget(QWidget):
         self.g_info_contrast = QGroupBox("Contrast Limits")
         self.l_info_contrast = QVBoxLayout()
         self.label_info_contrast = QLabel("SAM computes its image embedding based on the current image contrast.\n"
-                                          "Image contrast can be adjusted with the contrast slider of the image layer.")
+                                          "Image contrast can be adjusted with the contrast slider of the image layer, the embedding is updated once the slider rests.")
         self.label_info_contrast.setWordWrap(True)
         self.l_info_contrast.addWidget(self.label_info_contrast)
         self.g_info_contrast.setLayout(self.l_info_contrast)
@@ -167,6 +232,8 @@ class SamWidget(QWidget):
         self.label_info_click = QLabel("Positive Click: Middle Mouse Button\n \n"
                                  "Negative Click: Control + Middle Mouse Button\n \n"
                                  "Undo: Control + Z\n \n"
+                                 "Redo: Control + Shift + Z\n \n"
+                                 "Next/Previous Mask Candidate: Control + M / Control + Shift + M\n \n"
                                  "Select Point: Left Click\n \n"
                                  "Delete Selected Point: Delete\n \n")
         self.label_info_click.setWordWrap(True)
@@ -193,18 +260,35 @@ class SamWidget(QWidget):
         self.label_color_mapping = None
         self.points_layer = None
         self.points_layer_name = "Ignore this layer"  # "Ignore this layer <hidden>"
-        self.old_points = np.zeros(0)
+        self._is_updating_points_layer = False
+        self.points_layer_ids = []  # Point ID of every row of the points layer
         self.point_size = 10
 
         self.init_comboboxes()
 
         self.sam_model = None
+        self.sam_model_type = None
+        self.sam_model_precision = None
         self.sam_predictor = None
+        self.sam_decoder = None
+        self.sam_propagation_decoder = None  # Batched decoder used by propagate_slices
         self.sam_logits = None
         self.sam_features = None
-
-        self.points = defaultdict(list)
+        self.embedding_cache = EmbeddingCache()
+        self.embedding_batch_size = None  # Chosen from the available memory if None
+        self.image_preprocessor = None
+        self.requested_contrast_limits = None  # Contrast limits of the last requested embedding
+        self.image_scale = None  # Size of the image layer relative to the embedded pyramid level (height, width)
+        # Contrast changes are only applied once the contrast slider rests for contrast_delay ms
+        self.contrast_delay = 500
+        self.contrast_timer = QtCore.QTimer(self)
+        self.contrast_timer.setSingleShot(True)
+        self.contrast_timer.timeout.connect(self.update_contrast_limits)
+
+        self.points = None
         self.point_label = None
+        self.last_prediction = None  # (slice index, label) of the last prediction, whose logits are stored
+        self.mask_candidates = None  # (slice index, label, candidates, index of the written candidate) of the last prediction
 
         self.viewer.window.qt_viewer.layers.model().filterAcceptsRow = self._myfilter
 
@@ -219,18 +303,11 @@ class SamWidget(QWidget):
             self.rb_semantic.setStyleSheet("")
 
     def on_image_change(self):
-        image_name = self.cb_image_layers.currentText()
-        if image_name != "" and self.viewer.layers[image_name].ndim > 2:
-            self.rb_auto.setEnabled(False)
-            self.rb_auto.setChecked(False)
-            self.rb_click.setChecked(True)
-            self.rb_auto.setStyleSheet("color: gray")
-        else:
-            self.rb_auto.setEnabled(True)
-            self.rb_auto.setStyleSheet("")
+        self.rb_auto.setEnabled(True)
+        self.rb_auto.setStyleSheet("")
 
     def init_model_type_combobox(self):
-        model_types = list(sam_model_registry.keys())
+        model_types = list(SAM_MODEL_TYPES)
         cached_weight_types = get_cached_weight_types(model_types)
         entries = []
         for name, is_cached in cached_weight_types.items():
@@ -248,7 +325,7 @@ class SamWidget(QWidget):
         self.cb_model_type.currentTextChanged.connect(self.on_model_type_combobox_change)
 
     def on_model_type_combobox_change(self):
-        model_types = list(sam_model_registry.keys())
+        model_types = list(SAM_MODEL_TYPES)
         cached_weight_types = get_cached_weight_types(model_types)
 
         if cached_weight_types[list(cached_weight_types.keys())[self.cb_model_type.currentIndex()]]:
@@ -290,6 +367,8 @@ class SamWidget(QWidget):
         self._init_comboboxes_callback()
 
     def _on_layers_changed(self):
+        if self._is_updating_points_layer:  # The internal points layer is never listed in the comboboxes
+            return
         for combobox_dict in self.comboboxes:
             layer = combobox_dict["combobox"].currentText()
             layers = self.get_layer_names(combobox_dict["layer_type"])
@@ -324,15 +403,41 @@ class SamWidget(QWidget):
             self.btn_activate.setEnabled(False)
 
     def _load_model(self):
-        model_types = list(sam_model_registry.keys())
+        model_types = list(SAM_MODEL_TYPES)
         model_type = model_types[self.cb_model_type.currentIndex()]
-        self.sam_model = sam_model_registry[model_type](
-            get_weights_path(model_type)
-        )
-        self.sam_model.to(self.device)
+        self.btn_load_model.setEnabled(False)
+        self.btn_activate.setEnabled(False)
+        self.tasks.submit(self._build_model, model_type, description="Loading model",
+                          on_done=partial(self._on_model_loaded, model_type), on_cancelled=self._on_model_loading_cancelled)
+
+    def _build_model(self, model_type):
+        from napari_sam.engine import load_model
+        from napari_sam.models import get_precision
+        from napari_sam.decoder import ExportedDecoder, get_decoder
+        precision = get_precision()
+        sam_model = load_model(model_type, precision=precision)
+        decoder = get_decoder(sam_model)
+        propagation_decoder = decoder if decoder is not None else ExportedDecoder(sam_model, "torch")
+        return sam_model, precision, decoder, propagation_decoder
+
+    def _on_model_loaded(self, model_type, result):
+        from segment_anything import SamPredictor
+        from napari_sam.engine import create_mask_generator
+        sam_model, precision, decoder, propagation_decoder = result
+        self.sam_model = sam_model
+        self.sam_model_type = model_type
+        self.sam_model_precision = precision
+        self.device = str(sam_model.device)
         self.sam_predictor = SamPredictor(self.sam_model)
-        self.sam_anything_predictor = SamAutomaticMaskGenerator(self.sam_model)
+        self.sam_decoder = decoder
+        self.sam_propagation_decoder = propagation_decoder
+        self.sam_anything_predictor = create_mask_generator(self.sam_model)
         self.is_model_loaded = True
+        self.btn_load_model.setEnabled(True)
+        self._check_activate_btn()
+
+    def _on_model_loading_cancelled(self):
+        self.btn_load_model.setEnabled(True)
         self._check_activate_btn()
 
     def _activate(self):
@@ -344,6 +449,7 @@ class SamWidget(QWidget):
             self.cb_model_type.setEnabled(False)
             self.cb_image_layers.setEnabled(False)
             self.cb_label_layers.setEnabled(False)
+            self.cb_lazy_embedding.setEnabled(False)
             self.image_name = self.cb_image_layers.currentText()
             self.image_layer = self.viewer.layers[self.cb_image_layers.currentText()]
             self.label_layer = self.viewer.layers[self.cb_label_layers.currentText()]
@@ -392,57 +498,71 @@ class SamWidget(QWidget):
             if self.annotator_mode == AnnotatorMode.CLICK:
                 self.create_label_color_mapping()
 
-                with warnings.catch_warnings():
-                    warnings.filterwarnings("ignore", category=FutureWarning)
-                    self._history_limit = self.label_layer._history_limit
                 self._reset_history()
+                self.points = PointRegistry(self.image_layer.ndim)
 
-                if self.image_layer.ndim == 3:
-                    # self.image_layer.events.contrast_limits.connect(self.on_contrast_limits_change)
-                    # self.image_layer._qt_controls.contrast_limits_slider.slider.sliderReleased.connect(self.on_contrast_limits_change)
-                    # self.image_layer._qt_controls['contrast_limits'].slider.sliderReleased.connect(self.on_contrast_limits_change)
-                    pass
+                self.image_layer.events.contrast_limits.connect(self.on_contrast_limits_change)
 
                 self.set_image()
                 self.update_points_layer(None)
 
+                self.last_prediction = None
+                self.mask_candidates = None
+                self.btn_propagate.setEnabled(self.image_layer.ndim == 3)
                 self.viewer.mouse_drag_callbacks.append(self.callback_click)
                 self.viewer.keymap['Delete'] = self.on_delete
                 self.label_layer.keymap['Control-Z'] = self.on_undo
                 self.label_layer.keymap['Control-Shift-Z'] = self.on_redo
+                self.label_layer.keymap['Control-M'] = self.on_next_mask_candidate
+                self.label_layer.keymap['Control-Shift-M'] = self.on_previous_mask_candidate
 
             elif self.annotator_mode == AnnotatorMode.AUTO:
-                image = np.asarray(self.image_layer.data)
-                if not self.image_layer.rgb:
-                    image = np.stack((image,)*3, axis=-1)  # Expand to 3-channel image
-                image = image[..., :3]  # Remove a potential alpha channel
-                records = self.sam_anything_predictor.generate(image)
-                masks = np.asarray([record["segmentation"] for record in records])
-                prediction = np.argmax(masks, axis=0)
+                self.image_preprocessor = ImagePreprocessor(self.image_layer.data.dtype, self.image_layer.contrast_limits, self.image_layer.rgb)
+                image_shape = self.image_layer.data.shape[:-1] if self.image_layer.rgb else self.image_layer.data.shape
+                prediction = create_labels(image_shape, self.label_layer.data.dtype)
                 self.label_layer.data = prediction
+                from napari_sam.engine import segment_everything
+                from napari_sam.models import get_model
+                build_model = partial(get_model, self.sam_model_type, "cpu", self.sam_model_precision)
+                image = self.image_layer.data[0] if self.image_layer.multiscale else self.image_layer.data  # Full resolution
+                self.tasks.submit(segment_everything, self.sam_anything_predictor, image, prediction, self.image_preprocessor,
+                                  build_model=build_model, device=self.device, description="Segmenting everything",
+                                  on_yielded=self.refresh_labels)
         else:
             self._deactivate()
         self.btn_activate.setEnabled(True)
 
     def _deactivate(self):
         self.is_active = False
+        self.tasks.cancel()
+        self.contrast_timer.stop()
+        if self.image_layer is not None:
+            self.image_layer.events.contrast_limits.disconnect(self.on_contrast_limits_change)
         self.btn_activate.setText("Activate")
+        self.btn_propagate.setEnabled(False)
         self.btn_load_model.setEnabled(True)
         self.cb_model_type.setEnabled(True)
         self.cb_image_layers.setEnabled(True)
         self.cb_label_layers.setEnabled(True)
+        self.cb_lazy_embedding.setEnabled(True)
         self.remove_all_widget_callbacks(self.viewer)
+        self.viewer.dims.events.current_step.disconnect(self.on_dims_change)
+        if hasattr(self.sam_features, "prefetch"):  # SliceEmbeddings
+            self.sam_features.close()
+        self.sam_features = None
         if self.label_layer is not None:
             self.remove_all_widget_callbacks(self.label_layer)
         if self.points_layer is not None and self.points_layer in self.viewer.layers:
+            self._is_updating_points_layer = True
             self.viewer.layers.remove(self.points_layer)
+            self._is_updating_points_layer = False
         self.image_name = None
         self.image_layer = None
         self.label_layer = None
         self.label_layer_changes = None
         self.points_layer = None
         self.annotator_mode = AnnotatorMode.NONE
-        self.points = defaultdict(list)
+        self.points = None
         self.point_label = None
         self.sam_logits = None
         self.rb_click.setEnabled(True)
@@ -455,6 +575,47 @@ class SamWidget(QWidget):
         self.rb_instance.setStyleSheet("")
         self._reset_history()
 
+    def _on_task_started(self, description):
+        if description == "":
+            return
+        self.l_task.setText(description + ":")
+        self.pb_task.setRange(0, 0)  # Busy indicator until the task reports its progress
+        self.l_task.setVisible(True)
+        self.pb_task.setVisible(True)
+        self.btn_cancel_task.setVisible(True)
+
+    def _on_task_progress(self, done, total):
+        self.pb_task.setRange(0, total)
+        self.pb_task.setValue(done)
+
+    def _on_tasks_idle(self):
+        self.l_task.setVisible(False)
+        self.pb_task.setVisible(False)
+        self.btn_cancel_task.setVisible(False)
+
+    def _cancel_tasks(self):
+        self.tasks.cancel()
+
+    def on_profiling_toggled(self, checked):
+        profiler.enabled = checked
+        self.l_profiling.setVisible(checked)
+        self.btn_export_profiling.setVisible(checked)
+        if checked:
+            self.update_profiling_stats()
+            self.profiling_timer.start()
+        else:
+            self.profiling_timer.stop()
+
+    def update_profiling_stats(self):
+        self.l_profiling.setText(profiler.format_stats())
+
+    def export_profiling(self):
+        from qtpy.QtWidgets import QFileDialog
+        formats = {"Chrome trace (*.json)": "chrome", "Statistics (*.json)": "json"}
+        path, selected_filter = QFileDialog.getSaveFileName(self, "Export latencies", "napari-sam-trace.json", ";;".join(formats))
+        if path:
+            profiler.export(path, formats.get(selected_filter, "chrome"))
+
     def create_label_color_mapping(self, num_labels=1000):
         if self.label_layer is not None:
             self.label_color_mapping = {"label_mapping": {}, "color_mapping": {}}
@@ -488,258 +649,470 @@ class SamWidget(QWidget):
     def on_delete(self, layer):
         selected_points = list(self.points_layer.selected_data)
         if len(selected_points) > 0:
-            self.points_layer.data = np.delete(self.points_layer.data, selected_points[0], axis=0)
-            self.on_points_changed(None)
+            point_id = self.points_layer_ids[selected_points[0]]
+            self.remove_point_from_points_layer(point_id)
+            self.on_points_changed(point_id)
 
     def on_undo(self, layer):
-        """Undo the last paint or fill action since the view slice has changed."""
+        """Undo the last click or point deletion."""
         self.undo()
-        self.label_layer.undo()
-        self.label_layer.data = self.label_layer.data
 
     def on_redo(self, layer):
-        """Redo any previously undone actions."""
+        """Redo the last undone click or point deletion."""
         self.redo()
-        self.label_layer.redo()
-        self.label_layer.data = self.label_layer.data
+
+    def on_next_mask_candidate(self, layer):
+        """Replace the mask of the last click by its next candidate mask."""
+        self.tasks.submit(None, on_done=lambda _: self.cycle_mask_candidates(1))
+
+    def on_previous_mask_candidate(self, layer):
+        """Replace the mask of the last click by its previous candidate mask."""
+        self.tasks.submit(None, on_done=lambda _: self.cycle_mask_candidates(-1))
 
     def on_contrast_limits_change(self):
-        print("Contrast limit change")
-        self.set_image()
+        self.contrast_timer.start(self.contrast_delay)
 
-    def set_image(self):
+    def update_contrast_limits(self):
+        """Re-embed the image with the current contrast limits of the image layer.
+
+        2D images are embedded again. For 3D images the visible slice is embedded first and the remaining slices are
+        updated in the background, slices whose uint8 image is unchanged by the new contrast limits are copied from the
+        current embeddings.
+        """
+        if not self.is_active or self.image_preprocessor is None:
+            return
+        contrast_limits = tuple(float(limit) for limit in self.image_layer.contrast_limits)
+        if contrast_limits == self.requested_contrast_limits:
+            return
         if self.image_layer.ndim == 2:
-            image = np.asarray(self.image_layer.data)
-            if not self.image_layer.rgb:
-                image = np.stack((image,)*3, axis=-1)  # Expand to 3-channel image
-            image = image[..., :3]  # Remove a potential alpha channel
-            self.sam_predictor.set_image(image)
-            self.sam_features = self.sam_predictor.features
-        elif self.image_layer.ndim == 3:
-            l_creating_features= QLabel("Creating SAM image embedding:")
-            self.layout().addWidget(l_creating_features)
-            progress_bar = QProgressBar(self)
-            progress_bar.setMaximum(self.image_layer.data.shape[0])
-            progress_bar.setValue(0)
-            self.layout().addWidget(progress_bar)
-            self.sam_features = []
-            for index in tqdm(range(self.image_layer.data.shape[0]), desc="Creating SAM image embedding"):
-                image_slice = np.asarray(self.image_layer.data[index, ...])
-                if not self.image_layer.rgb:
-                    image_slice = np.stack((image_slice,) * 3, axis=-1)  # Expand to 3-channel image
-                image_slice = image_slice[..., :3]  # Remove a potential alpha channel
-                contrast_limits = self.image_layer.contrast_limits
-                image_slice = normalize(image_slice, source_limits=contrast_limits, target_limits=(0, 255)).astype(np.uint8)
-                self.sam_predictor.set_image(image_slice)
-                self.sam_features.append(self.sam_predictor.features)
-                progress_bar.setValue(index+1)
-                QApplication.processEvents()
-                progress_bar.deleteLater()
-                l_creating_features.deleteLater()
-        else:
+            self.set_image()
+            return
+        self.requested_contrast_limits = contrast_limits
+        # The preprocessor is only replaced together with the embeddings, clicks before decode the current embeddings
+        preprocess = ImagePreprocessor(self.image_layer.data.dtype, contrast_limits, self.image_layer.rgb)
+        self.tasks.submit(self.update_embeddings, self.get_image_data(), contrast_limits, preprocess, self.get_current_slice(),
+                          description="Updating SAM image embedding", on_done=partial(self._on_embeddings_updated, preprocess),
+                          on_cancelled=self._on_embeddings_cancelled)
+
+    def update_embeddings(self, image, contrast_limits, preprocess, slice_index):
+        """Open the embeddings of new contrast limits of a 3D image and compute slice_index. Runs as background task."""
+        from napari_sam.engine import open_embeddings
+        from napari_sam.models import get_model_id
+        model_id = get_model_id(self.sam_model_type, self.sam_model_precision)
+        embeddings = open_embeddings(self.sam_model, model_id, image, 3, preprocess, contrast_limits, self.embedding_cache,
+                                     self.device, self.embedding_batch_size, previous=self.sam_features)
+        embeddings.compute([slice_index])
+        return embeddings
+
+    def _on_embeddings_updated(self, preprocess, embeddings):
+        self.sam_features.close()
+        self.sam_features = embeddings
+        self.image_preprocessor = preprocess
+        self.reset_logits()
+        self.sam_features.prefetch(self.get_current_slice())
+        self.viewer.dims.events.current_step.connect(self.on_dims_change)
+
+    def on_dims_change(self):
+        if hasattr(self.sam_features, "prefetch"):
+            self.sam_features.prefetch(self.get_current_slice())
+
+    def get_current_slice(self):
+        index = int(np.round(self.image_layer.world_to_data(self.viewer.dims.point)[0]))
+        return int(np.clip(index, 0, self.image_layer.data.shape[0] - 1))
+
+    def get_image_data(self):
+        """Image data the embeddings are computed from.
+
+        For multiscale layers this is the smallest pyramid level that is still at least as large as SAM's input size.
+        """
+        if not self.image_layer.multiscale:
+            return self.image_layer.data
+        from napari_sam.engine import select_pyramid_level
+        levels = self.image_layer.data
+        level = select_pyramid_level([level_data.shape for level_data in levels], self.image_layer.rgb, self.image_layer.ndim,
+                                     self.sam_model.image_encoder.img_size)
+        return levels[level]
+
+    def set_image(self):
+        if self.image_layer.ndim != 2 and self.image_layer.ndim != 3:
             raise RuntimeError("Only 2D and 3D images are supported.")
 
-    def do_click(self, coords, is_positive):
-        self._save_history({"points": copy.deepcopy(self.points), "logits": self.sam_logits, "point_label": self.point_label})
+        from napari_sam.engine import get_image_size, set_image_size
+        if hasattr(self.sam_features, "prefetch"):
+            self.sam_features.close()
+        self.sam_features = None
 
+        self.image_preprocessor = ImagePreprocessor(self.image_layer.data.dtype, self.image_layer.contrast_limits, self.image_layer.rgb)
+        self.requested_contrast_limits = self.image_preprocessor.contrast_limits
+
+        # All slices share the same size, so the predictor state can be set without embedding an image. Multiscale
+        # layers are embedded and predicted at a smaller pyramid level, only the predicted masks are upscaled.
+        image_size = get_image_size(self.get_image_data(), self.image_layer.rgb)
+        set_image_size(self.sam_predictor, image_size)
+        full_size = get_image_size(self.image_layer.data[0] if self.image_layer.multiscale else self.image_layer.data, self.image_layer.rgb)
+        self.image_scale = np.asarray(full_size) / np.asarray(image_size)
+
+        lazy = self.image_layer.ndim == 3 and self.cb_lazy_embedding.isChecked()
+        self.tasks.submit(self.create_embeddings, self.get_image_data(), self.image_layer.ndim, self.image_layer.contrast_limits,
+                          self.image_preprocessor, lazy,
+                          description="Creating SAM image embedding", on_done=self._on_embeddings_created,
+                          on_cancelled=self._on_embeddings_cancelled)
+
+    def create_embeddings(self, image, ndim, contrast_limits, preprocess, lazy):
+        """Open the cached embedding of the image and compute the missing slices. Runs as background task.
+
+        2D images return their features. 3D images return a SliceEmbeddings object, whose slices are all computed
+        unless lazy is set.
+        """
+        from napari_sam.engine import open_embeddings
+        from napari_sam.models import get_model_id
+        with profiler.stage("create_embeddings"):
+            model_id = get_model_id(self.sam_model_type, self.sam_model_precision)
+            embeddings = open_embeddings(self.sam_model, model_id, image, ndim, preprocess, contrast_limits,
+                                         self.embedding_cache, self.device, self.embedding_batch_size)
+            num_slices, batch_size = len(embeddings), embeddings.batch_size
+
+            if ndim == 2:
+                yield 0, 1
+                features = embeddings[0]
+                embeddings.close()
+                return features
+            if not lazy:
+                yield embeddings.num_computed(), num_slices
+                for start in range(0, num_slices, batch_size):
+                    indices = range(start, min(start + batch_size, num_slices))
+                    embeddings.compute(indices)
+                    yield indices[-1] + 1, num_slices
+            return embeddings
+
+    def _on_embeddings_created(self, embeddings):
+        self.sam_features = embeddings
+        self.reset_logits()
+        if hasattr(embeddings, "prefetch") and self.cb_lazy_embedding.isChecked():
+            self.sam_features.prefetch(self.get_current_slice())
+            self.viewer.dims.events.current_step.connect(self.on_dims_change)
+
+    def reset_logits(self):
+        """Forget the logits and mask candidates of previous predictions, which belong to the previous embeddings."""
+        self.sam_logits = None if self.image_layer.ndim == 2 else [None] * self.image_layer.data.shape[0]
+        self.mask_candidates = None
+
+    def _on_embeddings_cancelled(self):
+        if self.is_active:
+            self._deactivate()
+
+    def do_click(self, coords, is_positive):
+        point_label_before = self.point_label
         self.point_label = self.label_layer.selected_label
         if not is_positive:
             self.point_label = 0
 
-        self.points[self.point_label].append(coords)
+        point_id = self.points.add(coords, self.point_label)
+        self.add_point_to_points_layer(point_id)
 
-        self.run(self.points, self.point_label)
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=FutureWarning)
-            self.label_layer._save_history((self.label_layer_changes["indices"], self.label_layer_changes["old_values"], self.label_layer_changes["new_values"]))
-
-    def run(self, points, point_label):
-        self.update_points_layer(points)
-
-        if points:
-            points_flattened = []
-            labels_flattended = []
-            for label, label_points in points.items():
-                points_flattened.extend(label_points)
-                label = int(label == point_label)
-                labels = [label] * len(label_points)
-                labels_flattended.extend(labels)
-
-            prediction, predicted_slices = self.predict(points_flattened, labels_flattended)
-        else:
-            prediction = np.zeros_like(self.label_layer.data)
-            predicted_slices = slice(None, None)
-
-        label_layer = np.asarray(self.label_layer.data)
-        changed_indices = np.where(prediction == 1)
-        index_labels_old = label_layer[changed_indices]
-        label_layer[predicted_slices][label_layer[predicted_slices] == point_label] = 0
-        if self.segmentation_mode == SegmentationMode.SEMANTIC or point_label == 0:
-            label_layer[prediction == 1] = point_label
+        slice_index = int(coords[0]) if self.image_layer.ndim == 3 else None
+        point = (point_id, coords, self.point_label, True)
+        self.run(self.points, self.point_label, slice_index, point, point_label_before)
+
+    def run(self, points, point_label, slice_index, point, point_label_before, use_logits=True):
+        """Predict the mask of point_label on the given slice (3D only) in the background and write it into the labels layer.
+
+        The prediction is queued after all running predictions, its result is written and saved to the history on the
+        GUI thread. If the prediction is cancelled, the added or removed point is restored.
+
+        Parameters
+        ----------
+        points : PointRegistry
+            Points of the session, the points of the slice are copied before the prediction is queued.
+        point_label : int
+            Label that is predicted.
+        slice_index : int
+            Slice of the prediction (3D) or None (2D).
+        point : tuple
+            (point_id, coords, label, added) of the added or removed point.
+        point_label_before : int
+            Active point label before the change.
+        use_logits : bool
+            Whether the logits of the previous prediction of the slice are passed to SAM.
+        """
+        slice_points, slice_labels = points.get_points(slice_index)
+        self.tasks.submit(self.predict_slice, slice_points, (slice_labels == point_label).astype(int), slice_index, use_logits,
+                          self.cb_multimask.isChecked(), on_done=partial(self.write_prediction, point_label, slice_index, point, point_label_before),
+                          on_cancelled=partial(self._on_prediction_cancelled, point, point_label_before))
+
+    def predict_slice(self, points, labels, slice_index, use_logits, multimask_output=False):
+        """Predict the mask, its bounding box and the logits of a slice. Runs as background task.
+
+        With multimask_output, all candidate masks are returned as well (see predict), otherwise candidates is None.
+        """
+        if len(points) == 0:
+            return None, None, None, None
+        mask_input = self.get_logits(slice_index) if use_logits else None
+        with profiler.stage("predict"):
+            if not multimask_output:
+                return self.predict(points, labels, slice_index, mask_input) + (None,)
+            candidates = self.predict(points, labels, slice_index, mask_input, multimask_output=True)
+            return candidates[0][:3] + (candidates,)
+
+    def write_prediction(self, point_label, slice_index, point, point_label_before, result):
+        """Write the mask of a prediction of point_label into the labels layer and save the change to the history.
+
+        Only the bounding box of the new mask and of the previous mask of point_label on this slice is compared and only
+        the changed pixels (or chunks of chunked labels, e.g. zarr) are written and refreshed, so the cost of a click does
+        not depend on the size of the volume.
+        """
+        prediction, prediction_bbox, logits, candidates = result
+        logits_before = self.get_logits(slice_index)
+        self.set_logits(slice_index, logits)
+        self.last_prediction = (slice_index, point_label)
+        self.mask_candidates = None if candidates is None else (slice_index, point_label, candidates, 0)
+        changed_indices, old_values, new_values = self.write_mask(point_label, slice_index, prediction, prediction_bbox)
+        self.label_layer_changes = {"indices": changed_indices, "old_values": old_values, "new_values": new_values}
+        with profiler.stage("history"):
+            self._save_history(point, (point_label_before, point_label), slice_index, logits_before)
+
+    def write_mask(self, point_label, slice_index, prediction, prediction_bbox):
+        """Replace the mask of point_label on a slice by prediction and return the changed (indices, old values, new values).
+
+        prediction is cropped to prediction_bbox (tuple of slices) or None for an empty mask.
+        """
+        with profiler.stage("write_labels"):
+            slice_prefix = (slice_index,) if self.image_layer.ndim == 3 else ()
+            label_slice = self.label_layer.data[slice_prefix]
+            bbox = union_bbox(get_bbox(label_slice == point_label), prediction_bbox)
+            region = None
+            if bbox is None:
+                old_values = new_values = np.zeros(0, dtype=label_slice.dtype)
+                changed_indices = tuple(np.zeros(0, dtype=int) for _ in range(self.label_layer.data.ndim))
+            else:
+                old_values = np.array(label_slice[bbox], copy=True)
+                new_values = old_values.copy()
+                new_values[new_values == point_label] = 0
+                if prediction is not None:
+                    mask = np.zeros(new_values.shape, dtype=bool)
+                    mask[tuple(slice(p.start - b.start, p.stop - b.start) for p, b in zip(prediction_bbox, bbox))] = prediction
+                    if self.segmentation_mode == SegmentationMode.SEMANTIC or point_label == 0:
+                        new_values[mask] = point_label
+                    else:
+                        new_values[mask & (new_values == 0)] = point_label
+                changed = np.nonzero(old_values != new_values)
+                old_values, new_values = old_values[changed], new_values[changed]
+                changed_indices = tuple(np.full(len(changed[0]), index) for index in slice_prefix)
+                changed_indices += tuple(axis_indices + b.start for axis_indices, b in zip(changed, bbox))
+                region = write_values(self.label_layer.data, changed_indices, new_values)
+        if region is not None:
+            self.refresh_labels(region)
+        return changed_indices, old_values, new_values
+
+    def cycle_mask_candidates(self, step=1):
+        """Replace the mask of the last click by the next (step=1) or previous (step=-1) of its candidate masks.
+
+        The candidates and their logits are cached by the prediction, so no inference is needed. Only the pixels in which
+        the candidates differ are written and the change is saved to the history.
+        """
+        if self.mask_candidates is None or self.last_prediction != self.mask_candidates[:2]:
+            return
+        slice_index, point_label, candidates, index = self.mask_candidates
+        index = (index + step) % len(candidates)
+        prediction, prediction_bbox, logits, _ = candidates[index]
+        logits_before = self.get_logits(slice_index)
+        self.set_logits(slice_index, logits)
+        self.mask_candidates = (slice_index, point_label, candidates, index)
+        changed_indices, old_values, new_values = self.write_mask(point_label, slice_index, prediction, prediction_bbox)
+        label_delta = LabelDelta(changed_indices, old_values, new_values) if len(old_values) > 0 else None
+        self.history.push(None, (self.point_label, self.point_label), slice_index, (logits_before, logits), label_delta)
+
+    def _propagate(self):
+        """Propagate the mask of the selected label on the current slice to the neighboring slices in the background."""
+        if not self.is_active or self.image_layer.ndim != 3:
+            return
+        self.tasks.submit(self.propagate_slices, self.label_layer.selected_label, self.get_current_slice(),
+                          description="Propagating mask", on_done=partial(self.write_propagation, self.label_layer.selected_label))
+
+    def propagate_slices(self, label, slice_index):
+        """Predict the masks of label on the neighboring slices of slice_index. Runs as background task.
+
+        The logits of the last prediction are used as prompt if it was a prediction of label on slice_index.
+        """
+        from napari_sam.engine import downscale_mask
+        from napari_sam.propagation import propagate_mask
+        mask = np.asarray(self.label_layer.data[slice_index]) == label
+        if not np.all(self.image_scale == 1):
+            mask = downscale_mask(mask, self.sam_predictor.original_size)
+        if label == 0 or not mask.any():
+            return []
+        logits = self.get_logits(slice_index) if self.last_prediction == (slice_index, label) else None
+        results = []
+        for done, total, result in propagate_mask(self.sam_propagation_decoder, self.sam_predictor, self.sam_features, mask, slice_index, logits):
+            if result is not None:
+                results.extend((index, *self.upscale_mask(prediction, bbox), index_logits) for index, prediction, bbox, index_logits in result)
+            yield done, total
+        return results
+
+    def write_propagation(self, label, results):
+        """Write propagated masks of label into the labels layer and save them as a single change to the history.
+
+        In instance mode only unlabeled pixels are written, so other objects are kept.
+        """
+        changed_indices, old_values, new_values = [], [], []
+        for slice_index, prediction, prediction_bbox, _ in results:
+            region = (slice_index,) + prediction_bbox
+            values = np.array(self.label_layer.data[region], copy=True)
+            if self.segmentation_mode == SegmentationMode.SEMANTIC:
+                changed = np.nonzero(prediction & (values != label))
+            else:
+                changed = np.nonzero(prediction & (values == 0))
+            indices = (np.full(len(changed[0]), slice_index),) + tuple(axis_indices + b.start for axis_indices, b in zip(changed, prediction_bbox))
+            changed_indices.append(np.stack(indices))
+            old_values.append(values[changed])
+            new_values.append(np.full(len(changed[0]), label, dtype=values.dtype))
+            region = write_values(self.label_layer.data, indices, label)
+            if region is not None:
+                self.refresh_labels(region)
+        if sum(len(values) for values in old_values) == 0:
+            return
+        label_delta = LabelDelta(np.concatenate(changed_indices, axis=1), np.concatenate(old_values), np.concatenate(new_values))
+        self.history.push(None, (self.point_label, self.point_label), None, (None, None), label_delta)
+
+    def _on_prediction_cancelled(self, point, point_label_before):
+        if not self.is_active:
+            return
+        point_id, coords, label, added = point
+        if added:
+            self.points.remove(point_id)
+            self.remove_point_from_points_layer(point_id)
         else:
-            label_layer[(prediction == 1) & (label_layer == 0)] = point_label
-        index_labels_new = label_layer[changed_indices]
-        self.label_layer_changes = {"indices": changed_indices, "old_values": index_labels_old, "new_values": index_labels_new}
-        self.label_layer.data = label_layer
-        self.old_points = copy.deepcopy(self.points_layer.data)
-        # self.label_layer.refresh()
-
-    def predict(self, points, labels):
-        points = np.asarray(points)
-        old_point, new_point = self.find_changed_point(np.asarray(self.old_points), points)
+            self.points.add(coords, label, point_id)
+            self.add_point_to_points_layer(point_id)
+        self.point_label = point_label_before
+
+    def refresh_labels(self, region):
+        """Refresh only the given region (tuple of slices) of the labels layer.
+
+        Uses the private partial refresh of napari if available and falls back to refreshing the whole layer otherwise.
+        """
+        with profiler.stage("refresh_labels"):
+            partial_refresh = getattr(self.label_layer, "_partial_labels_refresh", None)
+            if partial_refresh is not None:
+                try:
+                    self.label_layer._updated_slice = region
+                    partial_refresh()
+                    return
+                except (AttributeError, TypeError, ValueError, IndexError):  # The private API changed
+                    self.label_layer._updated_slice = None
+            self.label_layer.refresh()
+
+    def predict(self, points, labels, slice_index=None, mask_input=None, multimask_output=False):
+        """Predict a mask from the points of slice_index (3D) or the whole image (2D).
+
+        Returns the mask cropped to its bounding box together with the bounding box (tuple of slices) within the
+        slice, or (None, None) if the mask is empty, and the logits of the prediction. With multimask_output, the three
+        candidate masks of SAM are predicted in one decoder call and returned as list of (mask, bbox, logits, score),
+        ordered by their predicted score.
+        """
+        from napari_sam.engine import predict_mask
+        points = np.asarray(points, dtype=float)
+        points[:, -2:] = points[:, -2:] / self.image_scale  # Points of the pyramid level that is predicted
         if self.image_layer.ndim == 2:
-            self.sam_predictor.features = self.sam_features
-            prediction, _, self.sam_logits = self.sam_predictor.predict(
-                point_coords=np.flip(points, axis=-1),
-                point_labels=np.asarray(labels),
-                mask_input=self.sam_logits,
-                multimask_output=False,
-            )
-            prediction = prediction[0]
-            predicted_slices = None
+            prediction, scores, logits = predict_mask(self.sam_predictor, self.sam_features, points, labels, mask_input=mask_input,
+                                                      multimask_output=multimask_output, decoder=self.sam_decoder)
         elif self.image_layer.ndim == 3:
-            x_coords = np.unique(points[:, 0])
-            groups = {x_coord: list(points[points[:, 0] == x_coord]) for x_coord in x_coords}  # Group points if they are on the same image slice
-            x_coord = new_point[0]
-            prediction = np.zeros_like(self.label_layer.data)
-
-            group_points = groups[x_coord]
-            group_labels = [labels[np.argwhere(np.all(points == point, axis=1)).flatten()[0]] for point in group_points]
-            group_points = [point[1:] for point in group_points]
-            self.sam_predictor.features = self.sam_features[x_coord]
-            prediction_yz, _, self.sam_logits[x_coord] = self.sam_predictor.predict(
-                point_coords=np.flip(group_points, axis=-1),
-                point_labels=np.asarray(group_labels),
-                mask_input=self.sam_logits[x_coord],
-                multimask_output=False,
-            )
-            prediction_yz = prediction_yz[0]
-            prediction[x_coord, :, :] = prediction_yz
-            predicted_slices = x_coord
-        # elif self.image_layer.ndim == 3:
-        #     z_coords = np.unique(points[:, 2])
-        #     groups = {x_coord: list(points[points[:, 2] == x_coord]) for x_coord in z_coords}  # Group points if they are on the same image slice
-        #     image_point_proposals, image_label_proposals = [], []
-        #
-        #     for x_coord, group_points in groups.items():
-        #         group_labels = [labels[np.argwhere(np.all(points == point, axis=1)).flatten()[0]] for point in group_points]
-        #         group_points = [point[:2] for point in group_points]
-        #         self.sam_predictor.features = self.sam_features[x_coord - 1]
-        #         prediction_yz, _, _ = self.sam_predictor.predict(
-        #             point_coords=np.flip(group_points, axis=-1),
-        #             point_labels=np.asarray(group_labels),
-        #             mask_input=self.sam_logits,
-        #             multimask_output=False,
-        #         )
-        #         prediction_yz = prediction_yz[0]
-        #
-        #         for i, point in enumerate(group_points):
-        #             y_coord = point[1]
-        #             prediction_x = prediction_yz[:, y_coord]
-        #             point_proposals_x = np.asarray(list(zip(*np.where(prediction_x)))).flatten()
-        #             point_proposals = [(point_proposal_x, y_coord, x_coord) for point_proposal_x in point_proposals_x]
-        #             image_point_proposals.extend(point_proposals)
-        #             image_label_proposals.extend([group_labels[i]] * len(point_proposals))
-        #
-        #     image_point_proposals = np.asarray(image_point_proposals)
-        #     image_label_proposals = np.asarray(image_label_proposals)
-        #     z_coords = np.unique(image_point_proposals[:, 0])
-        #     groups = {x_coord: list(image_point_proposals[image_point_proposals[:, 0] == x_coord]) for x_coord in z_coords}  # Group points if they are on the same image slice
-        #
-        #     prediction = np.zeros_like(self.label_layer.data)
-        #     for x_coord, group_points in groups.items():
-        #         group_labels = [image_label_proposals[np.argwhere(np.all(image_point_proposals == point, axis=1)).flatten()[0]] for point in group_points]
-        #         group_points = [point[1:] for point in group_points]
-        #         self.sam_predictor.features = self.sam_features[x_coord - 1]
-        #         prediction_yz, _, _ = self.sam_predictor.predict(
-        #             point_coords=np.flip(group_points, axis=-1),
-        #             point_labels=np.asarray(group_labels),
-        #             mask_input=self.sam_logits,
-        #             multimask_output=False,
-        #         )
-        #         prediction_yz = prediction_yz[0]
-        #         prediction[x_coord, :, :] = prediction_yz  # prediction_yz is 2D
-        #     print("")
-        #     sam_logits = None  # TODO: Use sam_logits
+            x_coord = slice_index
+            group_points = points[:, 1:]  # All points are on the same image slice
+            group_labels = labels
+            prediction, scores, logits = predict_mask(self.sam_predictor, self.sam_features[x_coord], group_points, group_labels, mask_input=mask_input,
+                                                      multimask_output=multimask_output, decoder=self.sam_decoder)
         else:
             raise RuntimeError("Only 2D and 3D images are supported.")
-        return prediction, predicted_slices
+        candidates = []
+        for index in np.argsort(-scores, kind="stable"):
+            bbox = get_bbox(prediction[index])
+            mask = None if bbox is None else prediction[index][bbox]
+            if mask is not None:
+                mask, bbox = self.upscale_mask(mask, bbox)
+            candidates.append((mask, bbox, logits[index:index + 1], float(scores[index])))
+        if multimask_output:
+            return candidates
+        return candidates[0][:3]
+
+    def upscale_mask(self, mask, bbox):
+        """Upscale a mask cropped to bbox from the predicted pyramid level to the full resolution of the labels layer."""
+        if np.all(self.image_scale == 1):
+            return mask, bbox
+        from napari_sam.engine import upscale_mask
+        return upscale_mask(mask, bbox, self.image_scale, self.label_layer.data.shape[-2:])
 
     def update_points_layer(self, points):
+        """Synchronize the points layer with points. The points layer is only created once and updated in place afterwards."""
+        with profiler.stage("update_points_layer"):
+            if self.points_layer is None or self.points_layer not in self.viewer.layers:
+                self.create_points_layer()
+            self.points_layer_ids = [] if points is None else points.ids()
+            coords = np.asarray([points.get_coords(point_id) for point_id in self.points_layer_ids]).reshape(-1, self.image_layer.ndim)
+            colors = np.asarray([self.get_point_color(points.get_label(point_id)) for point_id in self.points_layer_ids]).reshape(-1, 4)
+            self.points_layer.selected_data = set()
+            self.points_layer.data = coords
+            if len(colors) > 0:
+                self.points_layer.face_color = colors
+            self.points_layer.refresh()
+
+    def get_point_color(self, label):
+        color = self.label_color_mapping["label_mapping"][label]
+        if color is None:  # Background label
+            return np.ones(4)
+        return color
+
+    def create_points_layer(self):
         selected_layer = None
         if self.viewer.layers.selection.active != self.points_layer:
             selected_layer = self.viewer.layers.selection.active
-        if self.points_layer is not None:
-            self.viewer.layers.remove(self.points_layer)
-
-        points_flattened = []
-        colors_flattended = []
-        if points is not None:
-            for label, label_points in points.items():
-                points_flattened.extend(label_points)
-                color = self.label_color_mapping["label_mapping"][label]
-                colors = [color] * len(label_points)
-                colors_flattended.extend(colors)
 
         self.point_size = int(np.min(self.image_layer.data.shape[:2]) / 100)
         if self.point_size == 0:
             self.point_size = 1
+        self._is_updating_points_layer = True
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore", category=UserWarning)
-            self.points_layer = self.viewer.add_points(name=self.points_layer_name, data=np.asarray(points_flattened), face_color=colors_flattended, edge_color="white", size=self.point_size)
+            self.points_layer = self.viewer.add_points(name=self.points_layer_name, data=np.zeros((0, self.image_layer.ndim)), ndim=self.image_layer.ndim, edge_color="white", size=self.point_size)
+        self._is_updating_points_layer = False
         self.points_layer.editable = False
+        self.points_layer_ids = []
 
         if selected_layer is not None:
             self.viewer.layers.selection.active = selected_layer
-        self.points_layer.refresh()
-
-    def on_points_changed(self, event):
-        self._save_history({"points": copy.deepcopy(self.points), "logits": self.sam_logits, "point_label": self.point_label})
-        old_point, new_point = self.find_changed_point(self.old_points, self.points_layer.data)
-        label = self.find_point_label(old_point)
-        index_to_remove = np.where((self.points[label] == old_point).all(axis=1))[0]
-        self.points[label] = np.delete(self.points[label], index_to_remove, axis=0).tolist()
-        if len(self.points[label]) == 0:
-            del self.points[label]
-        if new_point is not None:
-            self.points[label].append(new_point)
-        self.point_label = label
-        self.sam_logits = None
-        self.run(self.points, self.point_label)
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=FutureWarning)
-            self.label_layer._save_history((self.label_layer_changes["indices"], self.label_layer_changes["old_values"], self.label_layer_changes["new_values"]))
 
-    def find_changed_point(self, old_points, new_points):
-        if len(new_points) == 0:
-            old_point = old_points
-        else:
-            old_point = np.array([x for x in old_points if not np.any((x == new_points).all(1))])
-        if len(old_points) == 0:
-            new_point = new_points
-        else:
-            new_point = np.array([x for x in new_points if not np.any((x == old_points).all(1))])
+    def add_point_to_points_layer(self, point_id):
+        with profiler.stage("update_points_layer"):
+            # The current face color is only applied to the added point, the colors of all other points are kept
+            self.points_layer.selected_data = set()
+            self.points_layer.current_face_color = self.get_point_color(self.points.get_label(point_id))
+            self.points_layer.add(self.points.get_coords(point_id))
+            self.points_layer_ids.append(point_id)
+
+    def remove_point_from_points_layer(self, point_id):
+        with profiler.stage("update_points_layer"):
+            index = self.points_layer_ids.index(point_id)
+            del self.points_layer_ids[index]
+            self.points_layer.selected_data = {index}
+            self.points_layer.remove_selected()
+
+    def on_points_changed(self, point_id):
+        """Remove the point point_id, which has already been removed from the points layer, and update its slice."""
+        point_label_before = self.point_label
+        coords, label = self.points.remove(point_id)
+        self.point_label = label
+        slice_index = int(coords[0]) if self.image_layer.ndim == 3 else None
+        point = (point_id, coords, label, False)
+        self.run(self.points, self.point_label, slice_index, point, point_label_before, use_logits=False)
 
-        # if (len(old_point) != 0 and len(old_point) != 1) or (len(new_point) != 0 and len(new_point) != 1):
-        #     raise RuntimeError("Could not identify a changed point.")
+    def get_logits(self, slice_index):
+        return self.sam_logits if slice_index is None else self.sam_logits[slice_index]
 
-        if len(old_point) == 0:
-            old_point = None
+    def set_logits(self, slice_index, logits):
+        if slice_index is None:
+            self.sam_logits = logits
         else:
-            old_point = old_point[0]
-
-        if len(new_point) == 0:
-            new_point = None
-        else:
-            new_point = new_point[0]
-
-        return old_point, new_point
-
-    def find_point_label(self, point):
-        for label, label_points in self.points.items():
-            if np.in1d(point, label_points).all(axis=0):
-                return label
-        raise RuntimeError("Could not identify label.")
+            self.sam_logits[slice_index] = logits
 
     def remove_all_widget_callbacks(self, layer):
         callback_types = ['mouse_double_click_callbacks', 'mouse_drag_callbacks', 'mouse_move_callbacks',
@@ -758,71 +1131,63 @@ class SamWidget(QWidget):
                 raise RuntimeError("Could not determine callbacks type.")
 
     def _reset_history(self, event=None):
-        self._undo_history = deque()
-        self._redo_history = deque()
-
-    def _save_history(self, history_item):
-        """Save a history "atom" to the undo history.
+        self.history = History()
 
-        A history "atom" is a single change operation to the array. A history
-        *item* is a collection of atoms that were applied together to make a
-        single change. For example, when dragging and painting, at each mouse
-        callback we create a history "atom", but we save all those atoms in
-        a single history item, since we would want to undo one drag in one
-        undo operation.
+    def _save_history(self, point, point_label, slice_index, logits_before):
+        """Save the last click or point deletion to the undo history.
 
         Parameters
         ----------
-        history_item : 2-tuple of region prop dicts
+        point : tuple
+            (point_id, coords, label, added) of the added or removed point.
+        point_label : tuple
+            Active point label before and after the change.
+        slice_index : int
+            Slice of the prediction (3D) or None (2D).
+        logits_before : np.ndarray
+            Logits of the slice before the change.
         """
-        self._redo_history = deque()
-        # if not self._block_saving:
-        #     self._undo_history.append([value])
-        # else:
-        #     self._undo_history[-1].append(value)
-        self._undo_history.append(history_item)
+        label_delta = None
+        if len(self.label_layer_changes["old_values"]) > 0:
+            label_delta = LabelDelta(self.label_layer_changes["indices"], self.label_layer_changes["old_values"], self.label_layer_changes["new_values"])
+        self.history.push(point, point_label, slice_index, (logits_before, self.get_logits(slice_index)), label_delta)
 
-    def _load_history(self, before, after, undoing=True):
-        """Load a history item and apply it to the array.
+    def _load_history(self, history_item, undoing=True):
+        """Apply the state before (undoing) or after (redoing) a history item.
 
         Parameters
         ----------
-        before : list of history items
-            The list of elements from which we want to load.
-        after : list of history items
-            The list of element to which to append the loaded element. In the
-            case of an undo operation, this is the redo queue, and vice versa.
+        history_item : HistoryItem
+            The item that is undone or redone.
         undoing : bool
-            Whether we are undoing (default) or redoing. In the case of
-            redoing, we apply the "after change" element of a history element
-            (the third element of the history "atom").
-
-        See Also
-        --------
-        Labels._save_history
+            Whether we are undoing (default) or redoing.
         """
-        if len(before) == 0:
+        if history_item is None:
             return
 
-        history_item = before.pop()
-        after.append(history_item)
-
-        self.points = history_item["points"]
-        self.point_label = history_item["point_label"]
-        self.sam_logits = history_item["logits"]
-        # self.run(history_item["points"], history_item["point_label"])
-        self.update_points_layer(self.points)
+        self.last_prediction = None
+        self.mask_candidates = None
+        if history_item.point is not None:  # Propagated masks and mask candidates do not change points
+            point_id, coords, label, added = history_item.point
+            if added == undoing:
+                self.points.remove(point_id)
+                self.remove_point_from_points_layer(point_id)
+            else:
+                self.points.add(coords, label, point_id)
+                self.add_point_to_points_layer(point_id)
+            self.point_label = history_item.point_label[0 if undoing else 1]
+        if history_item.point is not None or history_item.logits != (None, None):  # Propagated masks do not change logits
+            self.set_logits(history_item.logits_index, self.history.get_logits(history_item.logits[0 if undoing else 1]))
+        if history_item.label_delta is not None:
+            region = history_item.label_delta.apply(self.label_layer.data, undoing)
+            self.refresh_labels(region)
 
     def undo(self):
-        self._load_history(
-            self._undo_history, self._redo_history, undoing=True
-        )
+        # Queued after running predictions, so that their results are undone and not the ones before
+        self.tasks.submit(None, on_done=lambda _: self._load_history(self.history.undo(), undoing=True))
 
     def redo(self):
-        self._load_history(
-            self._redo_history, self._undo_history, undoing=False
-        )
-        raise RuntimeError("Redo currently not supported.")
+        self.tasks.submit(None, on_done=lambda _: self._load_history(self.history.redo(), undoing=False))
 
     def _myfilter(self, row, parent):
         return "<hidden>" not in self.viewer.layers[row].name
\ No newline at end of file
@@ -0,0 +1,116 @@
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import numpy as np
+import torch
+from tqdm import tqdm
+from segment_anything import sam_model_registry
+from napari_sam.utils import ImagePreprocessor
+from napari_sam.engine import load_model, create_mask_generator, get_default_device, segment_everything
+from napari_sam.everything import MIN_THREADS_PER_WORKER
+from napari_sam.models import PRECISIONS
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".npy")
+
+_generator = None
+
+
+def read_image(path):
+    """Read an image, .npy files are memory-mapped so that large volumes are only read slice by slice."""
+    if path.suffix.lower() == ".npy":
+        return np.load(path, mmap_mode="r")
+    import imageio.v3 as iio
+    return iio.imread(path)
+
+
+def is_rgb(image, volume=False):
+    return not volume and image.ndim == 3 and image.shape[-1] in (3, 4)
+
+
+def get_contrast_limits(image):
+    if image.dtype == np.uint8:
+        return 0, 255
+    if image.ndim > 2:  # Avoid reading large (memory-mapped) volumes at once
+        limits = [(np.min(image[index]), np.max(image[index])) for index in range(image.shape[0])]
+        return float(min(limit[0] for limit in limits)), float(max(limit[1] for limit in limits))
+    return float(np.min(image)), float(np.max(image))
+
+
+def segment_file(input_path, output_path, generator, volume=False):
+    """Segment all objects of an image file and write the labels to a .npy file.
+
+    The labels are streamed into a memory-mapped temporary file slice by slice (3D) or tile by tile (large 2D images),
+    which is renamed to output_path once it is complete.
+    """
+    image = read_image(input_path)
+    rgb = is_rgb(image, volume)
+    preprocess = ImagePreprocessor(image.dtype, get_contrast_limits(image), rgb)
+    labels_shape = image.shape[:-1] if rgb else image.shape
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    labels = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.int32, shape=labels_shape)
+    for _ in segment_everything(generator, image, labels, preprocess):
+        pass
+    labels.flush()
+    del labels
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def _init_worker(model_type, device, precision, num_threads):
+    global _generator
+    torch.set_num_threads(num_threads)
+    _generator = create_mask_generator(load_model(model_type, device, precision))
+
+
+def _segment_file(input_path, output_path, volume):
+    return segment_file(input_path, output_path, _generator, volume)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Segment all objects of every image in a directory with SAM's Everything mode.")
+    parser.add_argument("input", type=Path, help="Directory with the input images ({}).".format(", ".join(IMAGE_EXTENSIONS)))
+    parser.add_argument("output", type=Path, help="Directory the labels are written to as <image name>.npy.")
+    parser.add_argument("-m", "--model-type", default="vit_h", choices=list(sam_model_registry.keys()), help="SAM model type (default: vit_h).")
+    parser.add_argument("-d", "--device", default=None, help="Device the model runs on (default: cuda if available, otherwise cpu).")
+    parser.add_argument("-p", "--precision", default=None, choices=list(PRECISIONS.keys()),
+                        help="Precision of the model weights, reduced precisions halve the memory of every worker (default: float32).")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Number of worker processes, each loads its own model (default: one per {} CPU cores, 0 on GPU).".format(MIN_THREADS_PER_WORKER))
+    parser.add_argument("--volume", action="store_true", help="Treat 3D images with 3 or 4 channels in the last axis as volumes instead of RGB images.")
+    parser.add_argument("--overwrite", action="store_true", help="Segment images whose labels already exist again.")
+    args = parser.parse_args(argv)
+
+    device = args.device if args.device is not None else get_default_device()
+    num_workers = args.workers
+    if num_workers is None:
+        num_workers = 0 if device != "cpu" else (os.cpu_count() or 1) // MIN_THREADS_PER_WORKER
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    jobs = []
+    for input_path in sorted(args.input.iterdir()):
+        output_path = args.output / (input_path.stem + ".npy")
+        if input_path.suffix.lower() in IMAGE_EXTENSIONS and (args.overwrite or not output_path.exists()):
+            jobs.append((input_path, output_path))
+    if len(jobs) == 0:
+        print("No images to segment in {}.".format(args.input))
+        return
+
+    num_workers = min(num_workers, len(jobs))
+    if num_workers <= 1:
+        generator = create_mask_generator(load_model(args.model_type, device, args.precision))
+        for input_path, output_path in tqdm(jobs, desc="Segmenting images"):
+            segment_file(input_path, output_path, generator, args.volume)
+        return
+
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(args.model_type, device, args.precision, num_threads)) as executor:
+        futures = [executor.submit(_segment_file, input_path, output_path, args.volume) for input_path, output_path in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Segmenting images"):
+            future.result()
+
+
+if __name__ == "__main__":
+    main()
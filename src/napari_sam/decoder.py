@@ -0,0 +1,259 @@
+import io
+import os
+import warnings
+import numpy as np
+import torch
+from torch import nn
+
+DECODER_BACKENDS = ("torch", "torchscript", "onnx")
+# Backend of the prompt encoder and mask decoder, can be overwritten with the NAPARI_SAM_DECODER environment variable
+DEFAULT_DECODER_BACKEND = "torch"
+
+
+def predict_masks(mask_decoder, image_embeddings, image_pe, sparse_prompt_embeddings, dense_prompt_embeddings):
+    """Same as MaskDecoder.predict_masks, but the i-th prompt is decoded with the i-th image embedding.
+
+    MaskDecoder.predict_masks decodes all prompts with a single image embedding, this allows to decode prompts of many
+    slices in one batch. For a single image both are identical.
+    """
+    output_tokens = torch.cat([mask_decoder.iou_token.weight, mask_decoder.mask_tokens.weight], dim=0)
+    output_tokens = output_tokens.unsqueeze(0).expand(sparse_prompt_embeddings.size(0), -1, -1)
+    tokens = torch.cat((output_tokens, sparse_prompt_embeddings), dim=1)
+
+    src = image_embeddings + dense_prompt_embeddings
+    pos_src = image_pe.expand(src.shape[0], -1, -1, -1)
+    b, c, h, w = src.shape
+
+    hs, src = mask_decoder.transformer(src, pos_src, tokens)
+    iou_token_out = hs[:, 0, :]
+    mask_tokens_out = hs[:, 1:(1 + mask_decoder.num_mask_tokens), :]
+
+    src = src.transpose(1, 2).view(b, c, h, w)
+    upscaled_embedding = mask_decoder.output_upscaling(src)
+    hyper_in = torch.stack([mlp(mask_tokens_out[:, i, :]) for i, mlp in enumerate(mask_decoder.output_hypernetworks_mlps)], dim=1)
+    b, c, h, w = upscaled_embedding.shape
+    masks = (hyper_in @ upscaled_embedding.view(b, c, h * w)).view(b, -1, h, w)
+    return masks, mask_decoder.iou_prediction_head(iou_token_out)
+
+
+class PromptMaskDecoder(nn.Module):
+    """Prompt encoder and mask decoder of SAM as a single traceable module.
+
+    Computes the same low resolution logits and IoU predictions as Sam.prompt_encoder followed by Sam.mask_decoder, but
+    without data-dependent control flow: points always include their padding point or box corners, and the mask prompt
+    is selected with has_mask_input instead of an if. The dense positional encoding is computed once. Batches of
+    prompts are decoded with a batch of image embeddings of the same size, e.g. of different slices.
+    """
+    def __init__(self, sam_model):
+        super().__init__()
+        self.prompt_encoder = sam_model.prompt_encoder
+        self.mask_decoder = sam_model.mask_decoder
+        self.img_size = float(sam_model.image_encoder.img_size)
+        self.dtype = next(sam_model.mask_decoder.parameters()).dtype
+        self.register_buffer("image_pe", sam_model.prompt_encoder.get_dense_pe().detach().clone(), False)
+
+    def _embed_points(self, point_coords, point_labels):
+        point_embedding = self.prompt_encoder.pe_layer._pe_encoding((point_coords + 0.5) / self.img_size)
+        point_labels = point_labels.unsqueeze(-1).expand_as(point_embedding)
+        point_embedding = point_embedding * (point_labels != -1)
+        point_embedding = point_embedding + self.prompt_encoder.not_a_point_embed.weight * (point_labels == -1)
+        for i in range(self.prompt_encoder.num_point_embeddings):
+            point_embedding = point_embedding + self.prompt_encoder.point_embeddings[i].weight * (point_labels == i)
+        return point_embedding
+
+    def _embed_masks(self, mask_input, has_mask_input):
+        mask_embedding = has_mask_input * self.prompt_encoder.mask_downscaling(mask_input)
+        return mask_embedding + (1 - has_mask_input) * self.prompt_encoder.no_mask_embed.weight.reshape(1, -1, 1, 1)
+
+    def forward(self, image_embeddings, point_coords, point_labels, mask_input, has_mask_input):
+        sparse_embedding = self._embed_points(point_coords, point_labels)
+        dense_embedding = self._embed_masks(mask_input, has_mask_input)
+        masks, scores = predict_masks(
+            self.mask_decoder,
+            image_embeddings=image_embeddings.to(self.dtype),
+            image_pe=self.image_pe.to(self.dtype),
+            sparse_prompt_embeddings=sparse_embedding.to(self.dtype),
+            dense_prompt_embeddings=dense_embedding.to(self.dtype),
+        )
+        return masks.float(), scores.float()
+
+
+class ExportedDecoder:
+    """Prompt encoder and mask decoder of a SAM model exported with TorchScript or ONNX.
+
+    Replaces SamPredictor.predict for features that have been computed before, e.g. by open_embeddings. Avoids the
+    eager PyTorch overhead of the small decoder, which dominates the latency of a click on the CPU. predict_batch()
+    decodes the prompts of many slices at once.
+
+    Parameters
+    ----------
+    sam_model : Sam
+        The SAM model.
+    backend : str
+        "torchscript" or "onnx". ONNX requires the onnx and onnxruntime packages and runs on the CPU only. "torch" runs
+        PromptMaskDecoder without exporting it, which still allows to decode batches of slices.
+    """
+    def __init__(self, sam_model, backend="torchscript"):
+        self.sam_model = sam_model
+        self.backend = backend
+        self.device = sam_model.device
+        module = PromptMaskDecoder(sam_model).eval()
+        example_inputs = self._get_inputs(
+            torch.zeros(1, sam_model.prompt_encoder.embed_dim, *sam_model.prompt_encoder.image_embedding_size, device=self.device),
+            np.zeros((1, 2, 2), dtype=np.float32), np.array([[1, -1]]), None,
+        )
+        if backend == "torch":
+            self._module = module
+        elif backend == "torchscript":
+            with torch.no_grad(), warnings.catch_warnings():
+                warnings.filterwarnings("ignore", category=FutureWarning)  # Deprecation of TorchScript
+                warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)  # Constant scale of the attention
+                self._module = torch.jit.freeze(torch.jit.trace(module, example_inputs, check_trace=False))
+        elif backend == "onnx":
+            import onnxruntime
+            buffer = io.BytesIO()
+            with torch.no_grad(), warnings.catch_warnings():
+                warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
+                torch.onnx.export(
+                    module, example_inputs, buffer, opset_version=17,
+                    input_names=["image_embeddings", "point_coords", "point_labels", "mask_input", "has_mask_input"],
+                    output_names=["masks", "scores"],
+                    dynamic_axes={"image_embeddings": {0: "batch"}, "point_coords": {0: "batch", 1: "num_points"},
+                                  "point_labels": {0: "batch", 1: "num_points"}, "mask_input": {0: "batch"},
+                                  "masks": {0: "batch"}, "scores": {0: "batch"}},
+                )
+            self._session = onnxruntime.InferenceSession(buffer.getvalue(), providers=["CPUExecutionProvider"])
+        else:
+            raise RuntimeError("Decoder backend {} not implemented, use one of {}.".format(backend, ", ".join(DECODER_BACKENDS)))
+
+    def _get_inputs(self, features, point_coords, point_labels, mask_input):
+        """Batched inputs of PromptMaskDecoder, points are already transformed to the input size of the model."""
+        point_coords = torch.as_tensor(point_coords, dtype=torch.float32, device=self.device)
+        point_labels = torch.as_tensor(point_labels, dtype=torch.float32, device=self.device)
+        has_mask_input = torch.tensor([float(mask_input is not None)], device=self.device)
+        if mask_input is None:
+            mask_input = torch.zeros(len(point_coords), 1, *self.sam_model.prompt_encoder.mask_input_size, device=self.device)
+        else:
+            mask_input = torch.as_tensor(mask_input, dtype=torch.float32, device=self.device)
+        return features.float(), point_coords, point_labels, mask_input, has_mask_input
+
+    def _decode(self, inputs):
+        if self.backend != "onnx":
+            with torch.no_grad():
+                return self._module(*inputs)
+        names = [node.name for node in self._session.get_inputs()]
+        masks, scores = self._session.run(None, {name: value.cpu().numpy() for name, value in zip(names, inputs)})
+        return torch.from_numpy(masks), torch.from_numpy(scores)
+
+    def predict(self, predictor, features, point_coords=None, point_labels=None, box=None, mask_input=None, multimask_output=False):
+        """Same as SamPredictor.predict with the features of the image passed in, coordinates are in (x, y) order.
+
+        predictor only provides the transform and the image size, see set_image_size.
+        """
+        masks, scores, logits = self.predict_batch(
+            predictor, features,
+            point_coords=None if point_coords is None else np.asarray(point_coords)[None],
+            point_labels=None if point_labels is None else np.asarray(point_labels)[None],
+            boxes=None if box is None else np.asarray(box)[None],
+            mask_input=None if mask_input is None else np.asarray(mask_input)[None],
+            multimask_output=multimask_output,
+        )
+        return masks[0], scores[0], logits[0]
+
+    def predict_batch(self, predictor, features, point_coords=None, point_labels=None, boxes=None, mask_input=None, multimask_output=False):
+        """Predict the masks of a batch of prompts, the i-th prompt is decoded with the i-th features.
+
+        Parameters
+        ----------
+        predictor : SamPredictor
+            Provides the transform and the image size, all features belong to images of this size.
+        features : torch.Tensor
+            Features with shape (B, C, H, W).
+        point_coords : np.ndarray
+            Point coordinates with shape (B, N, 2) in (x, y) order.
+        point_labels : np.ndarray
+            Point labels with shape (B, N).
+        boxes : np.ndarray
+            Boxes with shape (B, 4) in (x_min, y_min, x_max, y_max) order.
+        mask_input : np.ndarray
+            Logits with shape (B, 1, 256, 256).
+        multimask_output : bool
+            Whether three candidate masks are returned per prompt instead of one.
+
+        Returns
+        -------
+        masks, scores, logits
+            With shapes (B, M, H, W), (B, M) and (B, M, 256, 256) for M returned masks per prompt.
+        """
+        batch_size = len(features)
+        coords = np.zeros((batch_size, 0, 2), dtype=np.float32)
+        labels = np.zeros((batch_size, 0), dtype=np.float32)
+        if point_coords is not None:
+            coords = predictor.transform.apply_coords(np.asarray(point_coords, dtype=np.float32), predictor.original_size)
+            labels = np.asarray(point_labels, dtype=np.float32)
+        if boxes is not None:
+            corners = predictor.transform.apply_boxes(np.asarray(boxes, dtype=np.float32), predictor.original_size).reshape(batch_size, 2, 2)
+            coords = np.concatenate([coords, corners], axis=1)
+            labels = np.concatenate([labels, np.tile([[2, 3]], (batch_size, 1))], axis=1)
+        else:  # Without a box SAM adds a padding point
+            coords = np.concatenate([coords, np.zeros((batch_size, 1, 2))], axis=1)
+            labels = np.concatenate([labels, np.full((batch_size, 1), -1)], axis=1)
+        masks, scores = self._decode(self._get_inputs(features, coords, labels, mask_input))
+        mask_slice = slice(1, None) if multimask_output else slice(0, 1)
+        low_res_masks, scores = masks[:, mask_slice].to(self.device), scores[:, mask_slice]
+        with torch.no_grad():
+            masks = self.sam_model.postprocess_masks(low_res_masks, predictor.input_size, predictor.original_size)
+        masks = masks > self.sam_model.mask_threshold
+        return masks.cpu().numpy(), scores.cpu().numpy(), low_res_masks.cpu().numpy()
+
+
+def check_decoder(decoder, sam_model, rtol=1e-3, atol=1e-3):
+    """Whether decoder predicts the same logits and scores as SamPredictor for random features and prompts."""
+    from segment_anything import SamPredictor
+    from napari_sam.engine import set_image_size
+    predictor = SamPredictor(sam_model)
+    size = sam_model.image_encoder.img_size
+    set_image_size(predictor, (size, size * 3 // 4))
+    generator = torch.Generator().manual_seed(0)
+    features = torch.randn(1, sam_model.prompt_encoder.embed_dim, *sam_model.prompt_encoder.image_embedding_size, generator=generator).to(sam_model.device)
+    mask_input = torch.randn(1, *sam_model.prompt_encoder.mask_input_size, generator=generator).numpy()
+    prompts = [
+        dict(point_coords=np.array([[100, 200], [300, 50], [20, 400]]), point_labels=np.array([1, 0, 1]), multimask_output=False),
+        dict(point_coords=np.array([[100, 200]]), point_labels=np.array([1]), mask_input=mask_input, multimask_output=True),
+        dict(box=np.array([50, 60, 500, 400]), multimask_output=False),
+    ]
+    for prompt in prompts:
+        predictor.features = features
+        with torch.no_grad():
+            _, scores, logits = predictor.predict(**prompt)
+        _, decoder_scores, decoder_logits = decoder.predict(predictor, features, **prompt)
+        if not (np.allclose(decoder_logits, logits, rtol, atol * np.abs(logits).max()) and np.allclose(decoder_scores, scores, rtol, atol)):
+            return False
+    return True
+
+
+def get_decoder(sam_model, backend=None):
+    """Exported decoder of sam_model that can be passed to predict_mask, or None for the PyTorch decoder.
+
+    The backend defaults to the NAPARI_SAM_DECODER environment variable or "torch". Exported decoders are checked
+    against the PyTorch decoder, if they fail to export or their predictions differ the PyTorch decoder is used.
+    """
+    if backend is None:
+        backend = os.environ.get("NAPARI_SAM_DECODER", DEFAULT_DECODER_BACKEND)
+    if backend not in DECODER_BACKENDS:
+        raise RuntimeError("Decoder backend {} not implemented, use one of {}.".format(backend, ", ".join(DECODER_BACKENDS)))
+    if backend == "torch":
+        return None
+    if backend == "onnx" and sam_model.device.type != "cpu":
+        backend = "torchscript"
+    try:
+        decoder = ExportedDecoder(sam_model, backend)
+    except Exception as exception:
+        warnings.warn("Exporting the decoder with {} failed, using PyTorch instead: {}".format(backend, exception))
+        return None
+    # Reduced precision decoders round differently in the fused TorchScript or ONNX graph
+    tolerance = 1e-3 if next(sam_model.mask_decoder.parameters()).dtype == torch.float32 else 5e-2
+    if not check_decoder(decoder, sam_model, tolerance, tolerance):
+        warnings.warn("The {} decoder does not match the PyTorch decoder, using PyTorch instead.".format(backend))
+        return None
+    return decoder
@@ -0,0 +1,151 @@
+import hashlib
+import io
+import os
+import shutil
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from tqdm import tqdm
+
+# SHA-256 of the official SAM checkpoints by file name, files that are not listed are not verified
+SAM_WEIGHTS_SHA256 = {
+    "sam_vit_h_4b8939.pth": "a7bf3b02f3ebf1267aba913ff637d9a2d5c33d3173bb679e46d9f338c26f262e",
+    "sam_vit_l_0b3195.pth": "3adcc4315b642a4d2101128f611684e8734c41232a17c648ed1693702a49a622",
+    "sam_vit_b_01ec64.pth": "ec2df62732614e57411cdcf32a23ffdf28910380d03139ee0f4fcbe91eb8c912",
+}
+
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_RETRIES = 5
+
+
+def get_mirror_url(url):
+    """url with its directory replaced by the NAPARI_SAM_WEIGHTS_URL environment variable, a base URL or a local directory."""
+    mirror = os.environ.get("NAPARI_SAM_WEIGHTS_URL")
+    if not mirror:
+        return url
+    return mirror.rstrip("/") + "/" + url.split("/")[-1]
+
+
+def get_sha256(path, progress_bar=None):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            buffer = f.read(CHUNK_SIZE)
+            if not buffer:
+                break
+            sha256.update(buffer)
+            if progress_bar is not None:
+                progress_bar.update(len(buffer))
+    return sha256.hexdigest()
+
+
+def _get_marker_path(path):
+    return path.with_name(path.name + ".sha256")
+
+
+def is_verified(path, sha256=None):
+    """Whether path exists and has been verified against sha256 since it was last modified.
+
+    The result of a verification is stored next to the file together with its size and modification time, so that large
+    checkpoints are only hashed once.
+    """
+    path = Path(path)
+    if not path.is_file():
+        return False
+    if sha256 is None:
+        return True
+    stat = path.stat()
+    record = "{} {} {}".format(sha256, stat.st_size, stat.st_mtime_ns)
+    marker_path = _get_marker_path(path)
+    if marker_path.is_file() and marker_path.read_text().strip() == record:
+        return True
+    with tqdm(total=stat.st_size, unit="B", unit_scale=True, desc="Verifying {}".format(path.name)) as progress_bar:
+        if get_sha256(path, progress_bar) != sha256:
+            return False
+    marker_path.write_text(record)
+    return True
+
+
+def _is_local(url):
+    return "://" not in url or url.startswith("file://")
+
+
+def _open(url, start):
+    """Open url at byte offset start. Returns the response, the offset it starts at and the total size (or None)."""
+    if _is_local(url):
+        f = open(url[len("file://"):] if url.startswith("file://") else url, "rb")
+        size = os.fstat(f.fileno()).st_size
+        f.seek(min(start, size))
+        return f, min(start, size), size
+    request = urllib.request.Request(url)
+    if start > 0:
+        request.add_header("Range", "bytes={}-".format(start))
+    try:
+        response = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as error:
+        if error.code == 416:  # The partial file is already complete, or stale and rejected by verification
+            return io.BytesIO(), start, None
+        raise
+    if response.status == 206:
+        content_range = response.headers.get("Content-Range", "")
+        size = content_range.split("/")[-1]
+        return response, start, int(size) if size.isdigit() else None
+    length = response.headers.get("Content-Length")
+    return response, 0, int(length) if length is not None else None
+
+
+def download_file(url, path, sha256=None):
+    """Download url (or copy a local file) to path.
+
+    The data is written to path + ".part", which is resumed if a previous download was interrupted and only renamed to
+    path once it is complete and matches sha256. Interrupted connections are resumed up to MAX_RETRIES times, a resumed
+    file that does not match sha256 is downloaded once more from scratch. Raises RuntimeError if the downloaded file
+    still does not match.
+    """
+    path = Path(path)
+    part_path = path.with_name(path.name + ".part")
+    resumed = part_path.exists()
+    _download(url, part_path)
+    if resumed and not is_verified(part_path, sha256):
+        part_path.unlink()
+        _download(url, part_path)
+    if not is_verified(part_path, sha256):
+        part_path.unlink()
+        raise RuntimeError("Checksum of {} does not match, the corrupted download has been removed.".format(url))
+    os.replace(part_path, path)
+    if sha256 is not None:
+        os.replace(_get_marker_path(part_path), _get_marker_path(path))
+    return path
+
+
+def _download(url, part_path):
+    for attempt in range(MAX_RETRIES + 1):
+        start = part_path.stat().st_size if part_path.exists() else 0
+        try:
+            source, start, size = _open(url, start)
+            with source, open(part_path, "r+b" if start > 0 else "wb") as f, \
+                    tqdm(total=size, initial=start, unit="B", unit_scale=True, desc="Downloading {}".format(part_path.name)) as progress_bar:
+                f.seek(start)
+                f.truncate()
+                shutil.copyfileobj(_ProgressReader(source, progress_bar), f, CHUNK_SIZE)
+            if size is not None and part_path.stat().st_size < size:
+                raise OSError("Connection closed after {} of {} bytes".format(part_path.stat().st_size, size))
+            return
+        except OSError as error:  # Includes urllib.error.URLError
+            # Only dropped connections are worth retrying, a missing local file or an HTTP error (e.g. 404) is not
+            if _is_local(url) or isinstance(error, urllib.error.HTTPError) or attempt == MAX_RETRIES:
+                raise
+            print("Download of {} interrupted ({}), resuming ...".format(url, error))
+            time.sleep(min(2 ** attempt, 30))
+
+
+class _ProgressReader:
+    def __init__(self, source, progress_bar):
+        self.source = source
+        self.progress_bar = progress_bar
+
+    def read(self, size=-1):
+        buffer = self.source.read(size)
+        self.progress_bar.update(len(buffer))
+        return buffer
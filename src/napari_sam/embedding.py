@@ -0,0 +1,309 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import torch
+from napari_sam.embedding_cache import get_slice_digest
+from napari_sam.profiling import profiler
+
+# Upper limit for automatically chosen batch sizes, larger batches do not increase the throughput any further
+MAX_AUTO_BATCH_SIZE = 8
+# Dtypes the features can be stored in, can be chosen with the NAPARI_SAM_EMBEDDING_DTYPE environment variable
+STORAGE_DTYPES = ("float32", "float16", "bfloat16")
+DEFAULT_STORAGE_DTYPE = "float32"
+# Size in MB of the features that are kept on the device, can be overwritten with the NAPARI_SAM_DEVICE_CACHE_SIZE environment variable
+DEFAULT_DEVICE_CACHE_SIZE = 256
+
+
+def encode_images(sam_model, transform, images):
+    """Compute the SAM image embeddings of a list of equally sized uint8 HxWx3 images in a single forward pass.
+
+    Does the same as SamPredictor.set_image, but without touching any predictor state so that it can be called from
+    background threads while the predictor is in use.
+    """
+    input_images = [torch.as_tensor(np.ascontiguousarray(resize_image(transform, image)), device=sam_model.device) for image in images]
+    input_images = torch.stack(input_images).permute(0, 3, 1, 2).contiguous()
+    with torch.no_grad():
+        features = sam_model.image_encoder(sam_model.preprocess(input_images))
+    return features
+
+
+def resize_image(transform, image):
+    """Resize an image with the transform of SamPredictor. Grayscale images that are broadcast to RGB are only resized once."""
+    if image.ndim == 3 and image.strides[-1] == 0:
+        image = transform.apply_image(image[..., 0])
+        return np.broadcast_to(image[..., None], (*image.shape, 3))
+    return transform.apply_image(image)
+
+
+def get_storage_dtype(dtype=None):
+    """Dtype the features are stored in, dtype or the NAPARI_SAM_EMBEDDING_DTYPE environment variable if None."""
+    if dtype is None:
+        dtype = os.environ.get("NAPARI_SAM_EMBEDDING_DTYPE", DEFAULT_STORAGE_DTYPE)
+    if dtype not in STORAGE_DTYPES:
+        raise RuntimeError("Embedding dtype {} not implemented, use one of {}".format(dtype, ", ".join(STORAGE_DTYPES)))
+    return dtype
+
+
+def get_numpy_dtype(dtype):
+    """NumPy dtype of the stored features. NumPy has no bfloat16, so bfloat16 features are stored as their uint16 bits."""
+    return np.dtype(np.uint16) if dtype == "bfloat16" else np.dtype(dtype)
+
+
+def to_storage(features, dtype):
+    """Convert features (torch.Tensor) to a NumPy array in the storage dtype."""
+    if dtype == "bfloat16":
+        return features.to(torch.bfloat16).view(torch.int16).cpu().numpy().view(np.uint16)
+    return features.to(getattr(torch, dtype)).cpu().numpy()
+
+
+def from_storage(features, dtype, device="cpu"):
+    """Convert stored features (np.ndarray) to a float32 torch.Tensor on device.
+
+    The tensor never shares memory with features, so changing it in place cannot corrupt a memory-mapped cache entry.
+    """
+    if dtype == "bfloat16":
+        return torch.from_numpy(features.view(np.int16)).view(torch.bfloat16).to(device).float()
+    return torch.from_numpy(features).to(device=device, dtype=torch.float32, copy=True)
+
+
+def get_available_memory(device):
+    if str(device).startswith("cuda"):
+        return torch.cuda.mem_get_info(torch.device(device))[0]
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_batch_size(sam_model, device, batch_size=None):
+    """Number of images that are encoded in one forward pass.
+
+    Uses batch_size or the NAPARI_SAM_EMBEDDING_BATCH_SIZE environment variable if given. Otherwise the batch size is
+    chosen from the available memory and the peak activation memory of a single image in the image encoder, which is
+    dominated by the attention matrices of the global attention blocks.
+    """
+    if batch_size is None and "NAPARI_SAM_EMBEDDING_BATCH_SIZE" in os.environ:
+        batch_size = int(os.environ["NAPARI_SAM_EMBEDDING_BATCH_SIZE"])
+    if batch_size is not None:
+        return max(int(batch_size), 1)
+    available_memory = get_available_memory(device)
+    if available_memory is None:
+        return 1
+    image_encoder = sam_model.image_encoder
+    num_tokens = (image_encoder.img_size // image_encoder.patch_embed.proj.kernel_size[0]) ** 2
+    block = image_encoder.blocks[0]
+    embed_dim = block.norm1.normalized_shape[0]
+    image_memory = 4 * (block.attn.num_heads * num_tokens ** 2 + 8 * num_tokens * embed_dim)
+    return int(np.clip(available_memory // (2 * image_memory), 1, MAX_AUTO_BATCH_SIZE))
+
+
+def get_device_cache_size(device_cache_size=None):
+    """Size in bytes of the features kept on the device, device_cache_size or NAPARI_SAM_DEVICE_CACHE_SIZE (in MB)."""
+    if device_cache_size is None:
+        device_cache_size = float(os.environ.get("NAPARI_SAM_DEVICE_CACHE_SIZE", DEFAULT_DEVICE_CACHE_SIZE))
+    return int(max(device_cache_size, 0) * 1024 ** 2)
+
+
+class SliceEmbeddings:
+    """Per-slice SAM image embeddings that are computed on demand.
+
+    Indexing returns the features of a slice with shape (1, C, H, W) and computes them first if necessary. Computed
+    features are written into the (memory-mapped) features array, so they are persisted by the embedding cache.
+    prefetch() computes the remaining slices in background threads, starting with the ones closest to a given slice.
+    Background and bulk computations encode batch_size slices at once. Slices whose image is the same as in the previous
+    embeddings (e.g. of other contrast limits) are copied from them instead of being encoded again.
+
+    Features can be stored in float16 or bfloat16 to halve the size of the array. The most recently used slices are kept
+    on the device in float32 up to device_cache_size bytes, all other slices are read (and converted) from the features
+    array again when they are needed. Together with a memory-mapped features array, large volumes fit into a fixed memory
+    budget.
+
+    Parameters
+    ----------
+    encode : callable
+        Maps a list of uint8 HxWx3 images to their features of shape (N, C, H, W).
+    get_image : callable
+        Maps a slice index to the uint8 HxWx3 image that is encoded for this slice.
+    features : np.ndarray
+        Array of shape (slices, C, H, W) the features are stored in.
+    valid : np.ndarray
+        Boolean array of shape (slices,) that marks which slices in features are already computed.
+    device : str
+        Device the returned features are moved to.
+    num_workers : int
+        Number of background threads used by prefetch().
+    batch_size : int
+        Number of slices that are encoded together by prefetch() and compute().
+    previous : SliceEmbeddings
+        Embeddings of the same image that was preprocessed differently.
+    image_digest : str
+        Hash that identifies the image, see get_image_digest.
+    digests : np.ndarray
+        Array of shape (slices, DIGEST_SIZE) with the digest of the image every slice in features was computed from,
+        see get_slice_digest. If given, computed slices (e.g. of a cache entry) are verified against the digest of
+        their image before they are used for the first time and computed again if the image changed.
+    storage_dtype : str
+        Dtype of features, one of STORAGE_DTYPES.
+    device_cache_size : int
+        Size in bytes of the features that are kept on the device, see get_device_cache_size.
+    """
+    def __init__(self, encode, get_image, features, valid, device, num_workers=1, batch_size=1, previous=None, image_digest=None,
+                 digests=None, storage_dtype="float32", device_cache_size=0):
+        self.encode = encode
+        self.get_image = get_image
+        self.features = features
+        self.valid = valid
+        self.device = device
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.previous = previous
+        self.image_digest = image_digest
+        self.digests = digests
+        self._verified = None if digests is None else np.zeros(len(features), dtype=bool)
+        self.storage_dtype = storage_dtype
+        self.max_device_slices = int(device_cache_size // (4 * np.prod(features.shape[1:])))
+        self._device_cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._prefetch_order = []
+        self._num_prefetch_workers = 0
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="napari-sam-prefetch")
+        self._closed = False
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, index):
+        self._verify(index)
+        with self._lock:
+            if index in self._device_cache:
+                self._device_cache.move_to_end(index)
+                return self._device_cache[index]
+            future = self._pending.get(index)
+            is_owner = future is None and not self.valid[index]
+            if is_owner:
+                future = self._reserve(index)
+        if is_owner:
+            self._compute([index], [future])
+        if future is not None:
+            future.result()
+        features = from_storage(self.features[index:index+1], self.storage_dtype, self.device)
+        if self.max_device_slices > 0:
+            with self._lock:
+                self._device_cache[index] = features
+                while len(self._device_cache) > self.max_device_slices:
+                    self._device_cache.popitem(last=False)
+        return features
+
+    def compute(self, indices):
+        """Compute the given slices in the calling thread, encoding batch_size slices at once."""
+        for index in indices:
+            self._verify(index)
+        with self._lock:
+            pending = [self._pending[index] for index in indices if index in self._pending]
+            reserved = [(index, self._reserve(index)) for index in indices if not self.valid[index] and index not in self._pending]
+        for start in range(0, len(reserved), self.batch_size):
+            batch = reserved[start:start+self.batch_size]
+            self._compute([index for index, _ in batch], [future for _, future in batch])
+        for future in pending + [future for _, future in reserved]:
+            future.result()
+
+    def num_computed(self):
+        return int(np.count_nonzero(self.valid))
+
+    def prefetch(self, center):
+        """Compute all remaining slices in the background, ordered by their distance to the slice center."""
+        if self._closed:
+            return
+        order = sorted(range(len(self)), key=lambda index: abs(index - center))
+        with self._lock:
+            self._prefetch_order = [index for index in order if not self.valid[index]]
+            num_new_workers = self.num_workers - self._num_prefetch_workers
+            self._num_prefetch_workers += max(num_new_workers, 0)
+        for _ in range(num_new_workers):
+            self._executor.submit(self._prefetch_worker)
+
+    def close(self):
+        """Stop prefetching. Slices that are currently computed are still finished."""
+        self._closed = True
+        with self._lock:
+            self._prefetch_order = []
+            self._device_cache.clear()
+        self._executor.shutdown(wait=False)
+        self.previous = None
+
+    def _verify(self, index):
+        """Whether slice index is computed. A computed slice that does not match its digest is marked as not computed."""
+        if not self.valid[index]:
+            return False
+        if self._verified is None or self._verified[index]:
+            return True
+        if np.array_equal(self.digests[index], get_slice_digest(self.get_image(index))):
+            self._verified[index] = True
+            return True
+        with self._lock:
+            if index not in self._pending:
+                self.valid[index] = False
+        return False
+
+    def _reserve(self, index):
+        future = Future()
+        self._pending[index] = future
+        return future
+
+    def _compute(self, indices, futures):
+        try:
+            with profiler.stage("preprocess"):
+                images = {index: self.get_image(index) for index in indices}
+            previous = self.previous
+            if previous is not None:
+                for index in indices:
+                    if previous._verify(index) and np.array_equal(previous.get_image(index), images[index]):
+                        self.features[index] = to_storage(from_storage(previous.features[index:index+1], previous.storage_dtype), self.storage_dtype)[0]
+                        self._set_computed(index, images.pop(index))
+            if len(images) > 0:
+                with profiler.stage("encode"):
+                    features = to_storage(self.encode(list(images.values())), self.storage_dtype)
+                for (index, image), index_features in zip(images.items(), features):
+                    self.features[index] = index_features
+                    self._set_computed(index, image)
+            for future in futures:
+                future.set_result(None)
+        except BaseException as exception:
+            for future in futures:
+                future.set_exception(exception)
+        finally:
+            with self._lock:
+                for index in indices:
+                    del self._pending[index]
+
+    def _set_computed(self, index, image):
+        if self.digests is not None:
+            self.digests[index] = get_slice_digest(image)
+            self._verified[index] = True
+        self.valid[index] = True
+
+    def _next_prefetch_batch(self):
+        with self._lock:
+            batch = []
+            while self._prefetch_order and len(batch) < self.batch_size:
+                index = self._prefetch_order.pop(0)
+                if not self.valid[index] and index not in self._pending:
+                    batch.append((index, self._reserve(index)))
+            if not batch:
+                self._num_prefetch_workers -= 1
+            return batch
+
+    def _prefetch_worker(self):
+        while True:
+            batch = self._next_prefetch_batch()
+            if not batch:
+                break
+            self._compute([index for index, _ in batch], [future for _, future in batch])
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import numpy as np
+from napari_sam.utils import get_cache_dir
+
+# Size budget of the embedding cache in GB, can be overwritten with the NAPARI_SAM_EMBEDDING_CACHE_SIZE environment variable
+DEFAULT_CACHE_SIZE = 20
+
+# Size in bytes of the digests that identify the embedded image of a slice
+DIGEST_SIZE = 20
+# Number of evenly spaced slices of a 3D image that are hashed for its cache key
+NUM_KEY_SLICES = 8
+
+
+def get_slice_digest(image):
+    """Hash of the (preprocessed) image of a slice as uint8 array of DIGEST_SIZE bytes."""
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    hasher.update(str((image.shape, str(image.dtype))).encode())
+    hasher.update(np.ascontiguousarray(image))
+    return np.frombuffer(hasher.digest(), dtype=np.uint8)
+
+
+def get_image_digest(image, ndim=2):
+    """Hash that identifies the image in the cache key.
+
+    Hashing every slice of a 3D image (ndim=3) would make opening the embeddings O(depth) and would read a whole dask
+    or zarr volume from storage. 3D images are therefore identified by NUM_KEY_SLICES evenly spaced slices, so volumes
+    that only share some slices still get different entries. Slices that are not hashed are covered by the per-slice
+    digests that every cached slice is verified against before it is used, see SliceEmbeddings.
+    """
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    if ndim == 3:
+        for index in np.unique(np.linspace(0, len(image) - 1, NUM_KEY_SLICES).round().astype(int)):
+            hasher.update(np.ascontiguousarray(image[index]))
+    else:
+        hasher.update(np.ascontiguousarray(image))
+    return hasher.hexdigest()
+
+
+def embedding_key(image, contrast_limits, model_type, image_digest=None):
+    """Content-address of an image embedding.
+
+    Combines a hash of the image data with the contrast limits used for normalization and the SAM model type, so every
+    set of contrast limits has its own version of the embedding. image_digest can be passed to avoid hashing the image
+    again, see get_image_digest.
+    """
+    if image_digest is None:
+        image_digest = get_image_digest(image)
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(str((tuple(image.shape), str(image.dtype), model_type)).encode())
+    if contrast_limits is not None:
+        hasher.update(str(tuple(float(limit) for limit in contrast_limits)).encode())
+    hasher.update(image_digest.encode())
+    return hasher.hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent LRU cache of SAM image embeddings stored as memory-mapped .npy files.
+
+    Every entry holds the features of all slices of an image with shape (slices, C, H, W) together with a per-slice
+    flag that marks which slices have already been embedded and the digest of the image each slice was embedded from
+    (see get_slice_digest). Entries can therefore be filled incrementally.
+    """
+    def __init__(self, cache_dir=None, max_size=None):
+        if cache_dir is None:
+            cache_dir = get_cache_dir() / "embeddings"
+        if max_size is None:
+            max_size = float(os.environ.get("NAPARI_SAM_EMBEDDING_CACHE_SIZE", DEFAULT_CACHE_SIZE))
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size * 1024 ** 3)
+
+    def _paths(self, key):
+        return tuple(self.cache_dir / "{}.{}.npy".format(key, name) for name in ("features", "valid", "digests"))
+
+    def open(self, key, shape, dtype=np.float32):
+        """Open the entry of key or create an empty one. Returns the memory-mapped features, per-slice flags and digests."""
+        features_path, valid_path, digests_path = self._paths(key)
+        features, valid, digests = None, None, None
+        if features_path.exists() and valid_path.exists() and digests_path.exists():
+            try:
+                features = np.load(features_path, mmap_mode="r+")
+                valid = np.load(valid_path, mmap_mode="r+")
+                digests = np.load(digests_path, mmap_mode="r+")
+            except (OSError, ValueError):
+                features, valid, digests = None, None, None
+            if features is not None and (features.shape != tuple(shape) or features.dtype != dtype or len(valid) != shape[0]
+                                         or digests.shape != (shape[0], DIGEST_SIZE)):
+                features, valid, digests = None, None, None
+        if features is None:
+            self.remove(key)
+            features = np.lib.format.open_memmap(features_path, mode="w+", dtype=dtype, shape=tuple(shape))
+            valid = np.lib.format.open_memmap(valid_path, mode="w+", dtype=bool, shape=(shape[0],))
+            digests = np.lib.format.open_memmap(digests_path, mode="w+", dtype=np.uint8, shape=(shape[0], DIGEST_SIZE))
+        os.utime(features_path)  # Mark entry as recently used
+        self.evict(keep=key)
+        return features, valid, digests
+
+    def remove(self, key):
+        for path in self._paths(key):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits into its size budget."""
+        entries = sorted(self.cache_dir.glob("*.features.npy"), key=lambda path: path.stat().st_mtime)
+        cache_size = sum(path.stat().st_size for path in entries)
+        for path in entries:
+            if cache_size <= self.max_size:
+                break
+            key = path.name.split(".")[0]
+            if key == keep:
+                continue
+            cache_size -= path.stat().st_size
+            try:
+                self.remove(key)
+            except OSError:  # Entry is still memory-mapped by another process (Windows)
+                pass
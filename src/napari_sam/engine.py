@@ -0,0 +1,268 @@
+"""Inference without napari and Qt.
+
+All functions work on NumPy arrays in napari's axis order, i.e. 2D images are (H, W) or (H, W, C) for RGB images and 3D
+images are (slices, H, W). Point coordinates are given in (row, column) order.
+"""
+from functools import partial
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+from segment_anything.automatic_mask_generator import SamAutomaticMaskGenerator
+from napari_sam.utils import ImagePreprocessor, SliceReader
+from napari_sam.models import get_model
+from napari_sam.profiling import profiler
+from napari_sam.embedding_cache import embedding_key, get_image_digest
+from napari_sam.embedding import SliceEmbeddings, encode_images, get_batch_size, get_storage_dtype, get_numpy_dtype, get_device_cache_size, from_storage
+from napari_sam.everything import compose_masks, segment_tiled, segment_slices, get_tile_starts, get_generator_kwargs, get_num_workers, MaskGeneratorPool, TILE_SIZE, TILE_OVERLAP
+
+
+def get_default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def load_model(model_type, device=None, precision=None):
+    """Load the SAM model of model_type, downloading its weights if necessary.
+
+    Models are shared within the process, see napari_sam.models.get_model.
+    """
+    if device is None:
+        device = get_default_device()
+    return get_model(model_type, device, precision)
+
+
+def create_mask_generator(sam_model, **kwargs):
+    return SamAutomaticMaskGenerator(sam_model, output_mode="uncompressed_rle", **kwargs)
+
+
+def get_image_size(image, rgb=False):
+    """Height and width of the slices of a 2D or 3D image."""
+    return tuple(image.shape[-3:-1] if rgb else image.shape[-2:])
+
+
+def select_pyramid_level(shapes, rgb=False, ndim=2, target_size=1024):
+    """Index of the pyramid level of a multiscale image that SAM's embeddings are computed from.
+
+    SAM resizes every image to target_size along its longer side, so the smallest level whose slices are at least that
+    large gives (almost) the same embedding as the full resolution while reading far less data. For 3D images only
+    levels with all slices of the full resolution are considered, so slice indices stay the same. Predictions are made
+    at the size of the selected level as well, and only the cropped masks are upscaled to the full resolution (see
+    upscale_mask), so a click never allocates a full resolution mask.
+
+    Parameters
+    ----------
+    shapes : list of tuple
+        Shapes of the levels, from the full resolution to the smallest level.
+    rgb : bool
+        Whether the levels have a trailing channel axis.
+    ndim : int
+        Number of spatial dimensions (2 or 3).
+    target_size : int
+        Input size of the image encoder, e.g. sam_model.image_encoder.img_size.
+    """
+    level = 0
+    for index, shape in enumerate(shapes):
+        spatial_shape = shape[:-1] if rgb else shape
+        if ndim == 3 and spatial_shape[0] != (shapes[0][:-1] if rgb else shapes[0])[0]:
+            continue
+        if max(spatial_shape[-2:]) >= target_size:
+            level = index
+    return level
+
+
+def get_nearest_indices(start, stop, scale):
+    """Indices of the pixels of a grid that is scale times coarser that are nearest to the pixels start to stop - 1."""
+    return np.floor((np.arange(start, stop) + 0.5) / scale).astype(int)
+
+
+def upscale_mask(mask, bbox, scale, shape):
+    """Upscale a mask cropped to bbox (tuple of slices) by scale (per axis) with nearest neighbor interpolation.
+
+    Only the crop is upscaled, so the memory use does not depend on the size of the full image. Returns the upscaled
+    mask and its bounding box within an image of the given shape.
+    """
+    full_bbox, indices = [], []
+    for axis_slice, axis_scale, size in zip(bbox, scale, shape):
+        start = min(max(int(np.ceil(axis_slice.start * axis_scale - 0.5)), 0), size)
+        stop = min(max(int(np.ceil(axis_slice.stop * axis_scale - 0.5)), start), size)
+        full_bbox.append(slice(start, stop))
+        indices.append(np.clip(get_nearest_indices(start, stop, axis_scale), axis_slice.start, axis_slice.stop - 1) - axis_slice.start)
+    return mask[np.ix_(*indices)], tuple(full_bbox)
+
+
+def downscale_mask(mask, shape):
+    """Resize a mask to a smaller shape with nearest neighbor interpolation."""
+    indices = [np.clip(get_nearest_indices(0, new_size, new_size / size), 0, size - 1) for new_size, size in zip(shape, mask.shape)]
+    return mask[np.ix_(*indices)]
+
+
+def set_image_size(predictor, image_size):
+    """Prepare a SamPredictor for features of images of image_size that are computed elsewhere, e.g. by open_embeddings."""
+    predictor.reset_image()
+    predictor.original_size = tuple(image_size)
+    predictor.input_size = tuple(predictor.transform.get_preprocess_shape(*image_size, predictor.transform.target_length))
+    predictor.is_image_set = True
+
+
+def open_embeddings(sam_model, model_type, image, ndim, preprocess, contrast_limits=None, cache=None, device=None, batch_size=None, previous=None,
+                    storage_dtype=None, device_cache_size=None):
+    """Per-slice embeddings of a 2D (one slice) or 3D image that are computed on demand.
+
+    Parameters
+    ----------
+    sam_model : Sam
+        The SAM model.
+    model_type : str
+        Type of sam_model, part of the cache key. Use napari_sam.models.get_model_id for models in reduced precision.
+    image : array-like
+        2D or 3D image. Slices are only read when they are embedded, dask and zarr arrays chunk by chunk.
+    ndim : int
+        Number of spatial dimensions of image (2 or 3).
+    preprocess : callable
+        Converts a slice to uint8 HxWx3, e.g. ImagePreprocessor.
+    contrast_limits : tuple
+        Contrast limits of preprocess, part of the cache key.
+    cache : EmbeddingCache
+        Cache the embeddings are stored in. If None, they are kept in memory only.
+    device : str
+        Device the returned features are moved to.
+    batch_size : int
+        Number of slices encoded at once, chosen from the available memory if None.
+    previous : SliceEmbeddings
+        Embeddings of the same image with other contrast limits. Slices whose uint8 image did not change are copied
+        from them instead of being encoded again.
+    storage_dtype : str
+        Dtype the features are stored in ("float32", "float16" or "bfloat16"), see get_storage_dtype.
+    device_cache_size : float
+        Size in MB of the most recently used features that are kept on the device, see get_device_cache_size.
+
+    Returns
+    -------
+    SliceEmbeddings
+    """
+    if device is None:
+        device = sam_model.device
+    num_slices = 1 if ndim == 2 else image.shape[0]
+    features_shape = (num_slices, sam_model.prompt_encoder.embed_dim, *sam_model.prompt_encoder.image_embedding_size)
+    storage_dtype = get_storage_dtype(storage_dtype)
+    image_digest = previous.image_digest if previous is not None else None
+    if cache is not None:
+        if image_digest is None:
+            image_digest = get_image_digest(image, ndim)
+        features, valid, digests = cache.open(embedding_key(image, contrast_limits, model_type, image_digest), features_shape,
+                                              get_numpy_dtype(storage_dtype))
+    else:
+        features, valid, digests = np.zeros(features_shape, dtype=get_numpy_dtype(storage_dtype)), np.zeros(num_slices, dtype=bool), None
+    transform = SamPredictor(sam_model).transform
+    encode = lambda images: encode_images(sam_model, transform, images)
+    if ndim == 3:
+        reader = SliceReader(image)
+        get_image = lambda index: preprocess(reader[index])
+    else:
+        get_image = lambda index: preprocess(image)
+    batch_size = get_batch_size(sam_model, device, batch_size)
+    return SliceEmbeddings(encode, get_image, features, valid, device, batch_size=batch_size, previous=previous, image_digest=image_digest,
+                           digests=digests, storage_dtype=storage_dtype, device_cache_size=get_device_cache_size(device_cache_size))
+
+
+def embed_image(sam_model, image, rgb=False, contrast_limits=None, model_type=None, cache=None):
+    """Compute the features of all slices of a 2D or 3D image with shape (slices, C, H, W)."""
+    if contrast_limits is None:
+        contrast_limits = (0, 255) if image.dtype == np.uint8 else (float(np.min(image)), float(np.max(image)))
+    preprocess = ImagePreprocessor(image.dtype, contrast_limits, rgb)
+    ndim = image.ndim - 1 if rgb else image.ndim
+    embeddings = open_embeddings(sam_model, model_type, image, ndim, preprocess, contrast_limits, cache)
+    embeddings.compute(range(len(embeddings)))
+    embeddings.close()
+    return from_storage(np.asarray(embeddings.features), embeddings.storage_dtype).numpy()
+
+
+def predict_mask(predictor, features, points=None, point_labels=None, box=None, mask_input=None, multimask_output=False, decoder=None):
+    """Predict masks of a single slice from points and/or a box.
+
+    Parameters
+    ----------
+    predictor : SamPredictor
+        Predictor prepared with set_image_size.
+    features : torch.Tensor
+        Features of the slice with shape (1, C, H, W).
+    points : np.ndarray
+        Point coordinates with shape (N, 2) in (row, column) order.
+    point_labels : np.ndarray
+        1 for foreground and 0 for background points.
+    box : np.ndarray
+        Box (row_min, column_min, row_max, column_max).
+    mask_input : np.ndarray
+        Logits of a previous prediction of the slice.
+    multimask_output : bool
+        Whether three candidate masks are returned instead of one.
+    decoder : ExportedDecoder
+        Exported prompt encoder and mask decoder used instead of the PyTorch modules, see napari_sam.decoder.get_decoder.
+
+    Returns
+    -------
+    masks, scores, logits
+        As returned by SamPredictor.predict.
+    """
+    prompts = dict(
+        point_coords=None if points is None else np.flip(np.asarray(points), axis=-1),
+        point_labels=None if point_labels is None else np.asarray(point_labels),
+        box=None if box is None else np.asarray(box)[[1, 0, 3, 2]],
+        mask_input=mask_input,
+        multimask_output=multimask_output,
+    )
+    if decoder is not None:
+        return decoder.predict(predictor, features, **prompts)
+    predictor.features = features
+    return predictor.predict(**prompts)
+
+
+def segment_everything(generator, image, labels, preprocess, build_model=None, num_workers=None, device="cpu"):
+    """Segment all objects of a 2D or 3D image and stream the results into labels.
+
+    3D images are segmented slice by slice and 2D images larger than twice the tile size tile by tile. This is a
+    generator that yields (done, total, region) after every slice or tile, where region is the tuple of slices of labels
+    that has been written.
+
+    Parameters
+    ----------
+    generator : SamAutomaticMaskGenerator
+        Generator created with output_mode="uncompressed_rle", e.g. by create_mask_generator.
+    image : array-like
+        2D or 3D image.
+    labels : array-like
+        Labels array of the image size.
+    preprocess : callable
+        Converts a slice or tile to uint8 HxWx3, e.g. ImagePreprocessor.
+    build_model : callable
+        Picklable callable that returns the model, required to distribute the work over worker processes.
+    num_workers : int
+        Number of worker processes, see get_num_workers.
+    device : str
+        Device the worker processes run the model on.
+    """
+    preprocess = profiler.wrap("preprocess", preprocess)
+    if labels.ndim == 3:
+        num_images = labels.shape[0]
+        segment = segment_slices
+    elif max(labels.shape) > 2 * TILE_SIZE:
+        num_images = len(get_tile_starts(labels.shape[0], TILE_SIZE, TILE_OVERLAP)) * len(get_tile_starts(labels.shape[1], TILE_SIZE, TILE_OVERLAP))
+        segment = partial(segment_tiled, tile_size=TILE_SIZE, overlap=TILE_OVERLAP)
+    else:
+        records = profiler.wrap("generate_masks", generator.generate)(preprocess(image))
+        compose_masks(records, labels)
+        yield 1, 1, tuple(slice(0, size) for size in labels.shape)
+        return
+    num_workers = 0 if build_model is None else get_num_workers(generator.predictor.model, device, num_images, num_workers)
+    pool = None
+    if num_workers > 0:
+        pool = MaskGeneratorPool(build_model, get_generator_kwargs(generator), num_workers, device)
+        generate = pool.imap
+    else:
+        generate = lambda images: map(profiler.wrap("generate_masks", generator.generate), images)
+    yield 0, num_images, None
+    try:
+        for done, region in enumerate(segment(image, generate, labels, preprocess), 1):
+            yield done, num_images, region
+    finally:
+        if pool is not None:
+            pool.close()
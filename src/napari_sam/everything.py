@@ -0,0 +1,326 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from segment_anything.automatic_mask_generator import SamAutomaticMaskGenerator
+from napari_sam.utils import SliceReader
+from napari_sam.embedding import get_available_memory
+from napari_sam.profiling import profiler
+
+# Edge length and minimal overlap of the tiles large images are split into in Everything mode
+TILE_SIZE = 1024
+TILE_OVERLAP = 128
+# Minimal number of CPU cores per worker process, fewer threads make the image encoder of every worker inefficient
+MIN_THREADS_PER_WORKER = 4
+
+
+def decode_rle_crop(rle):
+    """Decode an uncompressed (column-major) RLE only within the bounding box of its foreground.
+
+    Returns the mask cropped to its bounding box and the bounding box as tuple of slices, or (None, None) if the mask
+    is empty. Only the columns spanned by the mask are decoded, with uint8 temporaries.
+    """
+    h, w = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    ends = np.cumsum(counts)
+    run_starts, run_ends = (ends - counts)[1::2], ends[1::2]  # Runs of ones are at odd positions
+    non_empty = run_ends > run_starts
+    run_starts, run_ends = run_starts[non_empty], run_ends[non_empty]
+    if len(run_starts) == 0:
+        return None, None
+    x0, x1 = run_starts[0] // h, (run_ends[-1] - 1) // h + 1
+    offset = x0 * h
+    diff = np.zeros((x1 - x0) * h + 1, dtype=np.int8)
+    diff[run_starts - offset] = 1  # Runs of ones never touch each other, so no index occurs twice
+    diff[run_ends - offset] = -1
+    mask = np.cumsum(diff[:-1], dtype=np.int8).astype(bool).reshape(x1 - x0, h).T
+    rows = np.flatnonzero(mask.any(axis=1))
+    y0, y1 = rows[0], rows[-1] + 1
+    return mask[y0:y1], (slice(int(y0), int(y1)), slice(int(x0), int(x1)))
+
+
+def compose_masks(records, labels, order="area", start_label=1, overwrite=True):
+    """Paint the masks of SamAutomaticMaskGenerator records one at a time into a labels array.
+
+    The generator needs to be created with output_mode="uncompressed_rle". Every mask only touches its bounding box,
+    so the peak memory is O(H×W) independent of the number of masks.
+
+    Parameters
+    ----------
+    records : list of dict
+        Records returned by SamAutomaticMaskGenerator.generate.
+    labels : np.ndarray
+        2D labels array the masks are painted into.
+    order : str
+        "area" paints large masks first so that smaller masks stay visible, "predicted_iou" paints the masks with the
+        highest predicted IoU last.
+    start_label : int
+        Label of the first painted mask, every following mask gets the next label.
+    overwrite : bool
+        Whether masks overwrite already painted labels or only fill unlabeled pixels.
+
+    Returns
+    -------
+    int
+        The next unused label.
+    """
+    if order == "area":
+        records = sorted(records, key=lambda record: record["area"], reverse=True)
+    elif order == "predicted_iou":
+        records = sorted(records, key=lambda record: record["predicted_iou"])
+    else:
+        raise RuntimeError("Mask order {} not implemented.".format(order))
+
+    label = start_label
+    with profiler.stage("compose_masks"):
+        for record in records:
+            mask, bbox = decode_rle_crop(record["segmentation"])
+            if mask is None:
+                continue
+            region = labels[bbox]
+            if not overwrite:
+                mask &= region == 0
+            region[mask] = label
+            label += 1
+    return label
+
+
+def get_tile_starts(length, tile_size, overlap):
+    """Start positions of tiles of tile_size that cover length and overlap by at least overlap pixels."""
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    starts = list(range(0, length - tile_size, step))
+    return starts + [length - tile_size]
+
+
+def get_generator_kwargs(generator):
+    """Arguments to create a SamAutomaticMaskGenerator with the same settings as generator."""
+    names = ("points_per_batch", "pred_iou_thresh", "stability_score_thresh", "stability_score_offset", "box_nms_thresh",
+             "crop_n_layers", "crop_nms_thresh", "crop_overlap_ratio", "point_grids", "min_mask_region_area")
+    kwargs = {name: getattr(generator, name) for name in names}
+    kwargs["points_per_side"] = None
+    kwargs["output_mode"] = "uncompressed_rle"
+    return kwargs
+
+
+def get_num_workers(sam_model, device, num_images, num_workers=None):
+    """Number of worker processes of Everything mode, 0 means that the masks are generated in the main process.
+
+    Uses num_workers or the NAPARI_SAM_NUM_WORKERS environment variable if given. Otherwise workers are only used on
+    the CPU and at most one per MIN_THREADS_PER_WORKER cores, as long as every worker gets at least two images and a
+    copy of the model fits into the available memory.
+    """
+    if num_workers is None and "NAPARI_SAM_NUM_WORKERS" in os.environ:
+        num_workers = int(os.environ["NAPARI_SAM_NUM_WORKERS"])
+    if num_workers is not None:
+        return max(int(num_workers), 0)
+    if str(device) != "cpu":
+        return 0
+    num_workers = min((os.cpu_count() or 1) // MIN_THREADS_PER_WORKER, num_images // 2)
+    available_memory = get_available_memory(device)
+    if available_memory is not None:
+        model_size = sum(parameter.numel() * parameter.element_size() for parameter in sam_model.parameters())
+        num_workers = min(num_workers, available_memory // (2 * model_size))
+    return int(num_workers) if num_workers > 1 else 0
+
+
+_worker_generator = None
+
+
+def _init_worker(build_model, device, generator_kwargs, num_threads):
+    global _worker_generator
+    torch.set_num_threads(num_threads)
+    sam_model = build_model()
+    sam_model.to(device)
+    _worker_generator = SamAutomaticMaskGenerator(sam_model, **generator_kwargs)
+
+
+def _generate(image):
+    return _worker_generator.generate(image)
+
+
+class MaskGeneratorPool:
+    """Runs SamAutomaticMaskGenerator in worker processes, each holding its own copy of the model.
+
+    Parameters
+    ----------
+    build_model : callable
+        Picklable callable without arguments that returns the SAM model, e.g. functools.partial(sam_model_registry[model_type], checkpoint).
+    generator_kwargs : dict
+        Arguments of SamAutomaticMaskGenerator, output_mode needs to be "uncompressed_rle".
+    num_workers : int
+        Number of worker processes.
+    device : str
+        Device the workers run the model on.
+    """
+    def __init__(self, build_model, generator_kwargs, num_workers, device="cpu"):
+        self.num_workers = num_workers
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        self._executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_init_worker, initargs=(build_model, device, generator_kwargs, num_threads))
+
+    def imap(self, images):
+        """Generate the masks of an iterable of images and yield the records in order.
+
+        Only a few images per worker are in flight at once, so images can be read lazily from large arrays.
+        """
+        pending = deque()
+        for image in images:
+            pending.append(self._executor.submit(_generate, image))
+            if len(pending) >= 2 * self.num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def match_labels(labels, reference, num_labels, min_iou=0.5):
+    """Map every label of labels to the label of reference it overlaps with the highest IoU.
+
+    Labels whose best IoU is below min_iou are mapped to 0. With min_iou >= 0.5 no two labels are mapped to the same
+    reference label. Returns the mapping as array indexed by label with num_labels + 1 entries.
+    """
+    mapping = np.zeros(num_labels + 1, dtype=np.int64)
+    both = (labels > 0) & (reference > 0)
+    if not np.any(both):
+        return mapping
+    pairs, counts = np.unique(np.stack((labels[both], reference[both])), axis=1, return_counts=True)
+    areas = np.bincount(labels.ravel(), minlength=num_labels + 1)
+    reference_ids, reference_counts = np.unique(reference, return_counts=True)
+    reference_areas = reference_counts[np.searchsorted(reference_ids, pairs[1])]
+    ious = counts / (areas[pairs[0]] + reference_areas - counts)
+    for index in np.argsort(-ious):
+        if ious[index] < min_iou:
+            break
+        label, reference_label = pairs[:, index]
+        if mapping[label] == 0:
+            mapping[label] = reference_label
+    return mapping
+
+
+def assign_new_labels(labels, mapping, next_label):
+    """Map all labels of labels that are not mapped yet to new labels starting at next_label. Returns the next unused label."""
+    present = np.zeros(len(mapping), dtype=bool)
+    present[np.unique(labels)] = True
+    present[0] = False
+    new_labels = np.flatnonzero(present & (mapping == 0))
+    mapping[new_labels] = np.arange(next_label, next_label + len(new_labels))
+    return next_label + len(new_labels)
+
+
+def merge_tile_labels(tile_labels, region, processed, next_label, min_iou=0.5):
+    """Merge the labels of a tile into the already segmented labels of the tile region.
+
+    Tile instances are matched with the instances of previous tiles by their IoU within the part of the tile that
+    previous tiles already segmented, so instances that cross tile boundaries keep a single ID. Unmatched instances get
+    new IDs starting at next_label. Only unlabeled pixels of region are written.
+
+    Returns the next unused label.
+    """
+    num_tile_labels = int(tile_labels.max())
+    if num_tile_labels == 0:
+        return next_label
+    mapping = match_labels(tile_labels[processed], region[processed], num_tile_labels, min_iou)
+    next_label = assign_new_labels(tile_labels, mapping, next_label)
+    unlabeled = region == 0
+    region[unlabeled] = mapping[tile_labels[unlabeled]]
+    return next_label
+
+
+def segment_tiled(image, generate, labels, preprocess, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, order="area"):
+    """Segment a large 2D image with SamAutomaticMaskGenerator tile by tile.
+
+    The image is split into overlapping tiles that are read, preprocessed and segmented one after another, so the
+    memory use is bounded by the tile size. Instances of every tile are merged into labels with merge_tile_labels.
+    This is a generator that yields the slices of every tile once it is written into labels.
+
+    Parameters
+    ----------
+    image : array-like
+        2D image (with a trailing channel axis for RGB images). Can be any array that supports slicing, e.g. dask or zarr.
+    generate : callable
+        Maps an iterable of uint8 HxWx3 images to an iterable of their records, e.g.
+        lambda images: map(generator.generate, images) or MaskGeneratorPool.imap.
+    labels : array-like
+        2D labels array of the image size the instances are written into.
+    preprocess : callable
+        Converts an image tile to uint8 HxWx3, e.g. ImagePreprocessor.
+    tile_size : int
+        Edge length of the tiles.
+    overlap : int
+        Minimal overlap of neighboring tiles.
+    order : str
+        Order in which the masks of a tile are painted, see compose_masks.
+    """
+    row_starts = get_tile_starts(labels.shape[0], tile_size, overlap)
+    col_starts = get_tile_starts(labels.shape[1], tile_size, overlap)
+    tiles = [(slice(y, min(y + tile_size, labels.shape[0])), slice(x, min(x + tile_size, labels.shape[1])))
+             for y in row_starts for x in col_starts]
+    tile_images = (np.ascontiguousarray(preprocess(image[tile])) for tile in tiles)
+    next_label = 1
+    for index, records in enumerate(generate(tile_images)):
+        tile = tiles[index]
+        row, col = divmod(index, len(col_starts))
+        tile_labels = np.zeros([s.stop - s.start for s in tile], dtype=np.int32)
+        compose_masks(records, tile_labels, order=order)
+        # Tiles are processed row by row, so previous tiles cover the top rows and the left columns of the tile
+        processed = np.zeros(tile_labels.shape, dtype=bool)
+        if row > 0:
+            processed[:tiles[index - len(col_starts)][0].stop - tile[0].start] = True
+        if col > 0:
+            processed[:, :tiles[index - 1][1].stop - tile[1].start] = True
+        with profiler.stage("merge_tiles"):
+            region = np.asarray(labels[tile])
+            next_label = merge_tile_labels(tile_labels, region, processed, next_label)
+            labels[tile] = region
+        yield tile
+
+
+def segment_slices(image, generate, labels, preprocess, order="area", min_iou=0.5):
+    """Segment a 3D image with SamAutomaticMaskGenerator slice by slice and link the instances across slices.
+
+    The instances of every slice are matched with the instances of the previous slice by their IoU, so an object that
+    spans several slices keeps a single ID. This is a generator that yields the region (tuple of slices) of every slice
+    once it is written into labels, so results can be displayed while the remaining slices are still segmented.
+
+    Parameters
+    ----------
+    image : array-like
+        3D image (with a trailing channel axis for RGB images). Dask and zarr arrays are read chunk by chunk.
+    generate : callable
+        Maps an iterable of uint8 HxWx3 images to an iterable of their records, see segment_tiled.
+    labels : array-like
+        3D labels array of the image size the instances are written into.
+    preprocess : callable
+        Converts an image slice to uint8 HxWx3, e.g. ImagePreprocessor.
+    order : str
+        Order in which the masks of a slice are painted, see compose_masks.
+    min_iou : float
+        Minimal IoU of two instances on neighboring slices to be linked.
+    """
+    reader = SliceReader(image, num_blocks=1)
+    slice_images = (np.ascontiguousarray(preprocess(reader[index])) for index in range(labels.shape[0]))
+    next_label = 1
+    previous_labels = None
+    for index, records in enumerate(generate(slice_images)):
+        slice_labels = np.zeros(labels.shape[1:], dtype=np.int32)
+        num_slice_labels = compose_masks(records, slice_labels, order=order) - 1
+        with profiler.stage("link_slices"):
+            mapping = np.zeros(num_slice_labels + 1, dtype=np.int64)
+            if previous_labels is not None and num_slice_labels > 0:
+                mapping = match_labels(slice_labels, previous_labels, num_slice_labels, min_iou)
+            next_label = assign_new_labels(slice_labels, mapping, next_label)
+            previous_labels = mapping[slice_labels]
+            labels[index] = previous_labels
+        yield (slice(index, index + 1),) + tuple(slice(0, size) for size in labels.shape[1:])
@@ -0,0 +1,176 @@
+import os
+from collections import deque
+import numpy as np
+from napari_sam.labels import write_values
+
+# Memory budget of the undo/redo history in MB, can be overwritten with the NAPARI_SAM_HISTORY_SIZE environment variable
+DEFAULT_HISTORY_SIZE = 512
+
+
+def rle_encode(values):
+    """Run-length encode a 1D array into (values, lengths)."""
+    if len(values) == 0:
+        return values[:0], np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    lengths = np.diff(np.append(starts, len(values)))
+    return values[starts], lengths
+
+
+def rle_decode(encoded):
+    values, lengths = encoded
+    return np.repeat(values, lengths)
+
+
+class LabelDelta:
+    """Compact record of a change to a labels array.
+
+    Stores the bounding box of the changed elements, a bit-packed mask of the changed elements within the bounding box
+    and the run-length encoded values before and after the change.
+    """
+    def __init__(self, indices, old_values, new_values):
+        indices = np.asarray(indices)
+        self.offset = indices.min(axis=1)
+        self.shape = tuple(indices.max(axis=1) - self.offset + 1)
+        flat_indices = np.ravel_multi_index(tuple(indices - self.offset[:, None]), self.shape)
+        order = np.argsort(flat_indices, kind="stable")
+        mask = np.zeros(int(np.prod(self.shape)), dtype=bool)
+        mask[flat_indices] = True
+        self.mask = np.packbits(mask)
+        self.old_values = rle_encode(np.asarray(old_values)[order])
+        self.new_values = rle_encode(np.broadcast_to(new_values, order.shape)[order])
+
+    @property
+    def region(self):
+        return tuple(slice(int(offset), int(offset) + size) for offset, size in zip(self.offset, self.shape))
+
+    @property
+    def nbytes(self):
+        return self.mask.nbytes + sum(array.nbytes for array in self.old_values + self.new_values) + self.offset.nbytes
+
+    def apply(self, data, undoing=True):
+        """Write the values before (undoing) or after the change into data and return the changed region.
+
+        Only the changed elements (or the chunks that contain them) are written, see write_values.
+        """
+        mask = np.unpackbits(self.mask, count=int(np.prod(self.shape))).reshape(self.shape).astype(bool)
+        indices = tuple(axis_indices + offset for axis_indices, offset in zip(np.nonzero(mask), self.offset))
+        write_values(data, indices, rle_decode(self.old_values if undoing else self.new_values))
+        return self.region
+
+
+class LogitsStore:
+    """Reference counted store of SAM mask logits that are shared between history items."""
+    def __init__(self):
+        self._entries = {}
+        self.nbytes = 0
+
+    def add(self, logits):
+        if logits is None:
+            return None
+        key = id(logits)
+        if key not in self._entries:
+            self._entries[key] = [logits, 0]
+            self.nbytes += logits.nbytes
+        self._entries[key][1] += 1
+        return key
+
+    def get(self, key):
+        if key is None:
+            return None
+        return self._entries[key][0]
+
+    def release(self, key):
+        if key is None:
+            return
+        entry = self._entries[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            self.nbytes -= entry[0].nbytes
+            del self._entries[key]
+
+
+class HistoryItem:
+    """A single click, point deletion, mask propagation or change to another candidate mask.
+
+    Parameters
+    ----------
+    point : tuple
+        (point_id, coords, label, added) of the point that was added or removed, None for a mask propagation or a
+        candidate change.
+    point_label : tuple
+        Active point label before and after the change.
+    logits_index : int
+        Slice of the changed logits (3D) or None (2D).
+    logits : tuple
+        Keys of the logits in the LogitsStore before and after the change.
+    label_delta : LabelDelta
+        Change to the labels layer or None if the labels did not change.
+    """
+    def __init__(self, point, point_label, logits_index, logits, label_delta):
+        self.point = point
+        self.point_label = point_label
+        self.logits_index = logits_index
+        self.logits = logits
+        self.label_delta = label_delta
+
+    @property
+    def nbytes(self):
+        size = 64 if self.point is None else np.asarray(self.point[1]).nbytes + 64
+        if self.label_delta is not None:
+            size += self.label_delta.nbytes
+        return size
+
+
+class History:
+    """Undo/redo history that keeps its items and their logits within a memory budget (in MB).
+
+    The oldest undo items are dropped once the budget is exceeded.
+    """
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = float(os.environ.get("NAPARI_SAM_HISTORY_SIZE", DEFAULT_HISTORY_SIZE))
+        self.max_size = int(max_size * 1024 ** 2)
+        self.logits_store = LogitsStore()
+        self._undo_history = deque()
+        self._redo_history = deque()
+        self._items_nbytes = 0
+
+    @property
+    def nbytes(self):
+        return self._items_nbytes + self.logits_store.nbytes
+
+    def push(self, point, point_label, logits_index, logits, label_delta):
+        self._clear(self._redo_history)
+        logits = tuple(self.logits_store.add(item_logits) for item_logits in logits)
+        item = HistoryItem(point, point_label, logits_index, logits, label_delta)
+        self._undo_history.append(item)
+        self._items_nbytes += item.nbytes
+        while self.nbytes > self.max_size and len(self._undo_history) > 1:
+            self._remove(self._undo_history.popleft())
+
+    def undo(self):
+        """Move the last item to the redo history and return it or None if there is nothing to undo."""
+        return self._move(self._undo_history, self._redo_history)
+
+    def redo(self):
+        """Move the last undone item back to the undo history and return it or None if there is nothing to redo."""
+        return self._move(self._redo_history, self._undo_history)
+
+    def get_logits(self, key):
+        return self.logits_store.get(key)
+
+    def _move(self, before, after):
+        if len(before) == 0:
+            return None
+        item = before.pop()
+        after.append(item)
+        return item
+
+    def _remove(self, item):
+        self._items_nbytes -= item.nbytes
+        for key in item.logits:
+            self.logits_store.release(key)
+
+    def _clear(self, history):
+        while history:
+            self._remove(history.pop())
@@ -0,0 +1,57 @@
+import tempfile
+import numpy as np
+from napari_sam.utils import get_cache_dir
+
+# Labels that need more than this fraction of the available memory are created on disk
+MAX_LABELS_MEMORY_FRACTION = 0.25
+
+
+def create_labels(shape, dtype=np.int32):
+    """Empty labels array of the given shape.
+
+    Labels that do not fit comfortably into memory are memory-mapped from an anonymous temporary file in the cache
+    directory, which is removed once the array is garbage collected. Only the pages that are written are backed by disk.
+    """
+    from napari_sam.embedding import get_available_memory
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    available_memory = get_available_memory("cpu")
+    if available_memory is None or nbytes <= MAX_LABELS_MEMORY_FRACTION * available_memory:
+        return np.zeros(shape, dtype=dtype)
+    labels_dir = get_cache_dir() / "labels"
+    labels_dir.mkdir(parents=True, exist_ok=True)
+    return np.memmap(tempfile.TemporaryFile(dir=labels_dir), dtype=dtype, mode="w+", shape=tuple(shape))
+
+
+def get_chunk_shape(data):
+    """Chunk shape of a chunked (e.g. zarr) array or None for NumPy and memory-mapped arrays."""
+    if isinstance(data, np.ndarray):
+        return None
+    chunks = getattr(data, "chunks", None)
+    if not chunks or isinstance(chunks[0], tuple):  # Dask arrays are read-only
+        return None
+    return tuple(chunks)
+
+
+def write_values(data, indices, values):
+    """Write values at indices (tuple of index arrays) into a labels array and return the bounding box of the change.
+
+    NumPy and memory-mapped arrays are written element-wise. Chunked arrays (e.g. zarr) are written chunk by chunk,
+    so only the chunks that contain changed elements are read, modified and written again.
+    """
+    if len(indices[0]) == 0:
+        return None
+    values = np.broadcast_to(values, indices[0].shape)
+    bbox = tuple(slice(int(axis_indices.min()), int(axis_indices.max()) + 1) for axis_indices in indices)
+    chunk_shape = get_chunk_shape(data)
+    if chunk_shape is None:
+        data[indices] = values
+        return bbox
+    chunk_indices = np.stack([axis_indices // size for axis_indices, size in zip(indices, chunk_shape)], axis=1)
+    chunks, inverse = np.unique(chunk_indices, axis=0, return_inverse=True)
+    for chunk_index, chunk in enumerate(chunks):
+        selected = np.flatnonzero(inverse.reshape(-1) == chunk_index)
+        region = tuple(slice(int(start) * size, min((int(start) + 1) * size, dim)) for start, size, dim in zip(chunk, chunk_shape, data.shape))
+        block = np.array(data[region], copy=True)
+        block[tuple(axis_indices[selected] - r.start for axis_indices, r in zip(indices, region))] = values[selected]
+        data[region] = block
+    return bbox
@@ -0,0 +1,106 @@
+import inspect
+import os
+import threading
+import weakref
+import torch
+from segment_anything import sam_model_registry
+from segment_anything.modeling import Sam
+from napari_sam.utils import get_weights_path
+
+PRECISIONS = {"float32": torch.float32, "bfloat16": torch.bfloat16, "float16": torch.float16}
+# Precision of the model weights, can be overwritten with the NAPARI_SAM_PRECISION environment variable
+DEFAULT_PRECISION = "float32"
+
+_models = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+
+def get_precision(precision=None):
+    if precision is None:
+        precision = os.environ.get("NAPARI_SAM_PRECISION", DEFAULT_PRECISION)
+    if precision not in PRECISIONS:
+        raise RuntimeError("Precision {} not implemented, use one of {}.".format(precision, ", ".join(PRECISIONS)))
+    return precision
+
+
+def get_model_id(model_type, precision):
+    """Identifier of a model in the given precision, e.g. for cache keys of its embeddings."""
+    return model_type if precision == "float32" else "{}-{}".format(model_type, precision)
+
+
+def get_model(model_type, device="cpu", precision=None):
+    """Process-wide shared SAM model of model_type on device with weights in the given precision.
+
+    A model is only loaded once and reused by all widgets and reloads as long as any of them still holds a reference to
+    it. Models are used for inference only, so sharing them between threads is safe.
+
+    Parameters
+    ----------
+    model_type : str
+        Key of segment_anything.sam_model_registry.
+    device : str
+        Device the model is moved to.
+    precision : str
+        "float32", "bfloat16" or "float16", defaults to the NAPARI_SAM_PRECISION environment variable or float32.
+        In reduced precision the weights of the image encoder and mask decoder are stored in that precision, which
+        halves their memory, while inputs and outputs stay float32.
+    """
+    precision = get_precision(precision)
+    key = (model_type, str(torch.device(device)), precision)
+    with _lock:
+        sam_model = _models.get(key)
+        if sam_model is None:
+            sam_model = load_weights(model_type, get_weights_path(model_type))
+            sam_model.to(device)
+            set_precision(sam_model, PRECISIONS[precision])
+            _models[key] = sam_model
+    return sam_model
+
+
+def load_weights(model_type, checkpoint):
+    """Build a SAM model from a checkpoint whose weights are memory-mapped instead of read into memory.
+
+    The model is created on the meta device, so its weights are never randomly initialized, and the memory-mapped
+    tensors of the checkpoint are used as its parameters. The checkpoint pages are therefore only read on first use and
+    shared between all processes that load the same checkpoint. Falls back to the regular loading of segment_anything
+    if memory mapping is not supported.
+    """
+    build_sam = sam_model_registry[model_type]
+    if checkpoint is None:
+        return build_sam(checkpoint)
+    try:
+        state_dict = torch.load(checkpoint, map_location="cpu", mmap=True, weights_only=True)
+        with torch.device("meta"):
+            sam_model = build_sam(None)
+        sam_model.load_state_dict(state_dict, assign=True)
+    except (TypeError, RuntimeError, AttributeError):
+        return build_sam(checkpoint)
+    # Buffers that are not part of the checkpoint are created from the defaults of Sam
+    parameters = inspect.signature(Sam.__init__).parameters
+    for name in ("pixel_mean", "pixel_std"):
+        sam_model.register_buffer(name, torch.tensor(parameters[name].default, dtype=torch.float32).view(-1, 1, 1), False)
+    if any(tensor.is_meta for tensor in list(sam_model.parameters()) + list(sam_model.buffers())):
+        return build_sam(checkpoint)
+    return sam_model
+
+
+def _cast(value, dtype):
+    if isinstance(value, torch.Tensor):
+        return value.to(dtype) if value.is_floating_point() else value
+    if isinstance(value, (tuple, list)):
+        return type(value)(_cast(item, dtype) for item in value)
+    return value
+
+
+def set_precision(sam_model, dtype):
+    """Store the weights of the image encoder and mask decoder in dtype.
+
+    Their float inputs are cast to dtype and their outputs back to float32, so the rest of SAM (and code that converts
+    outputs to NumPy) keeps working on float32. The tiny prompt encoder stays in float32.
+    """
+    if dtype == torch.float32:
+        return
+    for module in (sam_model.image_encoder, sam_model.mask_decoder):
+        module.to(dtype=dtype)
+        module.register_forward_pre_hook(lambda module, args, kwargs: (_cast(args, dtype), {key: _cast(value, dtype) for key, value in kwargs.items()}), with_kwargs=True)
+        module.register_forward_hook(lambda module, args, output: _cast(output, torch.float32))
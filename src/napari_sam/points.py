@@ -0,0 +1,74 @@
+from collections import defaultdict
+import numpy as np
+
+
+class PointRegistry:
+    """Seed points of a click session with stable point IDs.
+
+    Coordinates and labels are stored in arrays indexed by point ID. An index from slices to point IDs makes slice
+    queries O(points on the slice).
+
+    Parameters
+    ----------
+    ndim : int
+        Number of dimensions of the points. For 3D points the first axis is the slice axis.
+    """
+    def __init__(self, ndim):
+        self.ndim = ndim
+        self._coords = np.zeros((16, ndim), dtype=int)
+        self._labels = np.zeros(16, dtype=int)
+        self._next_id = 0
+        self._ids = {}  # Ordered set of the IDs of all points
+        self._ids_by_slice = defaultdict(dict)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, point_id):
+        return point_id in self._ids
+
+    def _slice_key(self, coords):
+        return int(coords[0]) if self.ndim == 3 else None
+
+    def add(self, coords, label, point_id=None):
+        """Add a point and return its ID. Passing the ID of a removed point restores it under the same ID."""
+        coords = np.asarray(coords, dtype=int)
+        if point_id is None:
+            point_id = self._next_id
+            self._next_id += 1
+        if point_id >= len(self._coords):
+            capacity = max(2 * len(self._coords), point_id + 1)
+            self._coords = np.resize(self._coords, (capacity, self.ndim))
+            self._labels = np.resize(self._labels, capacity)
+        self._coords[point_id] = coords
+        self._labels[point_id] = label
+        self._ids[point_id] = None
+        self._ids_by_slice[self._slice_key(coords)][point_id] = None
+        return point_id
+
+    def remove(self, point_id):
+        """Remove a point and return its coordinates and label."""
+        coords, label = self.get_coords(point_id), self.get_label(point_id)
+        del self._ids[point_id]
+        slice_key = self._slice_key(coords)
+        del self._ids_by_slice[slice_key][point_id]
+        if len(self._ids_by_slice[slice_key]) == 0:
+            del self._ids_by_slice[slice_key]
+        return coords, label
+
+    def get_coords(self, point_id):
+        return self._coords[point_id].copy()
+
+    def get_label(self, point_id):
+        return int(self._labels[point_id])
+
+    def ids(self, slice_index=None):
+        """IDs of all points or only of the points on slice_index (3D)."""
+        if slice_index is None:
+            return list(self._ids)
+        return list(self._ids_by_slice.get(slice_index, ()))
+
+    def get_points(self, slice_index=None):
+        """Coordinates and labels of all points or only of the points on slice_index (3D)."""
+        point_ids = self.ids(slice_index)
+        return self._coords[point_ids], self._labels[point_ids]
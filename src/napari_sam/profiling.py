@@ -0,0 +1,130 @@
+"""Latency instrumentation of the hot paths.
+
+Stages are timed with `with profiler.stage("name"):`. Recording is off unless enabled in the widget or with the
+NAPARI_SAM_PROFILE environment variable, a disabled stage only costs an attribute lookup. Recorded stages can be exported
+as Chrome trace (chrome://tracing, Perfetto) or as JSON statistics.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Maximum number of recorded stages that are kept for the trace, the statistics include all stages
+MAX_EVENTS = 100000
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    """Records the duration of named stages from any thread.
+
+    Parameters
+    ----------
+    enabled : bool
+        Whether stages are recorded.
+    max_events : int
+        Number of most recent stages that are kept for export.
+    """
+    def __init__(self, enabled=False, max_events=MAX_EVENTS):
+        self.enabled = enabled
+        self._events = deque(maxlen=max_events)
+        self._stats = {}
+        self._thread_names = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def stage(self, name):
+        """Context manager that records the duration of its block as stage name."""
+        if not self.enabled:
+            return _NullStage()
+        return _Stage(self, name)
+
+    def wrap(self, name, function):
+        """function with every call recorded as stage name."""
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed
+
+    def record(self, name, start, duration):
+        """Record a stage that started at start (time.perf_counter()) and took duration seconds."""
+        thread = threading.current_thread()
+        with self._lock:
+            self._thread_names[thread.ident] = thread.name
+            self._events.append((name, start, duration, thread.ident))
+            stats = self._stats.setdefault(name, [0, 0.0, 0.0, 0.0])  # count, total, max, last
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3] = duration
+
+    def reset(self):
+        with self._lock:
+            self._events.clear()
+            self._stats.clear()
+            self._origin = time.perf_counter()
+
+    def get_stats(self):
+        """Count and total, mean, max and last duration in ms of every stage."""
+        with self._lock:
+            return {name: {"count": count, "total_ms": 1000 * total, "mean_ms": 1000 * total / count, "max_ms": 1000 * maximum,
+                           "last_ms": 1000 * last} for name, (count, total, maximum, last) in self._stats.items()}
+
+    def format_stats(self):
+        """The statistics as a plain text table, slowest stages (by total duration) first."""
+        stats = sorted(self.get_stats().items(), key=lambda item: item[1]["total_ms"], reverse=True)
+        lines = ["{:<22}{:>7}{:>10}{:>10}{:>10}".format("Stage", "Count", "Last ms", "Mean ms", "Max ms")]
+        for name, stage in stats:
+            lines.append("{:<22}{:>7}{:>10.1f}{:>10.1f}{:>10.1f}".format(name[:21], stage["count"], stage["last_ms"], stage["mean_ms"], stage["max_ms"]))
+        return "\n".join(lines)
+
+    def get_chrome_trace(self):
+        """Recorded stages in the Chrome trace event format."""
+        pid = os.getpid()
+        with self._lock:
+            events = list(self._events)
+            thread_names = dict(self._thread_names)
+            origin = self._origin
+        trace_events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}} for tid, name in thread_names.items()]
+        trace_events += [{"name": name, "cat": "napari-sam", "ph": "X", "pid": pid, "tid": tid, "ts": 1e6 * (start - origin), "dur": 1e6 * duration}
+                         for name, start, duration, tid in events]
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def export(self, path, format="chrome"):
+        """Write the recorded stages to path as Chrome trace ("chrome") or as statistics and stages ("json")."""
+        if format == "chrome":
+            data = self.get_chrome_trace()
+        elif format == "json":
+            with self._lock:
+                events = [{"name": name, "start_ms": 1000 * (start - self._origin), "duration_ms": 1000 * duration,
+                           "thread": self._thread_names.get(tid)} for name, start, duration, tid in self._events]
+            data = {"stats": self.get_stats(), "events": events}
+        else:
+            raise RuntimeError("Export format {} not implemented, use one of chrome, json".format(format))
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+
+# Profiler of the process, enabled from the start with NAPARI_SAM_PROFILE=1
+profiler = Profiler(enabled=os.environ.get("NAPARI_SAM_PROFILE", "0") not in ("", "0"))
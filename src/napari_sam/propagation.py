@@ -0,0 +1,84 @@
+import numpy as np
+import torch
+from napari_sam.utils import get_bbox
+
+# Number of slices per direction that are predicted from the same prompt in one batch
+PROPAGATION_BATCH_SIZE = 4
+# Propagation stops at slices whose mask is smaller or larger than these ratios of the mask on the previous slice
+MIN_AREA_RATIO = 0.1
+MAX_AREA_RATIO = 4.0
+
+
+def get_box(mask):
+    """Bounding box (x_min, y_min, x_max, y_max) of a 2D mask as expected by SAM."""
+    bbox = get_bbox(mask)
+    return np.array([bbox[1].start, bbox[0].start, bbox[1].stop - 1, bbox[0].stop - 1])
+
+
+def propagate_mask(decoder, predictor, embeddings, mask, slice_index, logits=None, batch_size=PROPAGATION_BATCH_SIZE,
+                   min_area_ratio=MIN_AREA_RATIO, max_area_ratio=MAX_AREA_RATIO):
+    """Propagate the mask of an object on one slice of a 3D image up and down through the neighboring slices.
+
+    The box of the mask on the last segmented slice in each direction and its logits are used as prompts for the next
+    batch_size slices in that direction. The slices of both directions are decoded together in one batch. A direction
+    stops at the first slice where the object vanishes, i.e. whose mask is empty or changes its area by more than the
+    given ratios compared to the slice before, or at the border of the image. This is a generator that yields
+    (done, total, result) after every batch, where result is a list of (slice_index, mask_crop, bbox, logits) of the
+    segmented slices, with the mask cropped to its bounding box (tuple of slices) as returned by the widget's predict.
+
+    Parameters
+    ----------
+    decoder : ExportedDecoder
+        Decoder that predicts batches of prompts, e.g. ExportedDecoder(sam_model, "torch").
+    predictor : SamPredictor
+        Predictor prepared with set_image_size.
+    embeddings : SliceEmbeddings
+        Embeddings of the slices of the image.
+    mask : np.ndarray
+        Mask of the object on slice_index.
+    slice_index : int
+        Annotated slice.
+    logits : np.ndarray
+        Logits of the prediction of mask with shape (1, 256, 256), if available.
+    """
+    num_slices = len(embeddings)
+    fronts = {direction: (slice_index, mask, logits) for direction in (-1, 1)}
+    done = 0
+    yield done, num_slices - 1, None
+    while len(fronts) > 0:
+        jobs = []
+        for direction, (index, front_mask, front_logits) in fronts.items():
+            box = get_box(front_mask)
+            for step in range(1, batch_size + 1):
+                if 0 <= index + direction * step < num_slices:
+                    jobs.append((direction, index + direction * step, box, front_logits))
+        if len(jobs) == 0:
+            break
+        indices = [index for _, index, _, _ in jobs]
+        embeddings.compute(indices)
+        features = torch.cat([embeddings[index] for index in indices])
+        mask_input = None
+        if all(job_logits is not None for _, _, _, job_logits in jobs):
+            mask_input = np.stack([job_logits for _, _, _, job_logits in jobs])
+        masks, _, batch_logits = decoder.predict_batch(predictor, features, boxes=np.stack([box for _, _, box, _ in jobs]), mask_input=mask_input)
+
+        result = []
+        new_fronts = {}
+        for direction, (index, front_mask, _) in fronts.items():
+            area = np.count_nonzero(front_mask)
+            for (job_direction, job_index, _, _), job_mask, job_logits in zip(jobs, masks[:, 0], batch_logits):
+                if job_direction != direction:
+                    continue
+                job_area = np.count_nonzero(job_mask)
+                if job_area == 0 or not min_area_ratio * area <= job_area <= max_area_ratio * area:
+                    break
+                bbox = get_bbox(job_mask)
+                result.append((job_index, job_mask[bbox], bbox, job_logits))
+                area = job_area
+                new_fronts[direction] = (job_index, job_mask, job_logits)
+            else:
+                continue
+            new_fronts.pop(direction, None)  # The object vanished
+        fronts = new_fronts
+        done += len(result)
+        yield done, num_slices - 1, result
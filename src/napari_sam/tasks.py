@@ -0,0 +1,133 @@
+import time
+from collections import deque
+from qtpy.QtCore import QObject, Signal
+from qtpy.QtWidgets import QApplication
+from napari.qt.threading import create_worker
+
+
+class Task:
+    """A function that runs in a background thread together with the callbacks that handle its results on the GUI thread."""
+    def __init__(self, function, args, kwargs, description=None, on_done=None, on_yielded=None, on_cancelled=None):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.description = description
+        self.on_done = on_done
+        self.on_yielded = on_yielded
+        self.on_cancelled = on_cancelled
+
+
+class TaskQueue(QObject):
+    """Runs heavy work (model loading, embedding, mask generation and prediction) in background threads.
+
+    Tasks run one at a time in the order they were submitted, so every task sees the results of all tasks before it.
+    Results are passed to the callbacks of a task on the GUI thread. Generator functions report their progress by
+    yielding (done, total) or (done, total, result) tuples, the result of the latter is passed to on_yielded.
+    cancel() stops generator tasks at their next yield and drops the results of all running and pending tasks. If a task
+    fails, the exception is raised on the GUI thread and all pending tasks are cancelled.
+
+    Signals
+    -------
+    started(str)
+        A task with the given description started.
+    progress(int, int)
+        The running task finished done of total steps.
+    idle()
+        All tasks are done.
+    """
+    started = Signal(str)
+    progress = Signal(int, int)
+    idle = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._pending = deque()
+        self._task = None  # Task whose results are still applied
+        self._worker = None  # Worker of the running task, also while a cancelled task is finishing
+
+    @property
+    def is_busy(self):
+        return self._worker is not None or len(self._pending) > 0
+
+    def submit(self, function, *args, description=None, on_done=None, on_yielded=None, on_cancelled=None, **kwargs):
+        """Run function(*args, **kwargs) in a background thread after all previously submitted tasks are done.
+
+        Parameters
+        ----------
+        function : callable
+            Function or generator function that is run in the background thread. If None, on_done is called with None
+            on the GUI thread once all previously submitted tasks are done.
+        description : str
+            Shown to the user while the task is running.
+        on_done : callable
+            Called with the return value of function.
+        on_yielded : callable
+            Called with the results that a generator function yields.
+        on_cancelled : callable
+            Called without arguments if the task is cancelled or fails. Cancelled tasks are notified in reverse order, so
+            that their changes can be rolled back.
+        """
+        self._pending.append(Task(function, args, kwargs, description, on_done, on_yielded, on_cancelled))
+        self._start_next()
+
+    def cancel(self):
+        """Cancel the running and all pending tasks."""
+        if self._task is not None:
+            self._worker.quit()
+        self._drop_tasks()
+        if self._worker is None:
+            self.idle.emit()
+
+    def wait(self):
+        """Process Qt events until all tasks are done."""
+        while self.is_busy:
+            QApplication.processEvents()
+            time.sleep(0.01)
+
+    def _start_next(self):
+        while self._worker is None and len(self._pending) > 0 and self._pending[0].function is None:
+            task = self._pending.popleft()
+            if task.on_done is not None:
+                task.on_done(None)
+        if self._worker is not None or len(self._pending) == 0:
+            return
+        self._task = self._pending.popleft()
+        self._worker = create_worker(self._task.function, *self._task.args, _start_thread=False, **self._task.kwargs)
+        self._worker.returned.connect(lambda result, task=self._task: self._on_returned(task, result))
+        self._worker.errored.connect(lambda exception, task=self._task: self._on_errored(task, exception))
+        if hasattr(self._worker, "yielded"):
+            self._worker.yielded.connect(lambda value, task=self._task: self._on_yielded(task, value))
+        self._worker.finished.connect(self._on_finished)
+        self.started.emit(self._task.description or "")
+        self._worker.start()
+
+    def _on_returned(self, task, result):
+        if task is self._task and task.on_done is not None:
+            task.on_done(result)
+
+    def _on_yielded(self, task, value):
+        if task is not self._task or value is None:
+            return
+        self.progress.emit(int(value[0]), int(value[1]))
+        if len(value) > 2 and value[2] is not None and task.on_yielded is not None:
+            task.on_yielded(value[2])
+
+    def _on_errored(self, task, exception):
+        if task is self._task:
+            self._drop_tasks()
+            raise exception
+
+    def _drop_tasks(self):
+        tasks = ([self._task] if self._task is not None else []) + list(self._pending)
+        self._task = None
+        self._pending.clear()
+        for task in reversed(tasks):
+            if task.on_cancelled is not None:
+                task.on_cancelled()
+
+    def _on_finished(self):
+        self._task = None
+        self._worker = None
+        self._start_next()
+        if self._worker is None:
+            self.idle.emit()
@@ -1,9 +1,9 @@
-import urllib.request
 from pathlib import Path
 import os
 import os.path
 from os.path import join
-from tqdm import tqdm
+import threading
+import numpy as np
 
 SAM_WEIGHTS_URL = {
     "default": "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_h_4b8939.pth",
@@ -12,49 +12,42 @@ SAM_WEIGHTS_URL = {
     "vit_b": "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_b_01ec64.pth",
 }
 
+# Same order as segment_anything.sam_model_registry, which is only imported once a model is loaded
+SAM_MODEL_TYPES = tuple(SAM_WEIGHTS_URL.keys())
 
-def download_with_progress(url, output_file):
-    # Open the URL and get the content length
-    req = urllib.request.urlopen(url)
-    content_length = int(req.headers.get('Content-Length'))
 
-    # Set up the progress bar
-    progress_bar = tqdm(total=content_length, unit='B', unit_scale=True)
-
-    # Download the file and update the progress bar
-    with open(output_file, 'wb') as f:
-        downloaded_bytes = 0
-        while True:
-            buffer = req.read(8192)
-            if not buffer:
-                break
-            downloaded_bytes += len(buffer)
-            f.write(buffer)
-            progress_bar.update(len(buffer))
-
-    # Close the progress bar and the URL
-    progress_bar.close()
-    req.close()
+def get_cache_dir():
+    cache_dir = Path.home() / ".cache/napari-segment-anything"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
 
 
 def get_weights_path(model_type):
-    weight_url = SAM_WEIGHTS_URL[model_type]
+    """Path of the checkpoint of model_type, which is downloaded and verified against its SHA-256 if necessary.
 
-    cache_dir = Path.home() / ".cache/napari-segment-anything"
-    cache_dir.mkdir(parents=True, exist_ok=True)
+    Weights are downloaded from the NAPARI_SAM_WEIGHTS_URL environment variable (a base URL or a local directory)
+    instead of SAM_WEIGHTS_URL if it is set.
+    """
+    from napari_sam.download import SAM_WEIGHTS_SHA256, get_mirror_url, download_file, is_verified
+    weight_url = get_mirror_url(SAM_WEIGHTS_URL[model_type])
+
+    cache_dir = get_cache_dir()
 
     weight_path = cache_dir / weight_url.split("/")[-1]
+    sha256 = SAM_WEIGHTS_SHA256.get(weight_path.name)
 
-    if not weight_path.exists():
+    if not is_verified(weight_path, sha256):
+        if weight_path.exists():  # E.g. an interrupted download of an earlier version, resumed if it is a prefix
+            os.replace(weight_path, weight_path.with_name(weight_path.name + ".part"))
         print("Downloading {} to {} ...".format(weight_url, weight_path))
-        download_with_progress(weight_url, weight_path)
+        download_file(weight_url, weight_path, sha256)
 
     return weight_path
 
 
 def get_cached_weight_types(model_types):
     cached_weight_types = {}
-    cache_dir = str(Path.home() / ".cache/napari-segment-anything")
+    cache_dir = str(get_cache_dir())
 
     for model_type in model_types:
         model_type_name = os.path.basename(SAM_WEIGHTS_URL[model_type])
@@ -66,16 +59,141 @@ def get_cached_weight_types(model_types):
     return cached_weight_types
 
 
-def normalize(x, source_limits=None, target_limits=None):
-    if source_limits is None:
-        source_limits = (x.min(), x.max())
-
-    if target_limits is None:
-        target_limits = (0, 1)
-
-    if source_limits[0] == source_limits[1] or target_limits[0] == target_limits[1]:
-        return x * 0
-    else:
-        x_std = (x - source_limits[0]) / (source_limits[1] - source_limits[0])
-        x_scaled = x_std * (target_limits[1] - target_limits[0]) + target_limits[0]
-        return x_scaled
\ No newline at end of file
+def get_bbox(mask):
+    """Bounding box of the non-zero elements of a mask as tuple of slices or None if the mask is empty."""
+    bbox = []
+    for axis in range(mask.ndim):
+        nonzero = np.flatnonzero(np.any(mask, axis=tuple(i for i in range(mask.ndim) if i != axis)))
+        if len(nonzero) == 0:
+            return None
+        bbox.append(slice(int(nonzero[0]), int(nonzero[-1]) + 1))
+    return tuple(bbox)
+
+
+def union_bbox(bbox1, bbox2):
+    if bbox1 is None:
+        return bbox2
+    if bbox2 is None:
+        return bbox1
+    return tuple(slice(min(s1.start, s2.start), max(s1.stop, s2.stop)) for s1, s2 in zip(bbox1, bbox2))
+
+
+class ImagePreprocessor:
+    """Converts images to the uint8 RGB images SAM expects in a single pass.
+
+    Intensities are mapped from the contrast limits to [0, 255] and clipped. Integer images with at most 16 bits are
+    converted with a lookup table, all other images in row chunks through a reusable float32 buffer, so no full-size
+    float temporaries are created. Grayscale images are expanded to RGB with a broadcast view instead of a copy and
+    uint8 images whose contrast limits are (0, 255) are returned without any copy.
+
+    Parameters
+    ----------
+    dtype : np.dtype
+        Data type of the images that will be converted.
+    contrast_limits : tuple
+        Intensities that are mapped to 0 and 255.
+    rgb : bool
+        Whether the images have a trailing (RGB or RGBA) channel axis.
+    """
+    def __init__(self, dtype, contrast_limits, rgb=False):
+        self.dtype = np.dtype(dtype)
+        self.contrast_limits = (float(contrast_limits[0]), float(contrast_limits[1]))
+        self.rgb = rgb
+        self.lut = None
+        self.is_identity = self.dtype == np.uint8 and self.contrast_limits == (0, 255)
+        if self.dtype.kind in "ui" and self.dtype.itemsize <= 2:
+            # Index the lookup table with the unsigned view of the image, so signed values are looked up correctly
+            values = np.arange(2 ** (8 * self.dtype.itemsize), dtype="u{}".format(self.dtype.itemsize)).view(self.dtype)
+            self.lut = self._scale(values.astype(np.float32))
+        self._buffers = threading.local()
+
+    def _scale(self, x, out=None):
+        lower, upper = self.contrast_limits
+        if out is None:
+            out = np.empty(x.shape, dtype=np.uint8)
+        if lower == upper:
+            out[...] = 0
+            return out
+        x = np.subtract(x, lower, out=x, casting="unsafe")
+        x = np.multiply(x, 255 / (upper - lower), out=x)
+        x = np.clip(x, 0, 255, out=x)
+        np.copyto(out, x, casting="unsafe")
+        return out
+
+    def __call__(self, image, out=None):
+        image = np.asarray(image)
+        if self.rgb:
+            image = image[..., :3]  # Remove a potential alpha channel
+        if self.is_identity:
+            result = image
+        elif self.lut is not None:
+            unsigned_image = image.view("u{}".format(self.dtype.itemsize))
+            result = np.take(self.lut, unsigned_image, out=out)
+        else:
+            result = np.empty(image.shape, dtype=np.uint8) if out is None else out
+            rows = max(1, (1 << 20) // max(1, image[:1].size))
+            buffer = getattr(self._buffers, "buffer", None)
+            if buffer is None or buffer.size < rows * image[:1].size:
+                buffer = self._buffers.buffer = np.empty(rows * image[:1].size, dtype=np.float32)
+            for start in range(0, len(image), rows):
+                chunk = image[start:start+rows]
+                chunk_buffer = buffer[:chunk.size].reshape(chunk.shape)
+                np.copyto(chunk_buffer, chunk, casting="unsafe")
+                self._scale(chunk_buffer, out=result[start:start+rows])
+        if not self.rgb:
+            result = np.broadcast_to(result[..., None], (*result.shape, 3))  # Expand to 3-channel image
+        return result
+
+
+class SliceReader:
+    """Reads the slices of a (lazy) 3D array chunk by chunk.
+
+    Dask and zarr arrays are read in blocks of whole chunks along the first axis. The last blocks are kept, so a chunk
+    that holds several slices is only read and decompressed once when its slices are accessed one after another.
+    Blocks larger than max_block_size bytes and arrays without chunks (NumPy, memory-mapped) are indexed slice by slice.
+
+    Parameters
+    ----------
+    image : array-like
+        3D image (with a trailing channel axis for RGB images).
+    max_block_size : int
+        Maximal size of a cached block in bytes.
+    num_blocks : int
+        Number of cached blocks, more than one avoids reading blocks again when slices are accessed around a center.
+    """
+    def __init__(self, image, max_block_size=256 * 1024 ** 2, num_blocks=2):
+        self.image = image
+        self.max_block_size = max_block_size
+        self.num_blocks = num_blocks
+        self.chunk_starts = self._get_chunk_starts(image)
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_chunk_starts(image):
+        chunks = getattr(image, "chunks", None)
+        if not chunks:
+            return None
+        if isinstance(chunks[0], tuple):  # Dask arrays have the sizes of all chunks along every axis
+            return np.cumsum((0,) + chunks[0])
+        return np.append(np.arange(0, image.shape[0], chunks[0]), image.shape[0])  # Zarr arrays have one chunk shape
+
+    def __len__(self):
+        return self.image.shape[0]
+
+    def __getitem__(self, index):
+        if self.chunk_starts is None:
+            return np.asarray(self.image[index])
+        chunk = np.searchsorted(self.chunk_starts, index, side="right") - 1
+        start, stop = int(self.chunk_starts[chunk]), int(self.chunk_starts[chunk + 1])
+        slice_size = int(np.prod(self.image.shape[1:])) * np.dtype(self.image.dtype).itemsize
+        if (stop - start) * slice_size > self.max_block_size:
+            return np.asarray(self.image[index])
+        with self._lock:
+            block = self._blocks.pop(start, None)
+            if block is None:
+                block = np.asarray(self.image[start:stop])
+                while len(self._blocks) >= self.num_blocks:
+                    del self._blocks[next(iter(self._blocks))]
+            self._blocks[start] = block  # Most recently used block last
+        return block[index - start]